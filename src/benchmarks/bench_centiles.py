@@ -0,0 +1,133 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "workflows", "common")
+)
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "workflows", "w_sMRI")
+)
+import roi_tables as roitab
+import w_mlscores as w_mlscores
+
+
+def calc_subject_centiles_loop(
+    df_in: pd.DataFrame, df_cent: pd.DataFrame, df_dict: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Reference (per subject, per ROI) implementation of the centile calculation
+    """
+    rdict = dict(zip(df_dict["Name"], df_dict["Code"]))
+    df_cent["VarName"] = df_cent["VarName"].replace(rdict)
+
+    cent = df_cent.columns[2:].str.replace("centile_", "").astype(int).values
+
+    df_in["Age"] = df_in.Age.round(0)
+    df_in.loc[df_in["Age"] > df_cent.Age.max(), "Age"] = df_cent.Age.max()
+    df_in.loc[df_in["Age"] < df_cent.Age.min(), "Age"] = df_cent.Age.min()
+
+    sel_vars = df_in.columns[df_in.columns.isin(df_cent.VarName.unique())].tolist()
+
+    cent_subj_all = np.zeros([df_in.shape[0], len(sel_vars)])
+    for i, tmp_ind in enumerate(df_in.index):
+        df_subj = df_in.loc[[tmp_ind]]
+        df_cent_sel = df_cent[df_cent.Age == df_subj.Age.values[0]]
+
+        for j, tmp_var in enumerate(sel_vars):
+            vals_cent = df_cent_sel[df_cent_sel.VarName == tmp_var].values[0][2:]
+            sval = df_subj[tmp_var].values[0]
+            sval = np.min([vals_cent[-1], np.max([vals_cent[0], sval])])
+            ind1 = np.where(sval <= vals_cent)[0][0] - 1
+            if ind1 == -1:
+                ind1 = 0
+            ind2 = ind1 + 1
+            slope = (cent[ind2] - cent[ind1]) / (vals_cent[ind2] - vals_cent[ind1])
+            cent_subj_all[i, j] = cent[ind1] + slope * (sval - vals_cent[ind1])
+
+    df_out = pd.DataFrame(columns=sel_vars, data=cent_subj_all)
+    df_out = pd.concat([df_in[["MRID"]], df_out], axis=1)
+
+    return df_out
+
+
+def make_data(num_subj: int, num_roi: int, seed: int = 0) -> list:
+    """
+    Creates a synthetic centile table, roi dictionary and subject data
+    """
+    rng = np.random.default_rng(seed)
+    ages = np.arange(21, 96)
+    cent = [5, 25, 50, 75, 95]
+    list_roi = [f"MUSE_{i}" for i in range(num_roi)]
+
+    # Centile curves: a random baseline per ROI, decreasing with age
+    base = rng.uniform(1e3, 1e5, num_roi)
+    rows = []
+    for r, roi in enumerate(list_roi):
+        for age in ages:
+            med = base[r] * (1.2 - age / 200)
+            rows.append([roi, age] + [med * (0.7 + 0.006 * c) for c in cent])
+    df_cent = pd.DataFrame(
+        rows, columns=["VarName", "Age"] + [f"centile_{c}" for c in cent]
+    )
+    df_dict = pd.DataFrame({"Name": list_roi, "Code": list_roi})
+
+    df_in = pd.DataFrame(
+        rng.uniform(0.4, 1.4, [num_subj, num_roi]) * base, columns=list_roi
+    )
+    df_in.insert(0, "Age", rng.uniform(15, 100, num_subj))
+    df_in.insert(0, "MRID", [f"Subj{i}" for i in range(num_subj)])
+
+    return [df_in, df_cent, df_dict]
+
+
+def run_benchmark(list_nsubj: list, num_roi: int, max_nsubj_loop: int) -> None:
+    print(
+        f"{'subjects':>10} {'vectorized (s)':>15} {'loop (s)':>10} {'max abs diff':>13}"
+    )
+    for num_subj in list_nsubj:
+        df_in, df_cent, df_dict = make_data(num_subj, num_roi)
+
+        t0 = time.perf_counter()
+        df_vec = w_mlscores.calc_subject_centiles(
+            df_in.copy(), roitab.make_centile_table(df_cent), df_dict
+        )
+        t_vec = time.perf_counter() - t0
+
+        t_loop, diff = np.nan, np.nan
+        if num_subj <= max_nsubj_loop:
+            t0 = time.perf_counter()
+            df_loop = calc_subject_centiles_loop(df_in.copy(), df_cent.copy(), df_dict)
+            t_loop = time.perf_counter() - t0
+            diff = np.nanmax(
+                np.abs(df_vec.iloc[:, 1:].values - df_loop.iloc[:, 1:].values)
+            )
+
+        print(f"{num_subj:>10} {t_vec:>15.3f} {t_loop:>10.3f} {diff:>13.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_subj",
+        help="Provide the list of sample sizes",
+        nargs="+",
+        type=int,
+        default=[100, 1000, 10000, 100000],
+    )
+    parser.add_argument(
+        "--num_roi", help="Provide the number of ROIs", type=int, default=250
+    )
+    parser.add_argument(
+        "--max_subj_loop",
+        help="Provide the max sample size for the reference loop",
+        type=int,
+        default=1000,
+    )
+    options = parser.parse_args()
+
+    run_benchmark(options.num_subj, options.num_roi, options.max_subj_loop)
@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), "viewer"))
+import utils.utils_stats as utilstat
+
+
+def fit_statsmodels(df: pd.DataFrame, frac: float) -> list:
+    """
+    Reference implementation (statsmodels OLS and exact LOWESS per group)
+    """
+    out_lin, out_lowess = {}, {}
+    for hname, dfh in df.dropna().sort_values("Age").groupby("Sex"):
+        x_ext = sm.add_constant(dfh["Age"])
+        model = sm.OLS(dfh["GM"], x_ext).fit()
+        out_lin[hname] = model.get_prediction(x_ext).conf_int()
+        out_lowess[hname] = sm.nonparametric.lowess(dfh["GM"], dfh["Age"], frac=frac)
+    return [out_lin, out_lowess]
+
+
+def fit_engine(df: pd.DataFrame, frac: float) -> list:
+    """
+    Fit engine (closed form OLS and binned LOWESS, without the cache)
+    """
+    plot_data = utilstat.calc_plot_data(df, "Age", "GM", "Sex")
+    return [utilstat.calc_linreg(plot_data), utilstat.calc_lowess(plot_data, frac)]
+
+
+def fit_cached(df: pd.DataFrame, frac: float) -> list:
+    """
+    Fit engine with the cache (the cost of a rerun with unchanged data)
+    """
+    plot_data = utilstat.get_plot_data(df, "Age", "GM", "Sex")
+    return [
+        utilstat.linreg_model(plot_data),
+        utilstat.lowess_model(plot_data, frac),
+    ]
+
+
+def make_data(num_points: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Creates a synthetic cohort (age, roi volume and sex of each subject)
+    """
+    rng = np.random.default_rng(seed)
+    age = rng.uniform(20, 95, num_points)
+    sex = rng.choice(["F", "M"], num_points)
+    vol = 7e5 - 20 * (age - 20) ** 2 + 4e4 * (sex == "M")
+    vol += rng.normal(0, 3e4, num_points)
+    return pd.DataFrame({"Age": age, "GM": vol, "Sex": sex})
+
+
+def run_benchmark(list_npoints: list, frac: float, flag_ref: bool) -> None:
+    list_funcs = [("engine", fit_engine), ("cached", fit_cached)]
+    if flag_ref:
+        list_funcs = [("statsmodels", fit_statsmodels)] + list_funcs
+
+    print("Linear fit and LOWESS, two groups")
+    for num_points in list_npoints:
+        df = make_data(num_points)
+        fit_cached(df, frac)
+        for name, func in list_funcs:
+            t0 = time.perf_counter()
+            func(df, frac)
+            t_run = time.perf_counter() - t0
+            print(f"{num_points:>8} {name:>12}: {t_run:.3f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_points",
+        help="Provide the list of sample sizes",
+        nargs="+",
+        type=int,
+        default=[1000, 5000, 30000],
+    )
+    parser.add_argument(
+        "--frac", help="Provide the LOWESS smoothness", type=float, default=0.7
+    )
+    parser.add_argument(
+        "--no_ref",
+        help="Do not run the reference implementation (slow for large samples)",
+        action="store_true",
+    )
+    options = parser.parse_args()
+
+    run_benchmark(options.num_points, options.frac, not options.no_ref)
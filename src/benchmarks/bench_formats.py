@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "workflows", "w_sMRI")
+)
+import w_mlscores as w_mlscores
+
+
+def make_data(num_subj: int, num_col: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Creates a synthetic DLMUSE+MLScores like table
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        rng.uniform(1e2, 1e5, [num_subj, num_col - 4]),
+        columns=[f"MUSE_{i}" for i in range(num_col - 4)],
+    )
+    df.insert(0, "Sex", rng.choice(["M", "F"], num_subj))
+    df.insert(0, "Age", rng.uniform(20, 95, num_subj).round(1))
+    df.insert(0, "Study", rng.choice([f"Study{i}" for i in range(10)], num_subj))
+    df.insert(0, "MRID", [f"Subj{i}" for i in range(num_subj)])
+    return df
+
+
+def read_table(f_in: str, columns: list = None) -> pd.DataFrame:
+    """
+    Reads a table (all or selected columns) by file extension
+    """
+    if f_in.endswith(".parquet"):
+        return pd.read_parquet(f_in, columns=columns)
+    if f_in.endswith(".feather"):
+        return pd.read_feather(f_in, columns=columns)
+    return pd.read_csv(f_in, dtype={"MRID": str}, usecols=columns)
+
+
+def time_call(func: Any, num_rep: int) -> float:
+    """
+    Returns the best time of num_rep calls
+    """
+    list_t = []
+    for _ in range(num_rep):
+        t0 = time.perf_counter()
+        func()
+        list_t.append(time.perf_counter() - t0)
+    return min(list_t)
+
+
+def run_benchmark(num_subj: int, num_col: int, num_rep: int) -> None:
+    df = make_data(num_subj, num_col)
+    sel_cols = ["MRID", "Age", "Sex", "MUSE_10"]
+
+    print(f"Table: {num_subj} rows x {num_col} columns")
+    print(
+        f"{'format':>8} {'size (MB)':>10} {'write (s)':>10} {'read all (s)':>13}"
+        f" {'read 4 cols (s)':>16}"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for out_format, ext in w_mlscores.table_formats.items():
+            f_out = os.path.join(tmp_dir, f"data{ext}")
+
+            def write(f_out: str = f_out) -> None:
+                w_mlscores.write_table(df, f_out)
+                w_mlscores.close_tables()
+
+            t_write = time_call(write, 1)
+            size = os.path.getsize(f_out) / 1e6
+            t_all = time_call(lambda f_out=f_out: read_table(f_out), num_rep)
+            t_sel = time_call(lambda f_out=f_out: read_table(f_out, sel_cols), num_rep)
+
+            print(
+                f"{out_format:>8} {size:>10.1f} {t_write:>10.3f} {t_all:>13.3f}"
+                f" {t_sel:>16.3f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_subj", help="Provide the number of rows", type=int, default=50000
+    )
+    parser.add_argument(
+        "--num_col", help="Provide the number of columns", type=int, default=300
+    )
+    parser.add_argument(
+        "--num_rep", help="Provide the number of repeated reads", type=int, default=3
+    )
+    options = parser.parse_args()
+
+    run_benchmark(options.num_subj, options.num_col, options.num_rep)
@@ -0,0 +1,177 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), "viewer"))
+import utils.utils_mriview as utilmri
+import utils.utils_nifti as utilni
+
+
+def crop_image(img: np.ndarray, mask: np.ndarray, crop_to_mask: bool) -> Any:
+    """
+    Crop img to the foreground of the mask (reference, padded to a cube)
+    """
+    if crop_to_mask:
+        crop_box = utilmri.get_crop_box(mask)
+    else:
+        crop_box = utilmri.get_crop_box(img)
+
+    img = utilmri.apply_crop_box(img, crop_box)
+    mask = utilmri.apply_crop_box(mask, crop_box)
+
+    return img, mask
+
+
+def detect_mask_bounds(mask: Any) -> Any:
+    """
+    Detect the mask start, end and center in each view (reference)
+    """
+    mask_bounds = np.zeros([3, 3]).astype(int)
+    for i in range(3):
+        mask_bounds[i, 0] = 0
+        mask_bounds[i, 1] = mask.shape[i]
+        slices_nz = np.where(np.sum(mask, axis=utilmri.VIEW_OTHER_AXES[i]) > 0)[0]
+        if len(slices_nz) > 0:
+            mask_bounds[i, 2] = slices_nz[len(slices_nz) // 2]
+        else:
+            mask_bounds[i, 2] = mask.shape[i] // 2
+
+    return mask_bounds
+
+
+def prep_image_and_olay_full(
+    f_img: str, f_mask: str, list_rois: list, crop_to_mask: bool
+) -> Any:
+    """
+    Reference (full RGB volume) implementation of the viewer image preparation
+    """
+    nii_img = utilni.reorient_nifti(nib.load(f_img), ref_orient="IPL")
+    nii_mask = utilni.reorient_nifti(nib.load(f_mask), ref_orient="IPL")
+
+    out_img = nii_img.get_fdata()
+    out_mask = nii_mask.get_fdata()
+
+    out_img = ndimage.zoom(out_img, nii_img.header.get_zooms(), order=0, mode="nearest")
+    out_mask = ndimage.zoom(
+        out_mask, nii_mask.header.get_zooms(), order=0, mode="nearest"
+    )
+    out_img = out_img - np.min([0, out_img.min()])
+    out_img = out_img.astype(float) / out_img.max()
+    out_img, out_mask = crop_image(out_img, out_mask, crop_to_mask)
+    out_mask = np.isin(out_mask, list_rois)
+
+    out_img = np.stack((out_img,) * 3, axis=-1)
+    out_img_masked = out_img.copy()
+    out_img_masked[out_mask == 1] = (
+        out_img_masked[out_mask == 1] * (1 - utilmri.OLAY_ALPHA)
+        + utilmri.MASK_COLOR * utilmri.OLAY_ALPHA
+    )
+
+    return out_img, out_mask, out_img_masked
+
+
+def make_data(out_dir: str, shape: list, zooms: list, seed: int = 0) -> list:
+    """
+    Creates a synthetic T1 image and a label image (nested ellipsoids)
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing="ij")
+    rad = np.sqrt(sum(g**2 for g in grid))
+
+    labels = np.zeros(shape, dtype=np.int16)
+    for i, r in enumerate(np.linspace(0.8, 0.1, 20)):
+        labels[rad < r] = i + 1
+    img = (labels * 50 + rng.normal(0, 20, shape)).astype(np.float32)
+
+    affine = np.diag(list(zooms) + [1])
+    f_img = os.path.join(out_dir, "subj_T1.nii.gz")
+    f_mask = os.path.join(out_dir, "subj_T1_DLMUSE.nii.gz")
+    nib.save(nib.Nifti1Image(img, affine), f_img)
+    nib.save(nib.Nifti1Image(labels, affine), f_mask)
+
+    return [f_img, f_mask]
+
+
+def time_first_slice(func: Any) -> list:
+    """
+    Returns the time and peak traced memory (MB) of a call
+    """
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    func()
+    t_run = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return [t_run, peak]
+
+
+def run_benchmark(shape: list, zooms: list) -> None:
+    list_rois = [5, 6, 7]
+    axis = 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        f_img, f_mask = make_data(tmp_dir, shape, zooms)
+
+        def first_slice_full() -> None:
+            img, mask, img_masked = prep_image_and_olay_full(
+                f_img, f_mask, list_rois, True
+            )
+            bounds = detect_mask_bounds(mask)
+            first_slice_full.out = [img, mask, img_masked]
+            first_slice_full.slice = img_masked[bounds[axis, 2]]
+
+        def first_slice_lazy() -> None:
+            img, mask, slice_maps, padding = utilmri.prep_image_and_labels(
+                f_img, f_mask, True
+            )
+            bounds = utilmri.detect_roi_bounds(
+                utilni.get_label_index(f_mask), slice_maps, list_rois
+            )
+            first_slice_lazy.out = [img, mask]
+            first_slice_lazy.slice = utilmri.get_slice_rgb(
+                img, mask, axis, bounds[axis, 2], list_rois, padding
+            )
+
+        print(f"Image: {shape} voxels, voxel size {zooms}")
+        print(
+            f"{'method':>8} {'first slice (s)':>16} {'peak mem (MB)':>14}"
+            f" {'kept mem (MB)':>14}"
+        )
+        for name, func in [("full", first_slice_full), ("lazy", first_slice_lazy)]:
+            t_run, peak = time_first_slice(func)
+            kept = sum(x.nbytes for x in func.out) / 1e6
+            print(f"{name:>8} {t_run:>16.3f} {peak:>14.1f} {kept:>14.1f}")
+
+        diff = np.abs(
+            first_slice_full.slice * 255 - first_slice_lazy.slice.astype(float)
+        ).max()
+        print(f"Max abs diff of the first slice (0-255 scale): {diff:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shape",
+        help="Provide the image size",
+        nargs=3,
+        type=int,
+        default=[176, 240, 256],
+    )
+    parser.add_argument(
+        "--zooms",
+        help="Provide the voxel size",
+        nargs=3,
+        type=float,
+        default=[1.0, 1.0, 1.0],
+    )
+    options = parser.parse_args()
+
+    run_benchmark(options.shape, options.zooms)
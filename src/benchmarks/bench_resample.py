@@ -0,0 +1,106 @@
+import argparse
+import os
+import sys
+import time
+from typing import Any
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), "viewer"))
+import utils.utils_nifti as utilni
+
+
+def resample_zoom(nii_img: Any, nii_mask: Any) -> list:
+    """
+    Reference implementation (reorientation followed by ndimage.zoom)
+    """
+    nii_img = utilni.reorient_nifti(nii_img, ref_orient="IPL")
+    nii_mask = utilni.reorient_nifti(nii_mask, ref_orient="IPL")
+
+    out_img = nii_img.get_fdata(dtype=np.float32)
+    out_mask = np.asanyarray(nii_mask.dataobj).astype(np.uint16)
+
+    out_img = ndimage.zoom(out_img, nii_img.header.get_zooms(), order=0, mode="nearest")
+    out_mask = ndimage.zoom(
+        out_mask, nii_mask.header.get_zooms(), order=0, mode="nearest"
+    )
+    return [out_img, out_mask]
+
+
+def resample_maps(nii_img: Any, nii_mask: Any) -> list:
+    """
+    Index map implementation (maps are calculated once per image geometry)
+    """
+    out_img = utilni.resample_volume(
+        nii_img.get_fdata(dtype=np.float32), utilni.get_resample_maps(nii_img)
+    )
+    out_mask = utilni.resample_volume(
+        np.asanyarray(nii_mask.dataobj), utilni.get_resample_maps(nii_mask)
+    ).astype(np.uint16, copy=False)
+    return [out_img, out_mask]
+
+
+def make_data(shape: list, zooms: list, orient: str, seed: int = 0) -> list:
+    """
+    Creates a synthetic FLAIR image and a lesion label image
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing="ij")
+    rad = np.sqrt(sum(g**2 for g in grid))
+
+    labels = (rad < 0.3).astype(np.int16) + (rad < 0.1)
+    img = (300 * (rad < 0.8) + 200 * labels + rng.normal(0, 20, shape)).astype(
+        np.float32
+    )
+
+    # Affine with the given axis codes (e.g. LAS, RAS, LPI)
+    affine = np.eye(4)
+    affine[:3, :3] = 0
+    for i, (axis, flip) in enumerate(nib.orientations.axcodes2ornt(orient)):
+        affine[int(axis), i] = flip * zooms[i]
+
+    return [nib.Nifti1Image(img, affine), nib.Nifti1Image(labels, affine)]
+
+
+def run_benchmark(shape: list, zooms: list, orient: str, num_reps: int) -> None:
+    nii_img, nii_mask = make_data(shape, zooms, orient)
+    print(f"Image: {shape} voxels, voxel size {zooms}, orientation {orient}")
+
+    out = {}
+    for name, func in [("zoom", resample_zoom), ("maps", resample_maps)]:
+        func(nii_img, nii_mask)
+        t0 = time.perf_counter()
+        for _ in range(num_reps):
+            out[name] = func(nii_img, nii_mask)
+        t_run = (time.perf_counter() - t0) / num_reps
+        print(f"{name:>6}: {t_run:.3f} s (image and mask)")
+
+    is_equal = all(np.array_equal(x, y) for x, y in zip(out["zoom"], out["maps"]))
+    print(f"Output size: {out['maps'][0].shape}, identical: {is_equal}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shape",
+        help="Provide the image size",
+        nargs=3,
+        type=int,
+        default=[256, 256, 48],
+    )
+    parser.add_argument(
+        "--zooms",
+        help="Provide the voxel size",
+        nargs=3,
+        type=float,
+        default=[0.9, 0.9, 3.0],
+    )
+    parser.add_argument("--orient", help="Provide the image orientation", default="LAS")
+    parser.add_argument(
+        "--num_reps", help="Provide the number of repetitions", type=int, default=5
+    )
+    options = parser.parse_args()
+
+    run_benchmark(options.shape, options.zooms, options.orient, options.num_reps)
@@ -0,0 +1,115 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), "viewer"))
+import utils.utils_cmaps as utilcmap
+import utils.utils_stats as utilstat
+import utils.utils_traces as utiltr
+
+
+def make_data(num_points: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Creates a synthetic cohort (age, roi volume and sex of each subject)
+    """
+    rng = np.random.default_rng(seed)
+    age = rng.uniform(20, 95, num_points)
+    sex = rng.choice(["F", "M"], num_points)
+    vol = 7e5 - 2e3 * age + 4e4 * (sex == "M") + rng.normal(0, 3e4, num_points)
+    return pd.DataFrame(
+        {
+            "MRID": [f"Subj{i:06d}" for i in range(num_points)],
+            "Age": age,
+            "GM": vol,
+            "Sex": sex,
+        }
+    )
+
+
+def get_plot_settings(mode: str) -> dict:
+    """
+    Returns plot settings for a plot mode (svg, webgl or density)
+    """
+    plot_settings = {
+        "cmaps": utilcmap.cmaps_init,
+        "alphas": utilcmap.alphas_init,
+        "flag_hide_legend": False,
+        "scattergl_min_points": 5000,
+        "flag_density": True,
+        "density_min_points": 50000,
+        "density_bins": 150,
+    }
+    if mode == "svg":
+        plot_settings["scattergl_min_points"] = np.inf
+        plot_settings["flag_density"] = False
+    elif mode == "webgl":
+        plot_settings["scattergl_min_points"] = 0
+        plot_settings["flag_density"] = False
+    elif mode == "density":
+        plot_settings["scattergl_min_points"] = 0
+        plot_settings["density_min_points"] = 0
+    return plot_settings
+
+
+def build_figure(df: pd.DataFrame, plot_settings: dict) -> go.Figure:
+    """
+    Builds the scatter plot
+    """
+    plot_params = {
+        "xvar": "Age",
+        "yvar": "GM",
+        "hvar": "Sex",
+        "hvals": None,
+        "traces": ["data"],
+    }
+    fig = go.Figure()
+    plot_data = utilstat.calc_plot_data(df, "Age", "GM", "Sex")
+    utiltr.add_trace_scatter(plot_data, plot_params, plot_settings, fig)
+    return fig
+
+
+def run_benchmark(list_npoints: list, list_modes: list) -> None:
+    print("Server side figure build and serialization (browser render not included)")
+    print(
+        f"{'points':>8} {'mode':>8} {'time (s)':>9} {'payload (MB)':>13} {'points sent':>12}"
+    )
+    for num_points in list_npoints:
+        df = make_data(num_points)
+        for mode in list_modes:
+            plot_settings = get_plot_settings(mode)
+            t0 = time.perf_counter()
+            fig = build_figure(df, plot_settings)
+            # The serialized figure is the payload sent to the browser
+            fig_json = fig.to_json()
+            t_run = time.perf_counter() - t0
+            num_sent = sum(len(x.x) for x in fig.data if x.type != "heatmap")
+            print(
+                f"{num_points:>8} {mode:>8} {t_run:>9.3f}"
+                f" {len(fig_json) / 1e6:>13.2f} {num_sent:>12}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_points",
+        help="Provide the list of sample sizes",
+        nargs="+",
+        type=int,
+        default=[1000, 10000, 100000],
+    )
+    parser.add_argument(
+        "--modes",
+        help="Provide the plot modes",
+        nargs="+",
+        choices=["svg", "webgl", "density"],
+        default=["svg", "webgl", "density"],
+    )
+    options = parser.parse_args()
+
+    run_benchmark(options.num_points, options.modes)
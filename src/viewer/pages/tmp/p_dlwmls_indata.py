@@ -115,24 +115,29 @@ def panel_extract(status: bool) -> None:
             btn_convert = st.button("Convert Series")
             if btn_convert:
                 with st.spinner("Wait for it..."):
-                    try:
-                        utildcm.convert_sel_series(
-                            st.session_state.df_dicoms,
-                            st.session_state.sel_series,
-                            dout,
-                            f"_{sel_mod}.nii.gz",
-                        )
-                        st.session_state.flags[sel_mod] = True
-                        # if st.session_state.has_cloud_session:
-                        #     utilcloud.update_stats_db(
-                        #         st.session_state.cloud_user_id, "NIFTIfromDICOM", num_nifti
-                        #     )
-
-                    except:
-                        st.warning(":material/thumb_down: Nifti conversion failed!")
-
-                time.sleep(1)
-                st.rerun()
+                    df_conv = utildcm.convert_sel_series(
+                        st.session_state.df_dicoms,
+                        st.session_state.sel_series,
+                        dout,
+                        f"_{sel_mod}.nii.gz",
+                    )
+                    # if st.session_state.has_cloud_session:
+                    #     utilcloud.update_stats_db(
+                    #         st.session_state.cloud_user_id, "NIFTIfromDICOM", num_nifti
+                    #     )
+
+                # Show the status of each series (failed series are kept on screen)
+                st.dataframe(df_conv[["SeriesDesc", "nifti_file", "Status", "Message"]])
+                num_fail = (df_conv.Status != "Success").sum()
+                if num_fail < df_conv.shape[0]:
+                    st.session_state.flags[sel_mod] = True
+                if num_fail > 0:
+                    st.warning(
+                        f":material/thumb_down: Nifti conversion failed for {num_fail} of {df_conv.shape[0]} series!"
+                    )
+                else:
+                    time.sleep(1)
+                    st.rerun()
 
         utilst.util_help_dialog(
             utildoc.title_dicoms_extract, utildoc.def_dicoms_extract
@@ -186,10 +191,11 @@ def panel_view(status: bool) -> None:
 
             try:
                 # Prepare final 3d matrix to display
-                img = utilni.prep_image(path_img)
+                img, padding = utilni.prep_image(path_img)
 
-                # Detect mask bounds and center in each view
-                img_bounds = utilni.detect_img_bounds(img)
+                # Detect mask bounds and center in each view (in padded coordinates)
+                img_bounds = utilni.detect_img_bounds(img, padding)
+                img = utilni.pad_image(img)
 
                 # Show images
                 blocks = st.columns(len(list_orient))
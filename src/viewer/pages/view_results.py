@@ -47,7 +47,6 @@ def plot_vars():
     """
     Panel for viewing dlmuse results
     """    
-    st.session_state.plot_data['df_data'] = utilpl.read_data(st.session_state.paths['plot_data']) 
     var_groups_data = ['demog', 'roi']
     var_groups_hue = ['cat_vars']
     pipeline = 'dlmuse'
@@ -74,6 +73,11 @@ def plot_vars():
         pipeline
     )
 
+    # Data is read once per file version and shared (read-only) by all pages
+    data = utilpl.load_data(st.session_state.paths['plot_data'])
+    st.session_state.plot_data['df_data'] = data['df']
+    st.session_state.plot_data['info'] = data['info']
+
     utilpl.panel_show_plots()
 
 st.markdown(
@@ -1,4 +1,5 @@
 import os
+import shutil
 import sys
 
 import pandas as pd
@@ -270,7 +271,42 @@ def panel_run() -> None:
 
     with st.container(border=True):
 
+        flag_checkpoint = st.checkbox(
+            "Save intermediate files",
+            value=True,
+            help="Write the results of each step to the working dir",
+        )
+        num_workers = st.number_input(
+            "Number of parallel steps",
+            min_value=1,
+            max_value=os.cpu_count(),
+            value=1,
+            help="Independent steps (SPARE, SurrealGAN, CCL-NMF) can run in parallel",
+        )
+        flag_inproc = st.checkbox(
+            "Apply models in-process",
+            value=False,
+            help="Keep loaded models in memory instead of calling external tools",
+        )
+        chunk_size = st.number_input(
+            "Batch size",
+            min_value=0,
+            value=0,
+            step=1000,
+            help="Process subjects in batches of this size (0: all subjects at once). With harmonization, all sites must be in the COMBAT model",
+        )
+        out_format = st.selectbox(
+            "Format of intermediate files",
+            ["csv", "parquet", "feather"],
+            help="With a columnar format, a copy of the output csv is also saved in this format",
+        )
+        flag_cache = st.checkbox(
+            "Reuse results of unchanged steps",
+            value=False,
+            help="Steps with the same input data, models and parameters as in a previous run are not recomputed",
+        )
         btn_mlscore = st.button("Run MLScore", disabled=False)
+        flag_failed = False
         if btn_mlscore:
 
             if not os.path.exists(st.session_state.paths["mlscores"]):
@@ -305,6 +341,12 @@ def panel_run() -> None:
                             st.session_state.paths["csv_dlmuse"],
                             st.session_state.paths["csv_demog"],
                             st.session_state.paths["mlscores"],
+                            flag_checkpoint,
+                            num_workers,
+                            flag_inproc,
+                            chunk_size,
+                            out_format,
+                            flag_cache,
                         )
                     else:
                         w_mlscores.run_workflow_noharmonization(
@@ -313,12 +355,19 @@ def panel_run() -> None:
                             st.session_state.paths["csv_dlmuse"],
                             st.session_state.paths["csv_demog"],
                             st.session_state.paths["mlscores"],
+                            flag_checkpoint,
+                            num_workers,
+                            flag_inproc,
+                            chunk_size,
+                            out_format,
+                            flag_cache,
                         )
                 except:
+                    flag_failed = True
                     st.warning(":material/thumb_up: ML scores calculation failed!")
 
-        # Check out file
-        if os.path.exists(st.session_state.paths["csv_mlscores"]):
+        # Check out file (not after a failed run)
+        if not flag_failed and os.path.exists(st.session_state.paths["csv_mlscores"]):
             st.success(
                 f"Data is ready ({st.session_state.paths['csv_mlscores']}).\n\n Output data includes harmonized ROIs, SPARE scores (AD, Age, Diabetes, Hyperlipidemia, Hypertension, Obesity, Smoking) and SurrealGAN subtype indices (R1-R5), and CCLNMF components.\n\n For more information on interpreting CCLNMF component results, please see the associated README at https://github.com/CBICA/CCL_NMF_Prediction/blob/main/README.md",
                 icon=":material/thumb_up:",
@@ -328,9 +377,16 @@ def panel_run() -> None:
             # Copy output to plots
             if not os.path.exists(st.session_state.paths["plots"]):
                 os.makedirs(st.session_state.paths["plots"])
-            os.system(
-                f"cp {st.session_state.paths['csv_mlscores']} {st.session_state.paths['csv_plot']}"
+            shutil.copy(
+                st.session_state.paths["csv_mlscores"],
+                st.session_state.paths["csv_plot"],
             )
+            f_table = utilio.get_table_file(st.session_state.paths["csv_mlscores"])
+            if f_table != st.session_state.paths["csv_mlscores"]:
+                f_ext = os.path.splitext(f_table)[1]
+                shutil.copy(
+                    f_table, f"{st.session_state.paths['csv_plot'][:-4]}{f_ext}"
+                )
             st.session_state.flags["csv_plot"] = True
             p_plot = st.session_state.paths["csv_plot"]
             print(f"Data copied to {p_plot}")
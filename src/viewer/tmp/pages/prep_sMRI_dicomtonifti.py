@@ -168,12 +168,18 @@ def panel_extract():
         btn_convert = st.button("Convert Series", disabled=flag_disabled)
         if btn_convert:
             with st.spinner("Wait for it..."):
-                utildcm.convert_sel_series(
+                df_conv = utildcm.convert_sel_series(
                     st.session_state.df_dicoms,
                     st.session_state.sel_series,
                     st.session_state.paths[st.session_state.sel_mod],
                     f"_{st.session_state.sel_mod}.nii.gz",
                 )
+            st.dataframe(df_conv[["SeriesDesc", "nifti_file", "Status", "Message"]])
+            num_fail = (df_conv.Status != "Success").sum()
+            if num_fail > 0:
+                st.warning(
+                    f":material/thumb_down: Nifti conversion failed for {num_fail} of {df_conv.shape[0]} series!"
+                )
 
         num_nifti = utilio.get_file_count(
             st.session_state.paths[st.session_state.sel_mod],
@@ -256,10 +262,11 @@ def panel_view():
         with st.spinner("Wait for it..."):
 
             # Prepare final 3d matrix to display
-            img = utilni.prep_image(st.session_state.paths["sel_img"])
+            img, padding = utilni.prep_image(st.session_state.paths["sel_img"])
 
-            # Detect mask bounds and center in each view
-            img_bounds = utilni.detect_img_bounds(img)
+            # Detect mask bounds and center in each view (in padded coordinates)
+            img_bounds = utilni.detect_img_bounds(img, padding)
+            img = utilni.pad_image(img)
 
             # Show images
             blocks = st.columns(len(list_orient))
@@ -0,0 +1,267 @@
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+# Memory budget (MB) of the volume cache shared by all sessions
+VOLUME_CACHE_MB = int(os.getenv("NICHART_VOLUME_CACHE_MB", "2048"))
+
+# Folder and disk budget (MB) of uncompressed copies of .nii.gz images
+# (an empty folder value disables the cache)
+NIFTI_CACHE_DIR = os.getenv(
+    "NICHART_NIFTI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nichart_nifti")
+)
+NIFTI_CACHE_MB = int(os.getenv("NICHART_NIFTI_CACHE_MB", "4096"))
+
+# Memory budget (MB) of the data table cache shared by all sessions
+DATA_CACHE_MB = int(os.getenv("NICHART_DATA_CACHE_MB", "2048"))
+
+
+def get_file_key(list_files: list) -> tuple:
+    """
+    Returns a key for a list of files (path, size and mtime of each file),
+    so that cached values are invalidated when a file changes
+    """
+    key = []
+    for fname in list_files:
+        try:
+            fstat = os.stat(fname)
+            key.append((fname, fstat.st_size, fstat.st_mtime_ns))
+        except (OSError, TypeError):
+            key.append((fname, None, None))
+    return tuple(key)
+
+
+def get_nbytes(value: Any) -> int:
+    """
+    Returns the size (bytes) of numpy arrays and dataframes in a value (single
+    array or dataframe, or tuple, list or dict of values)
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        # Strings are counted here: memory_usage(deep=True) raises a ValueError
+        # for read-only object arrays (it needs a writable buffer)
+        nbytes = int(value.memory_usage(deep=False).sum())
+        for col in value.select_dtypes(include="object"):
+            nbytes += sum(map(sys.getsizeof, value[col].to_numpy()))
+        return nbytes
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(x) for x in value)
+    return 0
+
+
+def set_read_only(value: Any) -> None:
+    """
+    Sets numpy arrays in a value as read only (cached arrays are shared by sessions)
+    """
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        set_read_only(list(value.values()))
+    elif isinstance(value, (tuple, list)):
+        for x in value:
+            set_read_only(x)
+
+
+class ArrayLRUCache:
+    """
+    LRU cache of array values (prepared volumes, trend fits and data tables),
+    limited by the total size of the arrays.
+    Values that are likely to be needed next can be loaded in a background
+    thread (prefetch); a request for a value that is being loaded waits for it.
+    """
+
+    def __init__(self, max_bytes: int, num_workers: int = 1) -> None:
+        self.max_bytes = max_bytes
+        self.curr_bytes = 0
+        self.items: OrderedDict = OrderedDict()
+        self.pending: dict = {}
+        self.prefetch_jobs: list = []
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="array_cache"
+        )
+
+    def get(self, key: Any, func: Callable, *args: Any) -> Any:
+        """
+        Returns the cached value for the key, or calls func(*args) and caches it
+        """
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.items[key][0]
+            fut = self.pending.get(key)
+            flag_load = fut is None
+            if flag_load:
+                fut = Future()
+                self.pending[key] = fut
+                self.stats["misses"] += 1
+
+        # Value is being loaded by another thread
+        if not flag_load:
+            return fut.result()
+
+        try:
+            value = func(*args)
+        except BaseException as e:
+            with self.lock:
+                self.pending.pop(key, None)
+            fut.set_exception(e)
+            raise
+
+        self.put(key, value)
+        with self.lock:
+            self.pending.pop(key, None)
+        fut.set_result(value)
+        return value
+
+    def put(self, key: Any, value: Any) -> None:
+        """
+        Adds a value to the cache, evicting least recently used values if needed
+        """
+        nbytes = get_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        set_read_only(value)
+        with self.lock:
+            if key in self.items:
+                self.curr_bytes -= self.items.pop(key)[1]
+            while self.curr_bytes + nbytes > self.max_bytes:
+                _, (_, old_nbytes) = self.items.popitem(last=False)
+                self.curr_bytes -= old_nbytes
+                self.stats["evictions"] += 1
+            self.items[key] = (value, nbytes)
+            self.curr_bytes += nbytes
+
+    def prefetch(self, list_jobs: list) -> None:
+        """
+        Loads values in the background for a list of (key, func, args)
+        Prefetch jobs from earlier calls that have not started are cancelled
+        """
+        for job in self.prefetch_jobs:
+            job.cancel()
+        self.prefetch_jobs = []
+        for key, func, args in list_jobs:
+            with self.lock:
+                if key in self.items or key in self.pending:
+                    continue
+            self.prefetch_jobs.append(self.executor.submit(self.get, key, func, *args))
+
+    def clear(self) -> None:
+        """
+        Removes all cached values
+        """
+        with self.lock:
+            self.items.clear()
+            self.curr_bytes = 0
+
+    def info(self) -> dict:
+        """
+        Returns cache usage info
+        """
+        with self.lock:
+            return {
+                "num_items": len(self.items),
+                "size_mb": self.curr_bytes / 1e6,
+                "max_size_mb": self.max_bytes / 1e6,
+            } | self.stats
+
+
+def get_nifti_cache_file(fname: str) -> str:
+    """
+    Returns the name of the uncompressed copy of an image in the NIfTI cache
+    """
+    key = hashlib.sha1(repr(get_file_key([os.path.abspath(fname)])).encode())
+    return os.path.join(NIFTI_CACHE_DIR, f"{key.hexdigest()}.nii")
+
+
+def evict_nifti_cache(max_bytes: float) -> None:
+    """
+    Deletes least recently used copies until the NIfTI cache fits in max_bytes
+    (copies are touched when they are used)
+    """
+    list_files = []
+    for entry in os.scandir(NIFTI_CACHE_DIR):
+        if entry.name.endswith(".nii"):
+            try:
+                fstat = entry.stat()
+                list_files.append((fstat.st_mtime, fstat.st_size, entry.path))
+            except OSError:
+                continue
+
+    total_bytes = sum(x[1] for x in list_files)
+    for _, fsize, fname in sorted(list_files):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(fname)
+            total_bytes -= fsize
+        except OSError:
+            continue
+
+
+def load_nifti(fname: str) -> Any:
+    """
+    Loads a NIfTI image
+    A .nii.gz image is decompressed once to the NIfTI cache (keyed by path,
+    size and mtime); later loads memory map the uncompressed copy
+    """
+    if not NIFTI_CACHE_DIR or not fname.endswith(".gz"):
+        return nib.load(fname)
+
+    f_cache = get_nifti_cache_file(fname)
+    if os.path.exists(f_cache):
+        try:
+            os.utime(f_cache)
+            return nib.load(f_cache, mmap=True)
+        except Exception:
+            print(f"Unable to read cached image: {f_cache}")
+
+    # Decompress the image (the copy has the same header and data as the source)
+    f_tmp = f"{f_cache}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(NIFTI_CACHE_DIR, exist_ok=True)
+        with gzip.open(fname, "rb") as f_in, open(f_tmp, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 22)
+        os.replace(f_tmp, f_cache)
+        evict_nifti_cache(NIFTI_CACHE_MB * 1e6)
+        return nib.load(f_cache, mmap=True)
+    except Exception as e:
+        print(f"Unable to cache image {fname}: {e}")
+        try:
+            os.remove(f_tmp)
+        except OSError:
+            pass
+        return nib.load(fname)
+
+
+@st.cache_resource  # type:ignore
+def get_volume_cache() -> ArrayLRUCache:
+    """
+    Returns the volume cache shared by all sessions
+    """
+    return ArrayLRUCache(VOLUME_CACHE_MB * 1e6)
+
+
+@st.cache_resource  # type:ignore
+def get_data_cache() -> ArrayLRUCache:
+    """
+    Returns the data table cache shared by all sessions
+    """
+    return ArrayLRUCache(DATA_CACHE_MB * 1e6)
@@ -213,3 +213,9 @@ def select_files(in_dir):
             except:
                 st.error(f'Could not write merged data: {st.session_state.paths['plot_data']}')
 
+            # Save a columnar copy for fast reads of selected columns
+            try:
+                utilio.write_table_copy(merged_df, st.session_state.paths['plot_data'])
+            except Exception as e:
+                print(f'Could not write columnar copy of merged data: {e}')
+
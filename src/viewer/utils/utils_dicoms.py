@@ -1,8 +1,9 @@
-import gc
+import hashlib
 import os
 import re
-import traceback
+import tempfile
 import unicodedata
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any
 
 import dicom2nifti.common as common
@@ -63,7 +64,9 @@ def _remove_accents_(unicode_filename: str) -> str:
     Function that will try to remove accents from a unicode string to be used in a filename.
     input filename should be either an ascii or unicode string
     """
-    valid_characters = bytes(b"-_.() 1234567890abcdefghijklmnopqrstuvwxyz")
+    valid_characters = bytes(
+        b"-_.() 1234567890abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    )
     cleaned_filename = unicodedata.normalize("NFKD", unicode_filename).encode(
         "ASCII", "ignore"
     )
@@ -77,51 +80,165 @@ def _remove_accents_(unicode_filename: str) -> str:
 
     return new_filename
 
+# Dicom tags read for the series index (fields used in index + validity check)
+index_tags = [
+    "PatientID",
+    "StudyDate",
+    "SeriesDescription",
+    "SeriesInstanceUID",
+    "InstanceNumber",
+    "ImageOrientationPatient",
+    "ImagePositionPatient",
+    "SharedFunctionalGroupsSequence",
+    "PerFrameFunctionalGroupsSequence",
+]
+index_fields = ["PatientID", "StudyDate", "SeriesDesc", "SeriesInstanceUID"]
+
+# Dir of dicom indexes (one file per dicom folder, keyed by the folder path)
+DICOM_INDEX_DIR = os.getenv(
+    "NICHART_DICOM_INDEX_DIR",
+    os.path.join(tempfile.gettempdir(), "nichart_dicom_index"),
+)
+
+# Max number of processes used for reading headers and converting series
+DICOM_MAX_WORKERS = int(os.getenv("NICHART_DICOM_MAX_WORKERS", "4"))
+
 # Adapted from dicom2nifti
-def detect_series(in_dir: str) -> Any:
+def read_dicom_fields(file_path: str) -> list:
     """
-    This function selects dicom files that match the selection keywords
-    Selection is done using the "SeriesDescription"
+    Reads the index fields from the header of a dicom file (only selected tags)
+    Fields are set to None for files that are not valid imaging dicoms
+    """
+    dfields = [None] * len(index_fields)
+    try:
+        if common.is_dicom_file(file_path):
+            # read only selected tags of the dicom header
+            dicom_headers = dcmread(
+                file_path,
+                defer_size="1 KB",
+                stop_before_pixels=True,
+                force=dicom2nifti.settings.pydicom_read_force,
+                specific_tags=index_tags,
+            )
+            if _is_valid_imaging_dicom(dicom_headers):
+                dfields = [
+                    str(dicom_headers.PatientID),
+                    str(dicom_headers.StudyDate),
+                    str(dicom_headers.SeriesDescription),
+                    str(dicom_headers.SeriesInstanceUID),
+                ]
+
+    # Explicitly capturing all errors here to be able to continue processing all the rest
+    except:
+        print(f"Unable to read: {file_path}")
+
+    return dfields
+
+def list_files_with_stats(in_dir: str) -> pd.DataFrame:
+    """
+    Returns all files in a folder (recursively) with their size and mtime
     """
-    # Sort dicom files and detect series
     list_files = []
     for root, _, files in os.walk(in_dir):
-        for dicom_file in files:
-            list_files.append(os.path.join(root, dicom_file))
-    list_dfields = []
-    for _, file_path in stqdm(
-        enumerate(list_files),
-        desc="Detecting series in dicom files ...",
-        total=len(list_files),
-    ):
-        # noinspection PyBroadException
-        dfields = []
+        for fname in files:
+            file_path = os.path.join(root, fname)
+            try:
+                fstat = os.stat(file_path)
+            except OSError:
+                continue
+            list_files.append([file_path, fstat.st_size, fstat.st_mtime_ns])
+    df_files = pd.DataFrame(data=list_files, columns=["fname", "size", "mtime"])
+    return df_files.astype({"size": "int64", "mtime": "int64"})
+
+def get_num_workers(num_workers: Any = None) -> int:
+    """
+    Returns the number of worker processes (by default the number of cpus,
+    up to DICOM_MAX_WORKERS)
+    """
+    if num_workers is None:
+        num_workers = min(os.cpu_count() or 1, DICOM_MAX_WORKERS)
+    return max(int(num_workers), 1)
+
+def get_index_file(in_dir: str) -> str:
+    """
+    Returns the name of the index file of a dicom folder
+    """
+    key = hashlib.sha256(os.path.abspath(in_dir).encode()).hexdigest()
+    return os.path.join(DICOM_INDEX_DIR, f"{key}.parquet")
+
+def update_dicom_index(in_dir: str, num_workers: Any = None) -> pd.DataFrame:
+    """
+    Returns an index of all files in the dicom folder, with their size, mtime
+    and header fields (None for files that are not imaging dicoms)
+    The index is saved in DICOM_INDEX_DIR (the dicom folder is not modified);
+    headers are read again only for new or modified files, using a pool of
+    num_workers processes.
+    """
+    f_index = get_index_file(in_dir)
+    df_files = list_files_with_stats(in_dir)
+
+    # Reuse index entries of unchanged files
+    df_old = pd.DataFrame(columns=["fname", "size", "mtime", "flag_read"] + index_fields)
+    if os.path.exists(f_index):
         try:
-            if common.is_dicom_file(file_path):
-                # read only dicom header without pixel data
-                dicom_headers = dcmread(
-                    file_path,
-                    defer_size="1 KB",
-                    stop_before_pixels=True,
-                    force=dicom2nifti.settings.pydicom_read_force,
+            df_old = pd.read_parquet(f_index)
+            df_old["flag_read"] = True
+        except Exception:
+            print(f"Unable to read dicom index: {f_index}")
+    df_index = df_files.merge(
+        df_old.astype({"size": "int64", "mtime": "int64"}),
+        on=["fname", "size", "mtime"],
+        how="left",
+    )
+    flag_new = df_index.flag_read.isna().values
+    list_new = df_index.fname[flag_new].tolist()
+    print(f"Dicom index: {len(df_index) - len(list_new)} files indexed, {len(list_new)} new")
+
+    # Read headers of new files
+    list_dfields = []
+    if len(list_new) > 0:
+        num_workers = get_num_workers(num_workers)
+        if num_workers <= 1 or len(list_new) < 100:
+            list_out = map(read_dicom_fields, list_new)
+            list_dfields = list(
+                stqdm(list_out, desc="Detecting series in dicom files ...", total=len(list_new))
+            )
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                list_out = executor.map(read_dicom_fields, list_new, chunksize=64)
+                list_dfields = list(
+                    stqdm(list_out, desc="Detecting series in dicom files ...", total=len(list_new))
                 )
-                if _is_valid_imaging_dicom(dicom_headers):
-                    dfields = [
-                        file_path,
-                        dicom_headers.PatientID,
-                        dicom_headers.StudyDate,
-                        dicom_headers.SeriesDescription,
-                    ]
-            list_dfields.append(dfields)
-
-        # Explicitly capturing all errors here to be able to continue processing all the rest
-        except:
-            print(f"Unable to read: {file_path}")
+        df_index.loc[flag_new, index_fields] = pd.DataFrame(
+            data=list_dfields, columns=index_fields
+        ).values
+    df_index = df_index.drop(columns=["flag_read"])
+
+    # Save index (to a temp file first, so that readers never see a partial file)
+    if len(list_new) > 0 or len(df_index) != len(df_old):
+        f_tmp = f"{f_index}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(DICOM_INDEX_DIR, exist_ok=True)
+            df_index.to_parquet(f_tmp, index=False)
+            os.replace(f_tmp, f_index)
+        except Exception:
+            print(f"Unable to write dicom index: {f_index}")
+            if os.path.exists(f_tmp):
+                os.remove(f_tmp)
+
+    return df_index
+
+def detect_series(in_dir: str, num_workers: Any = None) -> Any:
+    """
+    This function selects dicom files that match the selection keywords
+    Selection is done using the "SeriesDescription"
+    """
+    # Detect series using the index of the dicom folder
+    df_index = update_dicom_index(in_dir, num_workers)
+    df_dicoms = df_index.dropna(subset=["SeriesInstanceUID"])
 
     # Create dataframe with file name and dicom series description
-    df_dicoms = pd.DataFrame(
-        data=list_dfields, columns=["fname", "PatientID", "StudyDate", "SeriesDesc"]
-    )
+    df_dicoms = df_dicoms[["fname"] + index_fields].reset_index(drop=True)
 
     return df_dicoms
 
@@ -141,86 +258,124 @@ def select_series(df_dicoms: pd.DataFrame, dict_series: pd.Series) -> Any:
     # Return selected files, series descriptions, and all series in the folder
     return df_sel_list, dict_out
 
-def convert_single_series(
-    list_files: list,
-    out_dir: str,
-    out_suff: str,
-    compression: bool = True,
-    reorient: bool = True,
-) -> None:
+def get_nifti_name(patient_id: Any, study_date: Any, series_uid: str) -> str:
     """
-    This function will extract dicom files given in the list to nifti
+    Returns the base name of the nifti image for a dicom series
     """
-    # Sort dicom files by series uid
-    dicom_series = {}  # type: ignore
-    for file_path in list_files:
-        try:
+    # FIXME: Check also "AcquisitionDate"
+    if pd.isna(patient_id) or pd.isna(study_date):
+        return _remove_accents_(series_uid)
+    return _remove_accents_(f"{patient_id}_{study_date}")
+
+def convert_series_files(
+    list_files: list, nifti_file: str, reorient: bool = True
+) -> list:
+    """
+    Converts the dicom files of a single series to a nifti image
+    Returns the status and an error message (empty if successful)
+    """
+    try:
+        dicom_input = []
+        for file_path in list_files:
             dicom_headers = dcmread(
                 file_path,
                 defer_size="1 KB",
                 stop_before_pixels=False,
                 force=dicom2nifti.settings.pydicom_read_force,
             )
-            if not _is_valid_imaging_dicom(dicom_headers):
-                print(f"Skipping: {file_path}")
-                continue
-            print(f"Organizing: {file_path}")
-            if dicom_headers.SeriesInstanceUID not in dicom_series:
-                dicom_series[dicom_headers.SeriesInstanceUID] = []
-            dicom_series[dicom_headers.SeriesInstanceUID].append(dicom_headers)
-        except:  # Explicitly capturing all errors here to be able to continue processing all the rest
-            print("Unable to read: %s" % file_path)
-
-    # Start converting one by one
-    for series_id, dicom_input in stqdm(
-        dicom_series.items(), desc="    Converting scans...", total=len(dicom_series)
-    ):
-        base_filename = ""
-        try:
-            # construct the filename for the nifti
-            base_filename = ""
-            if "PatientID" in dicom_input[0]:
-                base_filename = _remove_accents("%s" % dicom_input[0].PatientID)
-
-            # FIXME: Check also "AcquisitionDate"
-            if "StudyDate" in dicom_input[0]:
-                base_filename = _remove_accents(
-                    f"{base_filename}_{dicom_input[0].StudyDate}"
+            if _is_valid_imaging_dicom(dicom_headers):
+                dicom_input.append(dicom_headers)
+        if len(dicom_input) == 0:
+            return ["Failed", "No valid imaging dicoms"]
+        convert_dicom.dicom_array_to_nifti(dicom_input, nifti_file, reorient)
+    # Explicitly capturing all errors here to be able to continue processing all the rest
+    except Exception as e:
+        return ["Failed", f"{type(e).__name__}: {e}"]
+    return ["Success", ""]
+
+def convert_series(
+    df_dicoms: pd.DataFrame,
+    out_dir: str,
+    out_suff: str,
+    reorient: bool = True,
+    num_workers: Any = None,
+) -> pd.DataFrame:
+    """
+    Converts each dicom series in the index (grouped by SeriesInstanceUID) to a
+    nifti image, using a pool of num_workers processes
+    Returns a table with the output file and conversion status of each series
+    """
+    # Group files by series (headers are not read again)
+    df_series = (
+        df_dicoms.dropna(subset=["SeriesInstanceUID"])
+        .groupby("SeriesInstanceUID", sort=False)
+        .agg(
+            PatientID=("PatientID", "first"),
+            StudyDate=("StudyDate", "first"),
+            SeriesDesc=("SeriesDesc", "first"),
+            NumFiles=("fname", "size"),
+            list_files=("fname", list),
+        )
+        .reset_index()
+    )
+    df_series["nifti_file"] = [
+        os.path.join(out_dir, get_nifti_name(pid, sdate, suid) + out_suff)
+        for pid, sdate, suid in df_series[
+            ["PatientID", "StudyDate", "SeriesInstanceUID"]
+        ].values
+    ]
+    df_series["Status"] = ""
+    df_series["Message"] = ""
+
+    # Series with the same output name would overwrite each other; keep the first one
+    flag_dup = df_series.nifti_file.duplicated().values
+    df_series.loc[flag_dup, "Status"] = "Skipped"
+    df_series.loc[flag_dup, "Message"] = "Duplicate output name"
+
+    # Convert series in parallel
+    list_ind = df_series.index[~flag_dup].tolist()
+    if len(list_ind) > 0:
+        num_workers = min(get_num_workers(num_workers), len(list_ind))
+        list_args = [
+            df_series.loc[list_ind, "list_files"].tolist(),
+            df_series.loc[list_ind, "nifti_file"].tolist(),
+            [reorient] * len(list_ind),
+        ]
+        if num_workers <= 1:
+            list_out = map(convert_series_files, *list_args)
+            list_res = list(
+                stqdm(list_out, desc="Converting scans ...", total=len(list_ind))
+            )
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                list_out = executor.map(convert_series_files, *list_args)
+                list_res = list(
+                    stqdm(list_out, desc="Converting scans ...", total=len(list_ind))
                 )
+        df_series.loc[list_ind, ["Status", "Message"]] = list_res
 
-            # if 'SeriesDescription' in dicom_input[0]:
-            # base_filename = _remove_accents(f'{base_filename}_{dicom_input[0].SeriesDescription}')
-
-            else:
-                base_filename = _remove_accents(dicom_input[0].SeriesInstanceUID)
-
-            print("--------------------------------------------")
-            print(f"Start converting {base_filename}")
-            if compression:
-                nifti_file = os.path.join(out_dir, base_filename + out_suff)
-            else:
-                nifti_file = os.path.join(out_dir, base_filename + out_suff)
-            convert_dicom.dicom_array_to_nifti(dicom_input, nifti_file, reorient)
-            gc.collect()
-        except:  # Explicitly capturing app exceptions here to be able to continue processing
-            print(f"Unable to convert: {base_filename}")
-            traceback.print_exc()
+    for nifti_file, status, msg in df_series[["nifti_file", "Status", "Message"]].values:
+        if status != "Success":
+            print(f"Unable to convert: {nifti_file} ({msg})")
 
+    return df_series.drop(columns=["list_files"])
 
 def convert_sel_series(
-    df_dicoms: pd.DataFrame, sel_series: pd.Series, out_dir: str, out_suff: str
-) -> None:
-    # Convert all images for each selected series
-    for _, stmp in stqdm(
-        enumerate(sel_series), desc="Sorting series...", total=len(sel_series)
-    ):
-        print(f"Converting series: {stmp}")
-        list_files = df_dicoms[df_dicoms.SeriesDesc == stmp].fname.tolist()
-        print(list_files)
-
-        convert_single_series(
-            list_files, out_dir, out_suff, compression=True, reorient=True
-        )
+    df_dicoms: pd.DataFrame,
+    sel_series: pd.Series,
+    out_dir: str,
+    out_suff: str,
+    num_workers: Any = None,
+) -> pd.DataFrame:
+    """
+    Converts all dicom series with the selected series descriptions
+    """
+    df_sel = df_dicoms[df_dicoms.SeriesDesc.isin(sel_series)]
+    print(f"Converting series: {list(sel_series)}")
+
+    return convert_series(
+        df_sel, out_dir, out_suff, reorient=True, num_workers=num_workers
+    )
 
 def panel_detect_dicom_series() -> None:
     """
@@ -304,19 +459,23 @@ def panel_extract_dicoms() -> None:
             btn_convert = st.button("Convert Series")
             if btn_convert:
                 with st.spinner("Wait for it..."):
-                    try:
-                        utildcm.convert_sel_series(
-                            st.session_state.df_dicoms,
-                            st.session_state.sel_series,
-                            out_folder,
-                            f"_{sel_mod}.nii.gz",
-                        )
-
-                    except:
-                        st.warning(":material/thumb_down: NIfTI conversion failed!")
-
-                time.sleep(1)
-                st.rerun()
+                    df_conv = utildcm.convert_sel_series(
+                        st.session_state.df_dicoms,
+                        st.session_state.sel_series,
+                        out_folder,
+                        f"_{sel_mod}.nii.gz",
+                    )
+
+                # Show the status of each series (failed series are kept on screen)
+                st.dataframe(df_conv[["SeriesDesc", "nifti_file", "Status", "Message"]])
+                num_fail = (df_conv.Status != "Success").sum()
+                if num_fail > 0:
+                    st.warning(
+                        f":material/thumb_down: NIfTI conversion failed for {num_fail} of {df_conv.shape[0]} series!"
+                    )
+                else:
+                    time.sleep(1)
+                    st.rerun()
 
         #utilst.util_help_dialog(
             #utildoc.title_dicoms_extract, utildoc.def_dicoms_extract
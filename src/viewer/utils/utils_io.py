@@ -7,6 +7,7 @@ from typing import Any, BinaryIO, List, Optional
 import streamlit as st
 import time
 
+import numpy as np
 import pandas as pd
 
 # https://stackoverflow.com/questions/64719918/how-to-write-streamlit-uploadedfile-to-temporary-in_dir-with-original-filenam
@@ -428,3 +429,61 @@ def get_image_path(
             if f.startswith(file_pref) and f.endswith(tmp_suff):
                 return os.path.join(folder_path, f)
     return ""
+
+def get_table_file(fname: str) -> str:
+    '''
+    Returns the columnar copy (.parquet or .feather) of a csv file if it exists
+    and is up to date, or the input file name
+    '''
+    if not fname.endswith('.csv') or not os.path.exists(fname):
+        return fname
+    for tmp_suff in ['.parquet', '.feather']:
+        f_tmp = fname[:-4] + tmp_suff
+        if os.path.exists(f_tmp) and os.path.getmtime(f_tmp) >= os.path.getmtime(fname):
+            return f_tmp
+    return fname
+
+def read_table(fname: str) -> pd.DataFrame:
+    '''
+    Reads a csv file, or its columnar copy if available
+    '''
+    fname = get_table_file(fname)
+    if fname.endswith('.parquet'):
+        return pd.read_parquet(fname)
+    if fname.endswith('.feather'):
+        return pd.read_feather(fname)
+    return pd.read_csv(fname)
+
+def compact_table(df: pd.DataFrame, id_cols: tuple = ('MRID',)) -> pd.DataFrame:
+    '''
+    Returns a compact, read-only copy of a table
+    Float columns (ROI values, scores) are converted to float32 and text columns
+    with repeated values to categoricals; id, integer and bool columns are not
+    converted, so that codes and labels keep their values. Column arrays are set
+    read-only, so that the table can be shared (writes raise an error)
+    '''
+    dict_cols = {}
+    for col in df.columns:
+        vals = df[col]
+        if pd.api.types.is_float_dtype(vals) and col not in id_cols:
+            arr = vals.to_numpy(dtype=np.float32)
+        elif col in id_cols or pd.api.types.is_numeric_dtype(vals):
+            arr = vals.to_numpy()
+        elif vals.nunique() <= vals.shape[0] / 2:
+            arr = pd.Categorical(vals)
+        else:
+            arr = vals.to_numpy()
+        if isinstance(arr, np.ndarray):
+            arr.flags.writeable = False
+        dict_cols[col] = arr
+    return pd.DataFrame(dict_cols, copy=False)
+
+def write_table_copy(df: pd.DataFrame, fname: str, out_format: str = 'parquet') -> None:
+    '''
+    Writes a columnar copy (.parquet or .feather) of the data next to a csv file
+    '''
+    f_out = fname[:-4] + f'.{out_format}'
+    if out_format == 'parquet':
+        df.to_parquet(f_out, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(f_out)
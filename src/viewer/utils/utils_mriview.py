@@ -5,12 +5,12 @@ from typing import Any
 
 import pandas as pd
 import numpy as np
-import nibabel as nib
-from nibabel.orientations import axcodes2ornt, ornt_transform
-from scipy import ndimage
 import utils.utils_plots as utilpl
 import utils.utils_misc as utilmisc
 import utils.utils_user_select as utiluser
+import utils.utils_cache as utilcache
+import utils.utils_nifti as utilni
+import utils.utils_tiles as utiltiles
 
 import streamlit_antd_components as sac
 
@@ -24,39 +24,22 @@ MASK_COLOR = (0, 255, 0)  # RGB format
 MASK_COLOR = np.array([0.0, 1.0, 0.0])  # RGB format
 OLAY_ALPHA = 0.2
 
-def reorient_nifti(nii_in: Any, ref_orient: str = "LPS") -> Any:
+def get_crop_box(img_fg: np.ndarray) -> Any:
     """
-    Initial img is reoriented to a standard orientation
+    Detect the bounding box of the foreground, extended to equal size in all dimensions
+    Returns the box start and end in the image, and the padding needed before and after
     """
 
-    # Find transform from current (approximate) orientation to
-    # target, in nibabel orientation matrix and affine forms
-    orient_in = nib.io_orientation(nii_in.affine)
-    orient_out = axcodes2ornt(ref_orient)
-    transform = ornt_transform(orient_in, orient_out)
-
-    # Apply transform
-    nii_reorient = nii_in.as_reoriented(transform)
-
-    # Return reoriented image
-    return nii_reorient
-
-def crop_image(img: np.ndarray, mask: np.ndarray, crop_to_mask: bool) -> Any:
-    """
-    Crop img to the foreground of the mask
-    """
-
-    # Detect bounding box
-    if crop_to_mask:
-        nz = np.nonzero(mask)
-    else:
-        nz = np.nonzero(img)
-
-    mn = np.min(nz, axis=1)
-    mx = np.max(nz, axis=1)
+    # Detect bounding box (using projections on each axis)
+    mn = np.zeros(3).astype(int)
+    mx = np.zeros(3).astype(int)
+    for i, axis in enumerate(VIEW_AXES):
+        slices_nz = np.flatnonzero(np.any(img_fg, axis=VIEW_OTHER_AXES[i]))
+        mn[i] = slices_nz[0]
+        mx[i] = slices_nz[-1]
 
     # Calculate crop to make all dimensions equal size
-    mask_sz = mask.shape
+    mask_sz = img_fg.shape
     crop_sz = mx - mn
     new_sz = max(crop_sz)
     pad_val = (new_sz - crop_sz) // 2
@@ -70,36 +53,73 @@ def crop_image(img: np.ndarray, mask: np.ndarray, crop_to_mask: bool) -> Any:
     pad1 = list(np.max([min2 - min1, [0, 0, 0]], axis=0))
     pad2 = list(np.max([max1 - max2, [0, 0, 0]], axis=0))
 
+    return min2, max2, pad1, pad2
+
+def apply_crop_box(img: np.ndarray, crop_box: Any, pad: bool = True) -> np.ndarray:
+    """
+    Crop and pad img using the crop box
+    If pad is False, the image is only cropped (see get_crop_padding)
+    """
+    min2, max2, pad1, pad2 = crop_box
+
     # Crop image
     img = img[min2[0] : max2[0], min2[1] : max2[1], min2[2] : max2[2]]
-    mask = mask[min2[0] : max2[0], min2[1] : max2[1], min2[2] : max2[2]]
 
     # Pad image
-    padding = np.array([pad1, pad2]).T
+    padding = get_crop_padding(crop_box)
 
-    if padding.sum() > 0:
+    if pad and padding.sum() > 0:
         img = np.pad(img, padding, mode="constant", constant_values=0)
-        mask = np.pad(mask, padding, mode="constant", constant_values=0)
 
-    return img, mask
+    return img
 
-def detect_mask_bounds(mask: Any) -> Any:
+def get_crop_padding(crop_box: Any) -> np.ndarray:
     """
-    Detect the mask start, end and center in each view
-    Used later to set the slider in the image viewer
+    Return the padding (before and after) of each axis in the crop box
     """
-    mask_bounds = np.zeros([3, 3]).astype(int)
+    return np.array([crop_box[2], crop_box[3]]).T
+
+def crop_slice_maps(slice_maps: list, crop_box: Any) -> list:
+    """
+    Crop and pad slice maps using the crop box (padded slices are set to -1)
+    """
+    min2, max2, pad1, pad2 = crop_box
+    out_maps = []
+    for i, (src_axis, slice_ind) in enumerate(slice_maps):
+        slice_ind = np.concatenate(
+            [
+                np.full(pad1[i], -1),
+                slice_ind[min2[i] : max2[i]],
+                np.full(pad2[i], -1),
+            ]
+        )
+        out_maps.append([src_axis, slice_ind])
+
+    return out_maps
+
+def detect_roi_bounds(label_index: dict, slice_maps: list, list_rois: list) -> np.ndarray:
+    """
+    Detect the roi start, end and center in each view
+    The voxel counts of roi labels in each slice are read from the label index
+    (instead of scanning the full mask)
+    """
+    is_roi = np.isin(label_index["labels"], list_rois)
+    roi_bounds = np.zeros([3, 3]).astype(int)
     for i, axis in enumerate(VIEW_AXES):
-        mask_bounds[i, 0] = 0
-        mask_bounds[i, 1] = mask.shape[i]
-        slices_nz = np.where(np.sum(mask, axis=VIEW_OTHER_AXES[i]) > 0)[0]
-        try:
-            mask_bounds[i, 2] = slices_nz[len(slices_nz) // 2]
-        except:
-            # Could not detect masked region. Set center to image center
-            mask_bounds[i, 2] = mask.shape[i] // 2
+        src_axis, slice_ind = slice_maps[i]
+        roi_prof = label_index[f"prof{src_axis}"][:, is_roi].sum(axis=1)
+        roi_prof = np.where(slice_ind >= 0, roi_prof[slice_ind], 0)
+
+        roi_bounds[i, 0] = 0
+        roi_bounds[i, 1] = len(slice_ind)
+        slices_nz = np.flatnonzero(roi_prof)
+        if len(slices_nz) > 0:
+            roi_bounds[i, 2] = slices_nz[len(slices_nz) // 2]
+        else:
+            # Could not detect roi. Set center to image center
+            roi_bounds[i, 2] = len(slice_ind) // 2
 
-    return mask_bounds
+    return roi_bounds
 
 def detect_img_bounds(img: np.ndarray) -> np.ndarray:
     """
@@ -115,90 +135,172 @@ def detect_img_bounds(img: np.ndarray) -> np.ndarray:
 
     return img_bounds
 
-@st.cache_data(max_entries=1)  # type:ignore
-def prep_image_and_olay(f_img: np.ndarray, f_mask: Any, list_rois: list, crop_to_mask: bool) -> Any:
+def prep_image_and_labels(f_img: str, f_mask: str, crop_to_mask: bool) -> Any:
     """
-    Read images from files and create 3D matrices for display
+    Read image and segmentation from files and create compact 3D matrices for display
+    The image is kept as uint8 and the segmentation as a label matrix
+    (RGB slices with the overlay are created on demand by get_slice_rgb)
+    Matrices are cropped but not padded; the padding is applied to slices
+    Slice maps link display slices to slices of the segmentation (and its label index)
     """
-
-    print(f_img)
-    print(f_mask)
-    print(list_rois)
-
     # Read nifti
-    nii_img = nib.load(f_img)
-    nii_mask = nib.load(f_mask)
+    nii_img = utilcache.load_nifti(f_img)
+    nii_mask = utilcache.load_nifti(f_mask)
 
-    # Reorient nifti
-    nii_img = reorient_nifti(nii_img, ref_orient="IPL")
-    nii_mask = reorient_nifti(nii_mask, ref_orient="IPL")
-
-    # Extract image to matrix
-    out_img = nii_img.get_fdata()
-    out_mask = nii_mask.get_fdata()
-
-    # Rescale image and out_mask to equal voxel size in all 3 dimensions
-    out_img = ndimage.zoom(out_img, nii_img.header.get_zooms(), order=0, mode="nearest")
-    out_mask = ndimage.zoom(
-        out_mask, nii_mask.header.get_zooms(), order=0, mode="nearest"
-    )
+    # Index maps to reorient and rescale to equal voxel size in all 3 dimensions
+    # (calculated once for each image geometry)
+    maps_img = utilni.get_resample_maps(nii_img, ref_orient="IPL")
+    maps_mask = utilni.get_resample_maps(nii_mask, ref_orient="IPL")
 
-    # Shift values in out_img to remove negative values
-    out_img = out_img - np.min([0, out_img.min()])
+    # Extract image and labels to matrix (labels are kept as integers)
+    out_img = utilni.resample_volume(nii_img.get_fdata(dtype=np.float32), maps_img)
+    out_mask = utilni.resample_volume(np.asanyarray(nii_mask.dataobj), maps_mask)
+    out_mask = out_mask.astype(np.uint16, copy=False)
 
-    # Convert image to uint
-    out_img = out_img.astype(float) / out_img.max()
+    # Convert image to uint8 (in place, to avoid float copies of the volume)
+    out_img = utilni.quantize_image(out_img)
 
-    # Crop image to ROIs and reshape
-    out_img, out_mask = crop_image(out_img, out_mask, crop_to_mask)
+    # Crop image to ROIs (padding to equal size is applied to slices)
+    if crop_to_mask:
+        crop_box = get_crop_box(out_mask)
+    else:
+        crop_box = get_crop_box(out_img)
+    out_img = apply_crop_box(out_img, crop_box, pad=False)
+    out_mask = apply_crop_box(out_mask, crop_box, pad=False)
+    padding = get_crop_padding(crop_box)
 
-    # Create mask with sel roi
-    out_mask = np.isin(out_mask, list_rois)
+    # Map slices of the display matrices to slices of the input segmentation
+    slice_maps = crop_slice_maps(maps_mask, crop_box)
 
-    # Merge image and out_mask
-    out_img = np.stack((out_img,) * 3, axis=-1)
+    return out_img, out_mask, slice_maps, padding
 
-    out_img_out_masked = out_img.copy()
-    out_img_out_masked[out_mask == 1] = (
-        # WARNING & FIXME:
-        # @spirosmaggioros: I don't think this should be like this, something is wrong here with MASK_COLOR * OLAY_ALPHA
-        out_img_out_masked[out_mask == 1] * (1 - OLAY_ALPHA)
-        + MASK_COLOR * OLAY_ALPHA  # type:ignore
+def get_image_and_labels(f_img: str, f_mask: str, crop_to_mask: bool) -> Any:
+    """
+    Return image and segmentation matrices from the volume cache (shared by sessions)
+    """
+    key = utilcache.get_file_key([f_img, f_mask]) + (crop_to_mask,)
+    return utilcache.get_volume_cache().get(
+        key, prep_image_and_labels, f_img, f_mask, crop_to_mask
     )
 
-    return out_img, out_mask, out_img_out_masked
-
-@st.cache_data  # type:ignore
-def prep_image(f_img: np.ndarray) -> np.ndarray:
+def prefetch_image_and_labels(list_files: list, crop_to_mask: bool) -> None:
     """
-    Read image from file and create 3D matrice for display
+    Load image and segmentation matrices in the background for a list of
+    (f_img, f_mask) pairs (e.g. subjects likely to be selected next)
     """
+    list_jobs = []
+    for f_img, f_mask in list_files:
+        if os.path.exists(f_img) and os.path.exists(f_mask):
+            key = utilcache.get_file_key([f_img, f_mask]) + (crop_to_mask,)
+            list_jobs.append(
+                (key, prep_image_and_labels, (f_img, f_mask, crop_to_mask))
+            )
+    utilcache.get_volume_cache().prefetch(list_jobs)
+
+def get_slice_rgb(
+    img: np.ndarray,
+    mask: Any,
+    scroll_axis: int,
+    slice_index: int,
+    list_rois: Any = None,
+    padding: Any = None,
+) -> np.ndarray:
+    """
+    Extract a single slice as an RGB uint8 image
+    Voxels with a label in list_rois are blended with the overlay color
+    If padding is given, slice_index is in padded coordinates and the slice is padded
+    """
+    other_axes = VIEW_OTHER_AXES[scroll_axis]
+    if padding is not None:
+        slice_index = slice_index - padding[scroll_axis, 0]
+
+    # Slices in the padded area are blank
+    if slice_index < 0 or slice_index >= img.shape[scroll_axis]:
+        out_slice = np.zeros(
+            [img.shape[other_axes[0]], img.shape[other_axes[1]], 3], dtype=np.uint8
+        )
+    else:
+        img_slice = np.take(img, slice_index, axis=scroll_axis)
+        out_slice = np.repeat(img_slice[:, :, np.newaxis], 3, axis=2)
 
-    # Read nifti
-    nii_img = nib.load(f_img)
-
-    # Reorient nifti
-    nii_img = reorient_nifti(nii_img, ref_orient="IPL")
-
-    # Extract image to matrix
-    out_img = nii_img.get_fdata()
-
-    # Rescale image to equal voxel size in all 3 dimensions
-    out_img = ndimage.zoom(out_img, nii_img.header.get_zooms(), order=0, mode="nearest")
+        if mask is not None and list_rois is not None:
+            mask_slice = np.isin(
+                np.take(mask, slice_index, axis=scroll_axis), list_rois
+            )
+            out_slice[mask_slice] = np.round(
+                out_slice[mask_slice] * (1 - OLAY_ALPHA)
+                + MASK_COLOR * 255 * OLAY_ALPHA  # type:ignore
+            ).astype(np.uint8)
+
+    if padding is not None and padding.sum() > 0:
+        out_slice = np.pad(
+            out_slice,
+            [padding[other_axes[0]], padding[other_axes[1]], (0, 0)],
+            mode="constant",
+            constant_values=0,
+        )
 
-    out_img = out_img.astype(float) / out_img.max()
+    return out_slice
 
-    # Pad image to equal size in x,y,z
-    out_img = pad_image(out_img)
+def get_display_shape(img: np.ndarray, padding: Any = None) -> np.ndarray:
+    """
+    Return the size of the displayed (padded) 3D matrix
+    """
+    img_shape = np.array(img.shape[:3])
+    if padding is not None:
+        img_shape += padding.sum(axis=1)
+    return img_shape
+
+def get_view_tile_key(
+    f_img: str, f_mask: str, crop_to_mask: bool, list_rois: Any = None
+) -> str:
+    """
+    Return the key of the slice tiles of a view (image, overlay rois and crop)
+    """
+    return utiltiles.get_tile_key(
+        f_img, f_mask, crop_to_mask, list_rois, MASK_COLOR, OLAY_ALPHA
+    )
 
-    # Convert image to rgb
-    out_img = np.stack((out_img,) * 3, axis=-1)
+def prerender_slice_tiles(
+    f_img: str,
+    f_mask: str,
+    crop_to_mask: bool,
+    list_overlays: list,
+    list_axes: list = VIEW_AXES,
+) -> int:
+    """
+    Write tiles of all slices to the tile cache for each overlay in list_overlays
+    (a list of roi label lists, None for the image without overlay)
+    Return the number of tiles written (tiles already in the cache are skipped)
+    """
+    img, mask, _, padding = prep_image_and_labels(f_img, f_mask, crop_to_mask)
+    img_shape = get_display_shape(img, padding)
+
+    num_tiles = 0
+    for list_rois in list_overlays:
+        tile_key = get_view_tile_key(f_img, f_mask, crop_to_mask, list_rois)
+        for scroll_axis in list_axes:
+            for slice_index in range(img_shape[scroll_axis]):
+                f_tile = utiltiles.get_tile_file(tile_key, scroll_axis, slice_index)
+                if os.path.exists(f_tile):
+                    continue
+                img_slice = get_slice_rgb(
+                    img, mask, scroll_axis, slice_index, list_rois, padding
+                )
+                utiltiles.write_tile(
+                    tile_key, scroll_axis, slice_index, utiltiles.encode_tile(img_slice)
+                )
+                num_tiles += 1
 
-    return out_img
+    return num_tiles
 
-def show_img_slices(img, scroll_axis, sel_axis_bounds, orientation, wimg = None):
+def show_img_slices(
+    img, scroll_axis, sel_axis_bounds, orientation, wimg = None, mask = None, list_rois = None,
+    tile_key = None, padding = None
+):
     """
     Display 3D mri img slice
+    If a tile key is given, the encoded slice is read from (or added to) the tile cache
     """
     # Create a slider to select the slice index
     slice_index = st.slider(
@@ -209,21 +311,15 @@ def show_img_slices(img, scroll_axis, sel_axis_bounds, orientation, wimg = None)
         key=f"slider_{orientation}",
     )
 
-    # Extract the slice and display it
+    # Extract the slice (with overlay) and display it
+    img_slice = utiltiles.get_tile(
+        tile_key, scroll_axis, slice_index,
+        get_slice_rgb, img, mask, scroll_axis, slice_index, list_rois, padding
+    )
     if wimg is None:
-        if scroll_axis == 0:
-            st.image(img[slice_index, :, :], use_container_width=True)
-        elif scroll_axis == 1:
-            st.image(img[:, slice_index, :], use_container_width=True)
-        else:
-            st.image(img[:, :, slice_index], use_container_width=True)
+        st.image(img_slice, use_container_width=True)
     else:
-        if scroll_axis == 0:
-            st.image(img[slice_index, :, :], width=w_img)
-        elif scroll_axis == 1:
-            st.image(img[:, slice_index, :], width=w_img)
-        else:
-            st.image(img[:, :, slice_index], width=w_img)
+        st.image(img_slice, width=wimg)
 
 def panel_select_var(sel_var_groups, plot_params, var_type, add_none = False):
     '''
@@ -353,10 +449,20 @@ def panel_view_seg(ulay, olay, plot_params):
     with st.container(border=True):
         with st.spinner("Wait for it..."):
             # Process image (and mask) to prepare final 3d matrix to display
-            img, mask, img_masked = prep_image_and_olay(
-                ulay, olay, plot_params['roi_indices'], plot_params['crop_to_mask']
+            img, mask, slice_maps, padding = get_image_and_labels(
+                ulay, olay, plot_params['crop_to_mask']
+            )
+            img_bounds = detect_roi_bounds(
+                utilni.get_label_index(olay), slice_maps, plot_params['roi_indices']
             )
-            img_bounds = detect_mask_bounds(mask)
+
+            # Keys of the pre-rendered slices (without and with the overlay)
+            tile_keys = [
+                get_view_tile_key(ulay, olay, plot_params['crop_to_mask']),
+                get_view_tile_key(
+                    ulay, olay, plot_params['crop_to_mask'], plot_params['roi_indices']
+                ),
+            ]
 
             cols = st.columns(len(plot_params['list_orient']))
             for i, tmp_orient in stqdm(
@@ -369,9 +475,12 @@ def panel_view_seg(ulay, olay, plot_params):
                     size_auto = True
                     if olay is None or plot_params['is_show_overlay'] is False:
                         show_img_slices(
-                            img, ind_view, img_bounds[ind_view, :], tmp_orient
+                            img, ind_view, img_bounds[ind_view, :], tmp_orient,
+                            tile_key = tile_keys[0], padding = padding
                         )
                     else:
                         show_img_slices(
-                            img_masked, ind_view, img_bounds[ind_view, :], tmp_orient
+                            img, ind_view, img_bounds[ind_view, :], tmp_orient,
+                            mask = mask, list_rois = plot_params['roi_indices'],
+                            tile_key = tile_keys[1], padding = padding
                         )
@@ -1,8 +1,12 @@
+import os
+import threading
+from functools import lru_cache
 from typing import Any
 
 import nibabel as nib
 import numpy as np
 import streamlit as st
+import utils.utils_cache as utilcache
 from nibabel.orientations import axcodes2ornt, ornt_transform
 from scipy import ndimage
 
@@ -32,6 +36,66 @@ def reorient_nifti(nii_in: Any, ref_orient: str = "LPS") -> Any:
     return nii_reorient
 
 
+@lru_cache(maxsize=32)
+def calc_resample_maps(shape_in: tuple, affine: tuple, ref_orient: str) -> tuple:
+    """
+    Calculate the index maps for an image geometry (shape and affine)
+    """
+    affine = np.array(affine).reshape(4, 4)
+    transform = ornt_transform(nib.io_orientation(affine), axcodes2ornt(ref_orient))
+    zooms = nib.affines.voxel_sizes(affine)
+
+    resample_maps = [None, None, None]
+    for i in VIEW_AXES:
+        j = int(transform[i, 0])
+        ind = np.arange(shape_in[i])
+        if transform[i, 1] == -1:
+            ind = ind[::-1]
+        ind = ndimage.zoom(ind, zooms[i], order=0, mode="nearest")
+        ind.flags.writeable = False
+        resample_maps[j] = (i, ind)
+
+    return tuple(resample_maps)
+
+
+def get_resample_maps(nii_in: Any, ref_orient: str = "IPL") -> tuple:
+    """
+    Return the nearest neighbor index maps that reorient an image and rescale it
+    to equal voxel size in all 3 dimensions
+    For each output axis: (input axis, input index of each output slice)
+    Maps are calculated once for each image geometry
+    """
+    return calc_resample_maps(
+        tuple(nii_in.shape[:3]),
+        tuple(np.asarray(nii_in.affine, dtype=float).ravel().tolist()),
+        ref_orient,
+    )
+
+
+def resample_volume(data: np.ndarray, resample_maps: tuple) -> np.ndarray:
+    """
+    Reorient and rescale a volume using index maps
+    Voxel values are copied (labels stay integers, the data type is kept)
+    """
+    out = data.transpose([x[0] for x in resample_maps])
+    is_copy = False
+    for j, (_, ind) in enumerate(resample_maps):
+        # Axes that are only flipped are not copied
+        ind_in = np.arange(out.shape[j])
+        if np.array_equal(ind, ind_in):
+            continue
+        if np.array_equal(ind, ind_in[::-1]):
+            out = np.flip(out, axis=j)
+            continue
+        out = out.take(ind, axis=j)
+        is_copy = True
+
+    if not is_copy or not out.flags.c_contiguous:
+        out = np.array(out, order="C")
+
+    return out
+
+
 def crop_image(img: np.ndarray, mask: np.ndarray, crop_to_mask: bool) -> Any:
     """
     Crop img to the foreground of the mask
@@ -79,25 +143,37 @@ def pad_image(img: np.ndarray) -> np.ndarray:
     """
     Pad img to equal x,y,z
     """
+    # Calculate padding values to make dims equal
+    padding = get_pad_vals(img.shape)
 
-    # Detect max size
-    simg = img.shape
-    mx = np.max(simg)
+    # Create padded image (with the same data type)
+    return np.pad(img, padding, mode="constant", constant_values=0)
 
-    # Calculate padding values to make dims equal
-    pad_vals = (mx - np.array(simg)) // 2
 
-    # Create padded image
-    out_img = np.zeros([mx, mx, mx])
+def get_pad_vals(shape: Any) -> np.ndarray:
+    """
+    Return the padding (before and after) of each axis to make dims equal
+    Used to pad slices at display time instead of padding the 3D matrix
+    """
+    shape = np.array(shape[:3])
+    pad_size = np.max(shape) - shape
+    return np.array([pad_size // 2, pad_size - pad_size // 2]).T
 
-    # Insert image inside the padded image
-    out_img[
-        pad_vals[0] : pad_vals[0] + simg[0],
-        pad_vals[1] : pad_vals[1] + simg[1],
-        pad_vals[2] : pad_vals[2] + simg[2],
-    ] = img
 
-    return out_img
+def quantize_image(img: np.ndarray) -> np.ndarray:
+    """
+    Scale image intensities to 0-255 and convert to uint8
+    The float input image is modified in place (to avoid copies of the volume)
+    """
+    # Shift values to remove negative values
+    img -= np.min([0, img.min()])
+
+    # Scale to 0-255
+    img_max = img.max()
+    if img_max > 0:
+        img *= 255 / img_max
+
+    return np.round(img, out=img).astype(np.uint8)
 
 
 def detect_mask_bounds(mask: Any) -> Any:
@@ -119,17 +195,20 @@ def detect_mask_bounds(mask: Any) -> Any:
     return mask_bounds
 
 
-def detect_img_bounds(img: np.ndarray) -> np.ndarray:
+def detect_img_bounds(img: np.ndarray, padding: Any = None) -> np.ndarray:
     """
     Detect the img start, end and center in each view
     Used later to set the slider in the image viewer
     """
+    img_shape = np.array(img.shape[:3])
+    if padding is not None:
+        img_shape += padding.sum(axis=1)
 
     img_bounds = np.zeros([3, 3]).astype(int)
     for i, axis in enumerate(VIEW_AXES):
         img_bounds[i, 0] = 0
-        img_bounds[i, 1] = img.shape[i]
-        img_bounds[i, 2] = img.shape[i] // 2
+        img_bounds[i, 1] = img_shape[i]
+        img_bounds[i, 2] = img_shape[i] // 2
 
     return img_bounds
 
@@ -143,22 +222,12 @@ def prep_image_and_olay(
     """
 
     # Read nifti
-    nii_img = nib.load(f_img)
-    nii_mask = nib.load(f_mask)
-
-    # Reorient nifti
-    nii_img = reorient_nifti(nii_img, ref_orient="IPL")
-    nii_mask = reorient_nifti(nii_mask, ref_orient="IPL")
+    nii_img = utilcache.load_nifti(f_img)
+    nii_mask = utilcache.load_nifti(f_mask)
 
-    # Extract image to matrix
-    out_img = nii_img.get_fdata()
-    out_mask = nii_mask.get_fdata()
-
-    # Rescale image and out_mask to equal voxel size in all 3 dimensions
-    out_img = ndimage.zoom(out_img, nii_img.header.get_zooms(), order=0, mode="nearest")
-    out_mask = ndimage.zoom(
-        out_mask, nii_mask.header.get_zooms(), order=0, mode="nearest"
-    )
+    # Reorient and rescale image and out_mask to equal voxel size in all 3 dimensions
+    out_img = resample_volume(nii_img.get_fdata(), get_resample_maps(nii_img))
+    out_mask = resample_volume(nii_mask.get_fdata(), get_resample_maps(nii_mask))
 
     # Shift values in out_img to remove negative values
     out_img = out_img - np.min([0, out_img.min()])
@@ -187,32 +256,119 @@ def prep_image_and_olay(
 
 
 @st.cache_data  # type:ignore
-def prep_image(f_img: np.ndarray) -> np.ndarray:
+def prep_image(f_img: str) -> Any:
     """
-    Read image from file and create 3D matrice for display
+    Read image from file and create a compact 3D matrix for display
+    The image is kept as uint8 and is not padded (returns the image and the
+    padding that makes dims equal, applied to slices at display time)
     """
 
     # Read nifti
-    nii_img = nib.load(f_img)
+    nii_img = utilcache.load_nifti(f_img)
 
-    # Reorient nifti
-    nii_img = reorient_nifti(nii_img, ref_orient="IPL")
+    # Reorient and rescale image to equal voxel size in all 3 dimensions
+    out_img = resample_volume(
+        nii_img.get_fdata(dtype=np.float32), get_resample_maps(nii_img)
+    )
 
-    # Extract image to matrix
-    out_img = nii_img.get_fdata()
+    # Convert image to uint8
+    out_img = quantize_image(out_img)
 
-    # Rescale image to equal voxel size in all 3 dimensions
-    out_img = ndimage.zoom(out_img, nii_img.header.get_zooms(), order=0, mode="nearest")
+    return out_img, get_pad_vals(out_img.shape)
 
-    out_img = out_img.astype(float) / out_img.max()
 
-    # Pad image to equal size in x,y,z
-    out_img = pad_image(out_img)
+def calc_label_index(labels: np.ndarray) -> dict:
+    """
+    Calculate the label index of a segmentation in a single pass over axial slices:
+    labels present, and for each label the voxel count, bounding box, centroid
+    and the voxel count in each slice along each axis (profiles)
+    """
+    num_lbl = int(labels.max()) + 1
+    prof = [np.zeros([labels.shape[i], num_lbl], dtype=np.int64) for i in VIEW_AXES]
+    ind1 = np.arange(labels.shape[1])[:, np.newaxis] * num_lbl
+    ind2 = np.arange(labels.shape[2])[np.newaxis, :] * num_lbl
+    for k in range(labels.shape[0]):
+        lbl_slice = labels[k].astype(np.int64)
+        prof[0][k] = np.bincount(lbl_slice.ravel(), minlength=num_lbl)
+        prof[1] += np.bincount(
+            (lbl_slice + ind1).ravel(), minlength=prof[1].size
+        ).reshape(prof[1].shape)
+        prof[2] += np.bincount(
+            (lbl_slice + ind2).ravel(), minlength=prof[2].size
+        ).reshape(prof[2].shape)
+
+    # Keep labels present in the image (excluding background)
+    counts = prof[0].sum(axis=0)
+    list_lbl = np.flatnonzero(counts[1:]) + 1
+    prof = [x[:, list_lbl].astype(np.int32) for x in prof]
+    counts = counts[list_lbl]
+
+    bbox = np.zeros([len(list_lbl), 3, 2], dtype=int)
+    centroid = np.zeros([len(list_lbl), 3])
+    for i in VIEW_AXES:
+        is_nz = prof[i] > 0
+        bbox[:, i, 0] = np.argmax(is_nz, axis=0)
+        bbox[:, i, 1] = prof[i].shape[0] - 1 - np.argmax(is_nz[::-1], axis=0)
+        centroid[:, i] = np.arange(prof[i].shape[0]) @ prof[i] / counts
+
+    return {
+        "labels": list_lbl,
+        "counts": counts,
+        "bbox": bbox,
+        "centroid": centroid,
+        "prof0": prof[0],
+        "prof1": prof[1],
+        "prof2": prof[2],
+    }
+
+
+def get_label_index_file(f_seg: str) -> str:
+    """
+    Return the name of the label index file (saved next to the segmentation)
+    """
+    return os.path.join(
+        os.path.dirname(f_seg), f".{os.path.basename(f_seg)}.labels.npz"
+    )
+
 
-    # Convert image to rgb
-    out_img = np.stack((out_img,) * 3, axis=-1)
+def get_label_index(f_seg: str) -> dict:
+    """
+    Return the label index of a segmentation image
+    The index is saved next to the image and calculated again only if the
+    image changes
+    """
+    fstat = os.stat(f_seg)
+    src_info = np.array([fstat.st_size, fstat.st_mtime_ns])
 
-    return out_img
+    # Read saved index
+    f_index = get_label_index_file(f_seg)
+    if os.path.exists(f_index):
+        try:
+            with np.load(f_index) as data:
+                if np.array_equal(data["src_info"], src_info):
+                    return {k: data[k] for k in data.files if k != "src_info"}
+        except Exception:
+            print(f"Unable to read label index: {f_index}")
+
+    # Calculate index
+    nii_seg = utilcache.load_nifti(f_seg)
+    labels = np.asanyarray(nii_seg.dataobj).astype(np.uint16)
+    label_index = calc_label_index(labels)
+
+    # Save index (to a temp file first, so that readers never see a partial file)
+    f_tmp = f"{f_index}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(f_tmp, "wb") as f:
+            np.savez(f, src_info=src_info, **label_index)
+        os.replace(f_tmp, f_index)
+    except Exception:
+        print(f"Unable to write label index: {f_index}")
+        try:
+            os.remove(f_tmp)
+        except OSError:
+            pass
+
+    return label_index
 
 
 def check_roi_index(f_img: str, roi_ind: int) -> bool:
@@ -220,14 +376,8 @@ def check_roi_index(f_img: str, roi_ind: int) -> bool:
     Check if index is one of the labels in the seg img
     """
     try:
-        # Read nifti
-        nii_img = nib.load(f_img)
-
-        # Extract image to matrix
-        out_img = nii_img.get_fdata().flatten()
-
         # Get labels
-        list_lbl = np.unique(out_img)
+        list_lbl = get_label_index(f_img)["labels"]
 
         return roi_ind in list_lbl
 
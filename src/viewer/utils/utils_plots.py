@@ -1,15 +1,18 @@
 import os
 import shutil
+import time
 from typing import Any, Optional
 
 import pandas as pd
 import numpy as np
 import streamlit as st
+import utils.utils_cache as utilcache
 import utils.utils_io as utilio
 import utils.utils_user_select as utiluser
 import utils.utils_session as utilses
 import utils.utils_misc as utilmisc
 import utils.utils_mriview as utilmri
+import utils.utils_stats as utilstat
 
 import plotly.graph_objs as go
 import plotly.figure_factory as ff
@@ -23,16 +26,40 @@ pd.set_option('display.max_colwidth', None)  # or use a large number like 500
 
 def read_data(fdata):
     '''
-    Read data file and add column for hue
+    Read data file, add column for hue and convert it to a compact, read-only
+    table (see utilio.compact_table)
+    Returns the table and its load info
     '''
-    # Read data file
-    df = pd.read_csv(fdata)
+    t_start = time.perf_counter()
+
+    # Read data file (or its columnar copy)
+    df = utilio.read_table(fdata)
     
     # Add column to handle hue var = None
     if 'grouping_var' not in df:
         df["grouping_var"] = "Data"
-    
-    return df
+
+    df = utilio.compact_table(df)
+    info = {
+        'file': fdata,
+        'num_rows': df.shape[0],
+        'num_cols': df.shape[1],
+        'size_mb': round(utilcache.get_nbytes(df) / 1e6, 2),
+        'load_time': round(time.perf_counter() - t_start, 3),
+    }
+    return {'df': df, 'info': info}
+
+def load_data(fdata):
+    '''
+    Returns the data table and its load info (see read_data)
+    The table is read once per file version (path, size and mtime) and shared
+    by all sessions and pages; it must not be modified
+    '''
+    list_files = [fdata, utilio.get_table_file(fdata)]
+    key = ('plot_data',) + utilcache.get_file_key(
+        [os.path.abspath(x) for x in list_files]
+    )
+    return utilcache.get_data_cache().get(key, read_data, fdata)
 
 def add_plot(df_plots, new_plot_params):
     """
@@ -105,39 +132,36 @@ def display_dist_plot(df, plot_params, plot_ind, plot_settings):
     Display dist plot
     '''
     # Read color map for data
-    colors = plot_settings['cmap']['data']
+    colors = plot_settings['cmaps']['data']
+    alpha = plot_settings['alphas']['data']
+    binnum = plot_settings['distplot_binnum']
 
     # Read plot params
     xvar = plot_params["xvar"]
-    yvar = plot_params["yvar"]
-    hvar = plot_params["hvar"]
     hvals = plot_params["hvals"]
     traces = plot_params['traces']
 
-    # Add a temp column if group var is not set
-    dft = df.copy()
-    if hvar is None:
-        hvar = "All"
-        hvals = None
-        dft["All"] = "Data"
-        vals_hue_all = ["All"]
-
-    vals_hue_all = sorted(dft[hvar].unique())
+    # Get data partitioned by group (shared with other plots)
+    plot_data = utilstat.get_plot_data(df, xvar, None, plot_params["hvar"])
     if hvals is None:
-        hvals = vals_hue_all
+        hvals = plot_data['hnames']
 
     data = []
     bin_sizes = []
     colors_sel = []
-    for hname in hvals:
-        col_ind = vals_hue_all.index(hname)  # Select index of colour for the category
-        dfh = dft[dft[hvar] == hname]
-        x_tmp = dfh[xvar]
-        x_range = x_tmp.max() - x_tmp.min()
+    hvals_sel = []
+    for c_ind, hname in enumerate(hvals):
+        dict_grp = utilstat.get_plot_group(plot_data, hname)
+        if dict_grp is None:
+            continue
+        x_tmp = dict_grp['x']
+        x_range = x_tmp[-1] - x_tmp[0]
         bin_size = x_range / binnum
         bin_sizes.append(bin_size)
         data.append(x_tmp)
-        colors_sel.append(colors[col_ind])
+        c = colors[f'd{c_ind+1}']
+        colors_sel.append(f'rgba({c[0]},{c[1]},{c[2]},{alpha})')
+        hvals_sel.append(str(hname))
 
     show_hist = "histogram" in traces
     show_curve = "density" in traces
@@ -145,7 +169,7 @@ def display_dist_plot(df, plot_params, plot_ind, plot_settings):
 
     fig = ff.create_distplot(
         data,
-        hvals,
+        hvals_sel,
         histnorm="",
         bin_size=bin_sizes,
         colors=colors_sel,
@@ -166,21 +190,26 @@ def display_scatter_plot(df, plot_params, plot_ind, plot_settings):
         st.session_state.plot_active = plot_ind
 
         # Detect MRID from the click info and save to session_state
-        hind = utilmisc.get_index_in_list(df.columns.tolist(), curr_params['hvar'])
-        
         sel_info = st.session_state[f"bubble_chart_{plot_ind}"]
         if len(sel_info["selection"]["points"]) > 0:
             sind = sel_info["selection"]["point_indices"][0]
-            if hind is None:
-                sel_mrid = df.iloc[sind]["MRID"]
+            sel_point = sel_info["selection"]["points"][0]
+            if sel_point.get("customdata") is not None:
+                # Points of decimated (large data) plots carry the MRID
+                sel_mrid = sel_point["customdata"]
+                if isinstance(sel_mrid, list):
+                    sel_mrid = sel_mrid[0]
             else:
-                lgroup = sel_info["selection"]["points"][0]["legendgroup"]
-                sel_mrid = df[df[curr_params["hvar"]] == lgroup].iloc[sind][
-                    "MRID"
-                ]
+                # Point index is the index in the group's plot data
+                lgroup = sel_point["legendgroup"]
+                hname = [x for x in plot_data['hnames'] if str(x) == lgroup][0]
+                sel_mrid = utilstat.get_plot_group(plot_data, hname)['mrid'][sind]
             sel_roi = st.session_state.plots.loc[st.session_state.plot_active, 'params']['yvar']
             st.session_state.sel_mrid = sel_mrid
             st.session_state.sel_roi = sel_roi
+            st.session_state.nbr_mrids = get_nearest_mrids(
+                df, sel_mrid, curr_params['xvar'], curr_params['yvar']
+            )
             #st.session_state.sel_roi_img = sel_roi
             # st.rerun()
 
@@ -188,12 +217,12 @@ def display_scatter_plot(df, plot_params, plot_ind, plot_settings):
 
     curr_params = st.session_state.plots.loc[plot_ind, 'params']
 
-    # Read centile data
+    # Get centile data (loaded once, shared by all plots)
     f_cent = os.path.join(
         st.session_state.paths['centiles'],
         f'{plot_params['method']}_centiles_{plot_params['centile_type']}.csv'
     )
-    df_cent = pd.read_csv(f_cent)
+    cent_table = utilstat.get_centile_table(f_cent)
 
     # Main plot
     m = plot_settings["margin"]
@@ -210,26 +239,33 @@ def display_scatter_plot(df, plot_params, plot_ind, plot_settings):
         xaxis_title = plot_params["xvar"], yaxis_title = plot_params["yvar"]
     )
     
-    # Add data scatter
+    # Get data partitioned by group (shared by all traces and plots)
+    plot_data = None
     if df is not None:
-        utiltr.add_trace_scatter(df, plot_params, plot_settings, fig)
+        plot_data = utilstat.get_plot_data(
+            df, plot_params['xvar'], plot_params['yvar'], plot_params['hvar']
+        )
+
+    # Add data scatter
+    if plot_data is not None:
+        utiltr.add_trace_scatter(plot_data, plot_params, plot_settings, fig)
 
     # Add linear fit
-    if df is not None:
-        utiltr.add_trace_linreg(df, plot_params, plot_settings, fig)
+    if plot_data is not None:
+        utiltr.add_trace_linreg(plot_data, plot_params, plot_settings, fig)
 
     # Add non-linear fit
-    if df is not None:
-        utiltr.add_trace_lowess(df, plot_params, plot_settings, fig)
+    if plot_data is not None:
+        utiltr.add_trace_lowess(plot_data, plot_params, plot_settings, fig)
 
     # Add centile trace
-    if df_cent is not None:
-        utiltr.add_trace_centile(df_cent, plot_params, plot_settings, fig)
+    if cent_table is not None:
+        utiltr.add_trace_centile(cent_table, plot_params, plot_settings, fig)
 
     # Add selected dot
     sel_mrid = st.session_state.sel_mrid
-    if sel_mrid is not None:
-        utiltr.add_trace_dot(df, sel_mrid, plot_params, plot_settings, fig)
+    if sel_mrid is not None and plot_data is not None:
+        utiltr.add_trace_dot(plot_data, sel_mrid, plot_params, plot_settings, fig)
 
     st.plotly_chart(fig, key=f"bubble_chart_{plot_ind}", on_select=callback_plot_clicked)
     # st.plotly_chart(fig, key=f"bubble_chart_{plot_ind}")
@@ -270,6 +306,38 @@ def show_plots(df, df_plots, plot_settings):
                 df_plots.loc[plot_ind, 'flag_sel'] = st.session_state[f'_flag_sel_{plot_ind}']
 
 
+def get_nearest_mrids(df, mrid, xvar, yvar, num_mrids = 4):
+    '''
+    Return MRIDs of the subjects closest to the selected subject in the scatter plot
+    (x and y values are scaled to unit variance)
+    '''
+    df_xy = df[['MRID', xvar, yvar]].dropna()
+    vals = df_xy.iloc[:, 1:].values.astype(float)
+    vals = vals / np.where(vals.std(axis=0) > 0, vals.std(axis=0), 1)
+
+    is_sel = (df_xy.MRID == mrid).values
+    if not is_sel.any():
+        return []
+
+    dist = np.sum((vals - vals[is_sel][0]) ** 2, axis=1)
+    dist[is_sel] = np.inf
+    sel_inds = np.argsort(dist)[:min(num_mrids, (~is_sel).sum())]
+
+    return df_xy.MRID.values[sel_inds].tolist()
+
+def get_mri_files(mrid):
+    '''
+    Return the underlay (T1) and overlay (DLMUSE) image files of a subject
+    '''
+    in_dir = st.session_state.paths['project']
+    ulay = os.path.join(
+        in_dir, 't1', f'{mrid}_T1.nii.gz'
+    )
+    olay = os.path.join(
+        in_dir, 'dlmuse_seg', f'{mrid}_T1_DLMUSE.nii.gz'
+    )
+    return ulay, olay
+
 def show_mri():
     '''
     Display mri plot
@@ -290,16 +358,16 @@ def show_mri():
     if st.session_state.plot_settings["flag_show_img"] == False:
         return
 
-    in_dir = st.session_state.paths['project']
     plot_params = st.session_state.plot_params
-    ulay = os.path.join(
-        in_dir, 't1', f'{mrid}_T1.nii.gz'
-    )
-    olay = os.path.join(
-        in_dir, 'dlmuse_seg', f'{mrid}_T1_DLMUSE.nii.gz'
-    )
+    ulay, olay = get_mri_files(mrid)
     utilmri.panel_view_seg(ulay, olay, plot_params)
 
+    # Load images of nearby subjects in the background
+    utilmri.prefetch_image_and_labels(
+        [get_mri_files(x) for x in st.session_state.nbr_mrids],
+        plot_params['crop_to_mask']
+    )
+
 ###################################################################
 # User selections
 def user_select_var2(sel_var_groups, plot_params, var_type, add_none = False):
@@ -500,6 +568,13 @@ def user_select_plot_settings(plot_params):
         disabled=False,
     )
 
+    # Checkbox to show large data as a density map
+    st.session_state.plot_settings['flag_density'] = st.checkbox(
+        f"Density map for large data ({st.session_state.plot_settings['density_min_points']}+ points)",
+        value=st.session_state.plot_settings['flag_density'],
+        disabled=False,
+    )
+
 def user_add_plots(plot_params):
     '''
     Panel to select plot args from the user
@@ -1,8 +1,18 @@
+import os
+import sys
 from typing import Any
 
 import pandas as pd
 import streamlit as st
-import os
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+        "workflows",
+        "common",
+    )
+)
+import roi_tables as roitab
 
 # from stqdm import stqdm
 
@@ -47,39 +57,30 @@ def muse_derived_to_dict(in_list: list) -> Any:
     """
     Create a dictionary from derived roi list
     """
-    # Read list
-    df = pd.read_csv(in_list, header=None)
-
+    # Read list (using the derived roi map, read once per file)
+    derived_map = roitab.get_derived_map(in_list)
 
     dict_derived = {
-        row[0]: [int(x) for x in row[2:] if pd.notna(x)] for _, row in df.iterrows()
+        int(code): list(labels)
+        for code, labels in zip(derived_map["codes"], derived_map["labels"])
     }
 
-    ## Create dict of roi indices and derived indices
-    #dict_derived = {}
-    #for i, tmp_ind in enumerate(df[0].values):
-        #df_tmp = df[df[] == tmp_ind].drop([0, 1], axis=1)
-        #sel_vals = df_tmp.T.dropna().astype(int).values.flatten()
-        #dict_derived[str(tmp_ind)] = list(sel_vals)
-
     return dict_derived
 
 def muse_derived_to_df(in_list: list) -> Any:
     """
     Create a df from derived roi list
     """
-    # Read list
-    df = pd.read_csv(in_list, header=None)
-
-    # Rename first two columns
-    df = df.rename(columns={0: 'Index', 1: 'Name'})
-
-    # Create a new column 'List' with the remaining columns as a list
-    df['List'] = df.iloc[:, 2:].apply(lambda row: row.dropna().astype(int).tolist(), axis=1)
-
-    # Keep only the desired columns
-    df = df[['Index', 'Name', 'List']]
-    df.Index = df.Index.astype(str)
+    # Read list (using the derived roi map, read once per file)
+    derived_map = roitab.get_derived_map(in_list)
+
+    df = pd.DataFrame(
+        {
+            'Index': derived_map["codes"],
+            'Name': derived_map["names"],
+            'List': [list(x) for x in derived_map["labels"]],
+        }
+    )
 
     return df
 
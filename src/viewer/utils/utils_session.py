@@ -7,6 +7,7 @@ import time
 import yaml
 import pandas as pd
 import streamlit as st
+import utils.utils_cache as utilcache
 import utils.utils_io as utilio
 import utils.utils_rois as utilroi
 import utils.utils_processes as utilproc
@@ -64,6 +65,12 @@ def disp_session_state():
                 st.markdown('➤ ' + sel_var + ':')
                 st.write(st.session_state[sel_var])
 
+        with st.container(border=True):
+            st.markdown('##### Plot Data:')
+            st.write(st.session_state.plot_data.get('info'))
+            st.markdown('##### Data Cache:')
+            st.write(utilcache.get_data_cache().info())
+
 def init_project_folders():
     '''
     Set initial values for project folders
@@ -92,6 +99,7 @@ def init_session_vars():
     st.session_state.sel_pipeline = 'DLMUSE'
 
     st.session_state.sel_mrid = None
+    st.session_state.nbr_mrids = []
 
     st.session_state.pipeline_colors = [
         'red', 'pink', 'grape', 'violet', 'indigo', 'blue',
@@ -281,7 +289,8 @@ def init_plot_vars() -> None:
     # Plot data
     st.session_state.plot_data = {
         'df_data': None,
-        'df_cent': None
+        'df_cent': None,
+        'info': None
     }
 
     # Plot settings
@@ -310,6 +319,10 @@ def init_plot_vars() -> None:
         "h_coeff_min": 0.6,
         "h_coeff_step": 0.2,
         "distplot_binnum": 100,
+        "scattergl_min_points": 5000,
+        "flag_density": True,
+        "density_min_points": 50000,
+        "density_bins": 150,
         "cmaps": utilcmap.cmaps_init,
         "alphas": utilcmap.alphas_init,
         #"cmaps2": utilcmap.cmaps2,
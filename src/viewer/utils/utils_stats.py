@@ -1,85 +1,253 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import os
+import sys
+import weakref
 from typing import Any
 
 import numpy as np
 import pandas as pd
 import statsmodels.api as sm
 import streamlit as st
+import utils.utils_cache as utilcache
+from scipy import stats
 
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+        "workflows",
+        "common",
+    )
+)
+import roi_tables as roitab
 
-@st.cache_data()  # type:ignore
-def linreg_model(df: pd.DataFrame, xvar: str, yvar: str, hvar: str) -> Any:
-    '''
-    Fit linear regression model to data
-    '''
-    dft = df[[xvar, yvar, hvar]].dropna().sort_values(xvar)
 
-    # Add traces for the fit
-    dict_out = {}
-    for hname, dfh in dft.groupby(hvar):
-        x_ext = sm.add_constant(dfh[xvar])
-        model = sm.OLS(dfh[yvar], x_ext).fit()
-        pred = model.get_prediction(x_ext)
-        dict_mdl = {
-            "x_hat": dfh[xvar],
-            "y_hat": model.fittedvalues,
-            "conf_int": pred.conf_int(),
-        }
-        dict_out[hname] = dict_mdl
-    return dict_out
+# Memory budget (MB) of the fit cache shared by all sessions
+FIT_CACHE_MB = int(os.getenv("NICHART_FIT_CACHE_MB", "256"))
+
+# Number of points of the fitted curves
+FIT_NUM_POINTS = 200
+
+# Above this size, LOWESS is fitted to the means of equal size bins of points
+LOWESS_MAX_POINTS = 5000
+
+# Column hashes of dataframes in use (see get_column_hash)
+_column_hashes: dict = {}
 
-# @st.cache_data()  # type:ignore
-def lowess_model(
-    df: pd.DataFrame, xvar: str, yvar: str, hvar: str, lowess_s: float
-) -> Any:
+
+@st.cache_resource  # type:ignore
+def get_fit_cache() -> utilcache.ArrayLRUCache:
+    """
+    Returns the fit cache shared by all sessions
+    """
+    return utilcache.ArrayLRUCache(FIT_CACHE_MB * 1e6)
+
+
+def get_column_hash(df: pd.DataFrame, col: str) -> str:
+    """
+    Returns the hash of a dataframe column
+    Hashes are kept with the dataframe object (and removed with it), so that a
+    dataframe shown in several plots is hashed once; dataframes are not
+    modified after they are plotted
+    """
+    key_df = id(df)
+    dict_hash = _column_hashes.get(key_df)
+    if dict_hash is None:
+        dict_hash = _column_hashes.setdefault(key_df, {})
+        weakref.finalize(df, _column_hashes.pop, key_df, None)
+    if col not in dict_hash:
+        hash_vals = pd.util.hash_pandas_object(df[col], index=False).values
+        dict_hash[col] = f"{df[col].dtype}_{hashlib.sha1(hash_vals).hexdigest()}"
+    return dict_hash[col]
+
+
+def get_data_fingerprint(df: pd.DataFrame, list_vars: list) -> str:
+    """
+    Returns a fingerprint of the selected columns of a dataframe
+    Only the selected columns are hashed, so that the fingerprint is cheap and
+    does not change with other columns
+    """
+    list_hash = [(x, get_column_hash(df, x)) for x in list_vars if x in df]
+    return hashlib.sha1(repr(list_hash).encode()).hexdigest()
+
+
+def calc_plot_data(df: pd.DataFrame, xvar: str, yvar: Any, hvar: str) -> dict:
+    """
+    Partitions the plotted values into groups in a single pass
+    Returns x, y and MRID arrays sorted by group and x (rows with missing values
+    are skipped), the group names and the start index of each group
+    If hvar is empty, all rows are in a single group ("Data"); if yvar is None,
+    only x values are used
+    """
+    x = df[xvar].to_numpy(dtype=float)
+    is_valid = ~np.isnan(x)
+    y = None
+    if yvar is not None:
+        y = df[yvar].to_numpy(dtype=float)
+        is_valid &= ~np.isnan(y)
+    mrid = df["MRID"].to_numpy() if "MRID" in df else np.arange(x.shape[0])
     if hvar == "":
-        dft = df[[xvar, yvar]].sort_values(xvar)
-        hvar = "All"
-        dft["All"] = "Data"
+        hcodes = np.zeros(x.shape[0], dtype=np.int64)
+        hnames = ["Data"]
     else:
-        dft = df[[xvar, yvar, hvar]].sort_values(xvar)
+        hcodes, hnames = pd.factorize(df[hvar], sort=True)
+        hnames = hnames.tolist()
+        is_valid &= hcodes >= 0
+
+    ind_sel = np.flatnonzero(is_valid)
+    ind_sel = ind_sel[np.lexsort((x[ind_sel], hcodes[ind_sel]))]
+    hcodes = hcodes[ind_sel]
+
+    # Groups without valid values are removed
+    counts = np.bincount(hcodes, minlength=len(hnames))
+    return {
+        "x": x[ind_sel],
+        "y": None if y is None else y[ind_sel],
+        "mrid": mrid[ind_sel],
+        "hnames": [x for x, n in zip(hnames, counts) if n > 0],
+        "ind_start": np.concatenate([[0], np.cumsum(counts[counts > 0])]),
+    }
+
+
+def get_plot_data(df: pd.DataFrame, xvar: str, yvar: Any, hvar: Any) -> dict:
+    """
+    Returns the plot data (see calc_plot_data) of the selected columns
+    Plot data is cached by the fingerprint of the columns, so that the data is
+    partitioned once and shared by all traces and plots with the same columns
+    """
+    if hvar is None or hvar == "None" or hvar not in df:
+        hvar = "grouping_var" if "grouping_var" in df else ""
+    list_vars = ["MRID", xvar, yvar, hvar]
+    key = ("plot_data", get_data_fingerprint(df, list_vars), xvar, yvar, hvar)
+    plot_data = get_fit_cache().get(
+        key, lambda: calc_plot_data(df, xvar, yvar, hvar) | {"key": key}
+    )
+    return plot_data
+
+
+def get_plot_group(plot_data: dict, hname: Any) -> Any:
+    """
+    Returns the values (views of the plot data arrays) of a group, or None
+    """
+    if hname not in plot_data["hnames"]:
+        return None
+    ind = plot_data["hnames"].index(hname)
+    sl = slice(plot_data["ind_start"][ind], plot_data["ind_start"][ind + 1])
+    return {
+        "x": plot_data["x"][sl],
+        "y": None if plot_data["y"] is None else plot_data["y"][sl],
+        "mrid": plot_data["mrid"][sl],
+    }
+
+
+def calc_linreg(plot_data: dict) -> Any:
+    """
+    Fit linear regression models to all groups (closed form OLS, vectorized over
+    groups); the fit and the 95% confidence band of the mean are evaluated on a
+    grid of FIT_NUM_POINTS points within the x range of each group
+    """
+    x, y = plot_data["x"], plot_data["y"]
+    hnames, ind_start = plot_data["hnames"], plot_data["ind_start"]
+    num_grp = len(hnames)
+    num_samp = np.diff(ind_start)
+    ind_grp = np.repeat(np.arange(num_grp), num_samp)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_mean = np.bincount(ind_grp, x, num_grp) / num_samp
+        y_mean = np.bincount(ind_grp, y, num_grp) / num_samp
+        x_cent = x - x_mean[ind_grp]
+        ss_x = np.bincount(ind_grp, x_cent**2, num_grp)
+        slope = np.bincount(ind_grp, x_cent * (y - y_mean[ind_grp]), num_grp) / ss_x
+        icpt = y_mean - slope * x_mean
+        resid = y - icpt[ind_grp] - slope[ind_grp] * x
+        dof = num_samp - 2
+        mse = np.bincount(ind_grp, resid**2, num_grp) / dof
+        tval = stats.t.ppf(0.975, dof)
+
+        # Fit and confidence band on the grid
+        x_min = x[ind_start[:-1]]
+        x_max = x[ind_start[1:] - 1]
+        x_hat = x_min[:, None] + (x_max - x_min)[:, None] * np.linspace(
+            0, 1, FIT_NUM_POINTS
+        )
+        y_hat = icpt[:, None] + slope[:, None] * x_hat
+        se_hat = np.sqrt(
+            mse[:, None]
+            * (1 / num_samp[:, None] + (x_hat - x_mean[:, None]) ** 2 / ss_x[:, None])
+        )
+        conf_int = np.stack(
+            [y_hat - tval[:, None] * se_hat, y_hat + tval[:, None] * se_hat], axis=-1
+        )
 
-    # Add traces for the fit
     dict_out = {}
-    for hname, dfh in dft.groupby(hvar):
-        lowess = sm.nonparametric.lowess
-        pred = lowess(dfh[yvar], dfh[xvar], frac=lowess_s)
-        dict_mdl = {"x_hat": pred[:, 0], "y_hat": pred[:, 1], "conf_int": []}
-        dict_out[hname] = dict_mdl
+    for i, hname in enumerate(hnames):
+        dict_out[hname] = {
+            "x_hat": x_hat[i],
+            "y_hat": y_hat[i],
+            "conf_int": conf_int[i],
+        }
     return dict_out
 
 
-def calc_subject_centiles(df_subj: pd.DataFrame, df_cent: pd.DataFrame) -> pd.DataFrame:
+def calc_lowess(plot_data: dict, frac: float) -> Any:
     """
-    Calculate subject specific centile values
+    Fit LOWESS curves to all groups
+    Large groups are reduced to the means of equal size bins of sorted points,
+    and local fits closer than 1% of the x range are interpolated (delta), so
+    that the fit time does not grow quadratically with the number of points
     """
+    dict_out = {}
+    for hname in plot_data["hnames"]:
+        dict_grp = get_plot_group(plot_data, hname)
+        xh, yh = dict_grp["x"], dict_grp["y"]
+        if xh.shape[0] > LOWESS_MAX_POINTS:
+            bin_size = int(np.ceil(xh.shape[0] / LOWESS_MAX_POINTS))
+            ind_bin = np.arange(0, xh.shape[0], bin_size)
+            bin_counts = np.diff(np.append(ind_bin, xh.shape[0]))
+            xh = np.add.reduceat(xh, ind_bin) / bin_counts
+            yh = np.add.reduceat(yh, ind_bin) / bin_counts
 
-    # Filter centiles to subject's age
-    tmp_ind = (df_cent.Age - df_subj.Age[0]).abs().idxmin()
-    sel_age = df_cent.loc[tmp_ind, "Age"]
-    df_cent_sel = df_cent[df_cent.Age == sel_age]
+        pred = sm.nonparametric.lowess(
+            yh, xh, frac=frac, delta=0.01 * (xh[-1] - xh[0]), is_sorted=True
+        )
+        x_hat, y_hat = pred[:, 0], pred[:, 1]
+        if x_hat.shape[0] > FIT_NUM_POINTS:
+            x_grid = np.linspace(x_hat[0], x_hat[-1], FIT_NUM_POINTS)
+            y_hat = np.interp(x_grid, x_hat, y_hat)
+            x_hat = x_grid
+        dict_out[hname] = {"x_hat": x_hat, "y_hat": y_hat, "conf_int": []}
+    return dict_out
 
-    # Find ROIs in subj data that are included in the centiles file
-    sel_vars = df_subj.columns[df_subj.columns.isin(df_cent_sel.ROI.unique())].tolist()
-    df_cent_sel = df_cent_sel[df_cent_sel.ROI.isin(sel_vars)].drop(
-        ["ROI", "Age"], axis=1
-    )
 
-    cent = df_cent_sel.columns.str.replace("centile_", "").astype(int).values
-    vals_cent = df_cent_sel.values
-    vals_subj = df_subj.loc[0, sel_vars]
+def linreg_model(plot_data: dict) -> Any:
+    """
+    Fit linear regression model to plot data (see get_plot_data)
+    Fits are cached with the plot data key
+    """
+    key = ("linreg", plot_data["key"])
+    return get_fit_cache().get(key, calc_linreg, plot_data)
 
-    cent_subj = np.zeros(vals_subj.shape[0])
-    for i, sval in enumerate(vals_subj):
-        # Find nearest x values
-        ind1 = np.where(vals_subj[i] < vals_cent[i, :])[0][0] - 1
-        ind2 = ind1 + 1
 
-        # Calculate slope
-        slope = (cent[ind2] - cent[ind1]) / (vals_cent[i, ind2] - vals_cent[i, ind1])
+def lowess_model(plot_data: dict, lowess_s: float) -> Any:
+    """
+    Fit LOWESS model to plot data (see get_plot_data)
+    Fits are cached with the plot data key
+    """
+    key = ("lowess", plot_data["key"], float(lowess_s))
+    return get_fit_cache().get(key, calc_lowess, plot_data, lowess_s)
 
-        # Estimate subj centile
-        cent_subj[i] = cent[ind1] + slope * (vals_subj[i] - vals_cent[i, ind1])
 
-    df_out = pd.DataFrame(dict(ROI=sel_vars, Centiles=cent_subj))
-    return df_out
+def get_centile_table(f_cent: str) -> Any:
+    """
+    Return the centile table (arrays indexed by ROI and age), or None if the
+    file does not exist
+    Tables are loaded once per process and reloaded only if the file changes
+    """
+    return roitab.get_centile_table(f_cent)
+
+
+def get_centile_curves(cent_table: dict, roi: str) -> Any:
+    """
+    Return the centile curves (age x centile) of an ROI, or None
+    """
+    return roitab.get_centile_curves(cent_table, roi)
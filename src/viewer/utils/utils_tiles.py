@@ -0,0 +1,272 @@
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Any, Callable
+
+import numpy as np
+import utils.utils_cache as utilcache
+from PIL import Image, features
+
+# Folder of pre-rendered slice tiles (an empty value disables the tile cache)
+TILE_CACHE_DIR = os.getenv(
+    "NICHART_TILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nichart_tiles")
+)
+
+# Disk budget (MB) of the tile cache (tiles of least recently used views are
+# deleted beyond it)
+TILE_CACHE_MB = int(os.getenv("NICHART_TILE_CACHE_MB", "2048"))
+
+# Version of the slice rendering code; increase it when rendering changes, so
+# that old tiles are not reused
+TILE_RENDER_VERSION = 1
+
+# Tiles are saved as lossless WebP (or PNG if Pillow was built without WebP)
+TILE_FORMAT = "webp" if features.check("webp") else "png"
+
+
+def get_tile_key(
+    f_img: str,
+    f_mask: str,
+    crop_to_mask: bool,
+    list_rois: Any,
+    olay_color: Any,
+    olay_alpha: float,
+) -> str:
+    """
+    Returns the key of the tiles of a view
+    The key includes the input files (path, size and mtime), the overlay
+    settings and the render version, so that tiles are not reused after any of
+    them changes
+    """
+    file_key = utilcache.get_file_key([os.path.abspath(f_img), os.path.abspath(f_mask)])
+    if list_rois is not None:
+        list_rois = sorted(int(x) for x in list_rois)
+    key = (
+        file_key,
+        bool(crop_to_mask),
+        list_rois,
+        tuple(np.round(np.asarray(olay_color, dtype=float), 4).tolist()),
+        round(float(olay_alpha), 4),
+        TILE_FORMAT,
+        TILE_RENDER_VERSION,
+    )
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def get_tile_dir(tile_key: str) -> str:
+    """
+    Returns the folder of the tiles of a view
+    """
+    return os.path.join(TILE_CACHE_DIR, tile_key[:2], tile_key)
+
+
+def get_tile_file(tile_key: str, scroll_axis: int, slice_index: int) -> str:
+    """
+    Returns the file name of a tile
+    """
+    return os.path.join(
+        get_tile_dir(tile_key), f"{scroll_axis}_{slice_index}.{TILE_FORMAT}"
+    )
+
+
+def evict_tile_cache(max_bytes: float) -> None:
+    """
+    Deletes tiles of least recently used views until the tile cache fits in
+    max_bytes (view folders are touched when their tiles are used)
+    """
+    list_dirs = []
+    for entry in glob.glob(os.path.join(TILE_CACHE_DIR, "*", "*")):
+        try:
+            dir_size = sum(x.stat().st_size for x in os.scandir(entry))
+            list_dirs.append((os.stat(entry).st_mtime, dir_size, entry))
+        except OSError:
+            continue
+
+    total_bytes = sum(x[1] for x in list_dirs)
+    for _, dir_size, dir_name in sorted(list_dirs):
+        if total_bytes <= max_bytes:
+            break
+        shutil.rmtree(dir_name, ignore_errors=True)
+        total_bytes -= dir_size
+        try:
+            os.rmdir(os.path.dirname(dir_name))
+        except OSError:
+            pass
+
+
+def encode_tile(img_slice: np.ndarray) -> bytes:
+    """
+    Encodes an RGB uint8 slice
+    """
+    buffer = BytesIO()
+    if TILE_FORMAT == "webp":
+        Image.fromarray(img_slice).save(buffer, format="WEBP", lossless=True, method=4)
+    else:
+        Image.fromarray(img_slice).save(buffer, format="PNG", compress_level=6)
+    return buffer.getvalue()
+
+
+def read_tile(tile_key: str, scroll_axis: int, slice_index: int) -> Any:
+    """
+    Returns the encoded tile, or None if it is not in the cache
+    """
+    try:
+        with open(get_tile_file(tile_key, scroll_axis, slice_index), "rb") as f:
+            data = f.read()
+        os.utime(get_tile_dir(tile_key))
+        return data
+    except OSError:
+        return None
+
+
+def write_tile(tile_key: str, scroll_axis: int, slice_index: int, data: bytes) -> None:
+    """
+    Writes an encoded tile to the cache
+    The tile is written to a temp file and renamed, so that readers never see
+    partial tiles. The cache is checked against its budget when a new view is
+    added.
+    """
+    f_tile = get_tile_file(tile_key, scroll_axis, slice_index)
+    flag_new = not os.path.isdir(get_tile_dir(tile_key))
+    try:
+        os.makedirs(os.path.dirname(f_tile), exist_ok=True)
+        f_tmp = f"{f_tile}.{os.getpid()}.tmp"
+        with open(f_tmp, "wb") as f:
+            f.write(data)
+        os.replace(f_tmp, f_tile)
+    except OSError as e:
+        print(f"Could not write tile {f_tile}: {e}")
+    if flag_new:
+        evict_tile_cache(TILE_CACHE_MB * 1e6)
+
+
+def get_tile(
+    tile_key: Any, scroll_axis: int, slice_index: int, func: Callable, *args: Any
+) -> bytes:
+    """
+    Returns the encoded tile from the cache, or renders it with func(*args),
+    encodes it and adds it to the cache
+    """
+    if not TILE_CACHE_DIR or tile_key is None:
+        return encode_tile(func(*args))
+
+    data = read_tile(tile_key, scroll_axis, slice_index)
+    if data is None:
+        data = encode_tile(func(*args))
+        write_tile(tile_key, scroll_axis, slice_index, data)
+    return data
+
+
+def prerender_project(
+    in_dir: str,
+    list_overlays: list,
+    list_axes: list,
+    crop_to_mask: bool,
+    num_workers: Any = None,
+) -> list:
+    """
+    Pre-renders the tiles of all subjects in a project folder (t1 and dlmuse_seg)
+    list_overlays is a list of roi label lists (None for the image without overlay)
+    Returns the number of tiles written for each subject
+    """
+    # Imported here, as utils_mriview uses this module
+    import utils.utils_mriview as utilmri
+
+    # Select subjects with both the image and the segmentation
+    list_img, list_mask = [], []
+    for f_img in sorted(glob.glob(os.path.join(in_dir, "t1", "*_T1.nii.gz"))):
+        mrid = os.path.basename(f_img).replace("_T1.nii.gz", "")
+        f_mask = os.path.join(in_dir, "dlmuse_seg", f"{mrid}_T1_DLMUSE.nii.gz")
+        if os.path.exists(f_mask):
+            list_img.append(f_img)
+            list_mask.append(f_mask)
+    if len(list_img) == 0:
+        return []
+
+    # Subjects are rendered in parallel
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = min(num_workers, len(list_img))
+    args = [
+        [crop_to_mask] * len(list_img),
+        [list_overlays] * len(list_img),
+        [list_axes] * len(list_img),
+    ]
+    if num_workers <= 1:
+        return list(map(utilmri.prerender_slice_tiles, list_img, list_mask, *args))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(
+            executor.map(utilmri.prerender_slice_tiles, list_img, list_mask, *args)
+        )
+
+
+if __name__ == "__main__":
+    import utils.utils_mriview as utilmri
+    import utils.utils_rois as utilroi
+
+    parser = argparse.ArgumentParser(
+        description="Pre-render viewer slice tiles for a project folder"
+    )
+    parser.add_argument(
+        "--in_dir", help="Provide the path to the project folder", required=True
+    )
+    parser.add_argument(
+        "--rois",
+        help="Provide the derived MUSE roi indices to overlay (e.g. 601 702)",
+        nargs="*",
+        type=int,
+        default=[],
+    )
+    parser.add_argument(
+        "--csv_derived",
+        help="Provide the derived roi map (list_MUSE_mapping_derived.csv)",
+        default=os.path.join(
+            os.path.dirname(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            ),
+            "workflows",
+            "w_sMRI",
+            "lists",
+            "list_MUSE_mapping_derived.csv",
+        ),
+    )
+    parser.add_argument(
+        "--no_underlay",
+        help="Do not render slices without overlay",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--orient",
+        help="Provide the viewing planes",
+        nargs="*",
+        choices=utilmri.img_views,
+        default=utilmri.img_views,
+    )
+    parser.add_argument(
+        "--no_crop", help="Do not crop images to the mask", action="store_true"
+    )
+    parser.add_argument(
+        "--num_workers", help="Provide the number of workers", type=int, default=None
+    )
+    options = parser.parse_args()
+
+    dict_derived = utilroi.muse_derived_to_dict(options.csv_derived)
+    list_overlays = [] if options.no_underlay else [None]
+    list_overlays += [dict_derived[x] for x in options.rois]
+    list_axes = [utilmri.img_views.index(x) for x in options.orient]
+
+    list_out = prerender_project(
+        options.in_dir,
+        list_overlays,
+        list_axes,
+        not options.no_crop,
+        options.num_workers,
+    )
+    print(
+        f"Wrote {sum(list_out)} tiles for {len(list_out)} subjects to {TILE_CACHE_DIR}"
+    )
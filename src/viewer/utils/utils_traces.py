@@ -11,16 +11,74 @@ import utils.utils_stats as utilstat
 import plotly.graph_objs as go
 import plotly.figure_factory as ff
 
+###################################################################
+# Large data
+def get_plot_bins(x: np.ndarray, y: np.ndarray, num_bins: int) -> list:
+    '''
+    Return the bin edges (x and y) of a num_bins x num_bins grid over the data
+    '''
+    list_edges = []
+    for vals in [x, y]:
+        vmin, vmax = np.nanmin(vals), np.nanmax(vals)
+        if vmin == vmax:
+            vmin, vmax = vmin - 0.5, vmax + 0.5
+        list_edges.append(np.linspace(vmin, vmax, num_bins + 1))
+    return list_edges
+
+def decimate_points(
+    x: np.ndarray, y: np.ndarray, x_edges: np.ndarray, y_edges: np.ndarray
+) -> np.ndarray:
+    '''
+    Select a single (exact) data point in each non-empty bin of the grid
+    Returns the indices of the selected points
+    '''
+    is_valid = np.flatnonzero(~np.isnan(x) & ~np.isnan(y))
+    num_x = len(x_edges) - 1
+    num_y = len(y_edges) - 1
+    ind_x = np.clip(np.searchsorted(x_edges, x[is_valid], side="right") - 1, 0, num_x - 1)
+    ind_y = np.clip(np.searchsorted(y_edges, y[is_valid], side="right") - 1, 0, num_y - 1)
+    _, ind_first = np.unique(ind_x * num_y + ind_y, return_index=True)
+    return is_valid[np.sort(ind_first)]
+
+def add_trace_density(
+    plot_data: dict, plot_params: dict, plot_settings: dict, fig: Any
+) -> list:
+    '''
+    Add a density raster of all data points (counts calculated on the server)
+    Returns the bin edges used for the raster
+    '''
+    x, y = plot_data['x'], plot_data['y']
+    x_edges, y_edges = get_plot_bins(x, y, plot_settings['density_bins'])
+    counts, _, _ = np.histogram2d(x, y, bins=[x_edges, y_edges])
+
+    # Empty bins are transparent, counts are shown in log scale
+    z = np.log10(counts.T, where=counts.T > 0, out=np.full(counts.T.shape, np.nan))
+    trace = go.Heatmap(
+        x=(x_edges[:-1] + x_edges[1:]) / 2,
+        y=(y_edges[:-1] + y_edges[1:]) / 2,
+        z=z,
+        colorscale="Greys",
+        showscale=False,
+        hoverinfo="skip",
+        name="density",
+    )
+    fig.add_trace(trace)
+
+    return [x_edges, y_edges]
+
 ###################################################################
 # Traces
-def add_trace_scatter(df: pd.DataFrame, plot_params: dict, plot_settings: dict, fig: Any) -> None:
+def add_trace_scatter(plot_data: dict, plot_params: dict, plot_settings: dict, fig: Any) -> None:
     '''
     Add trace with data points
+    Large data is plotted with WebGL; above the density limit (if enabled) the
+    data is shown as a density raster with a single selectable point per bin
     '''
     # Check data
-    if df is None:
+    if plot_data is None:
         return fig
-    if df.shape[0] == 0:
+    num_points = plot_data['x'].shape[0]
+    if num_points == 0:
         return fig
 
     # Set colormap
@@ -28,22 +86,41 @@ def add_trace_scatter(df: pd.DataFrame, plot_params: dict, plot_settings: dict,
     alpha = plot_settings['alphas']['data']
 
     # Get hue params
-    hvar = plot_params['hvar']
-    hvals = plot_params['hvals']    
-    if hvar is None or hvar == 'None':
-        hvar = 'grouping_var'
+    hvals = plot_params['hvals']
     if hvals is None:
-        hvals = df[hvar].dropna().sort_values().unique().tolist()
+        hvals = plot_data['hnames']
+
+    # Select plot mode for the data size
+    trace_type = go.Scatter
+    if num_points >= plot_settings['scattergl_min_points']:
+        trace_type = go.Scattergl
+    flag_density = (
+        plot_settings['flag_density']
+        and num_points >= plot_settings['density_min_points']
+    )
 
     if "data" in plot_params['traces']:
+        if flag_density:
+            x_edges, y_edges = add_trace_density(plot_data, plot_params, plot_settings, fig)
+
         for hname in hvals:
+            dict_grp = utilstat.get_plot_group(plot_data, hname)
+            if dict_grp is None:
+                continue
             c_ind = hvals.index(hname)  # Select index of colour for the category
             c = colors[f'd{c_ind+1}']
             c_txt = f'rgba({c[0]},{c[1]},{c[2]},{alpha})'
-            dfh = df[df[hvar] == hname]
-            trace = go.Scatter(
-                x=dfh[plot_params['xvar']],
-                y=dfh[plot_params['yvar']],
+            x, y = dict_grp['x'], dict_grp['y']
+            customdata = None
+            if flag_density:
+                # Keep one exact point per bin (MRIDs are used for selection)
+                sel_ind = decimate_points(x, y, x_edges, y_edges)
+                x, y = x[sel_ind], y[sel_ind]
+                customdata = dict_grp['mrid'][sel_ind]
+            trace = trace_type(
+                x=x,
+                y=y,
+                customdata=customdata,
                 mode="markers",
                 marker={"color": c_txt},
                 name=hname,
@@ -52,7 +129,7 @@ def add_trace_scatter(df: pd.DataFrame, plot_params: dict, plot_settings: dict,
             )
             fig.add_trace(trace)
 
-def add_trace_linreg(df: pd.DataFrame, plot_params: dict, plot_settings: dict, fig: Any) -> None:
+def add_trace_linreg(plot_data: dict, plot_params: dict, plot_settings: dict, fig: Any) -> None:
     '''
     Add trace for linear fit and confidence interval
     '''
@@ -60,25 +137,23 @@ def add_trace_linreg(df: pd.DataFrame, plot_params: dict, plot_settings: dict, f
     colors = plot_settings['cmaps']['data']
 
     # Get hue params
-    hvar = plot_params['hvar']
     hvals = plot_params['hvals']
-    if hvar is None or hvar == 'None':
-        hvar = 'grouping_var'
     if hvals is None:
-        hvals = df[hvar].dropna().sort_values().unique().tolist()
+        hvals = plot_data['hnames']
 
     traces = plot_params['traces']
+    if "lin_fit" not in traces and "conf_95%" not in traces:
+        return fig
         
     # Calculate fit
-    dict_fit = utilstat.linreg_model(
-        df, plot_params['xvar'], plot_params['yvar'], hvar
-    )
+    dict_fit = utilstat.linreg_model(plot_data)
+    hvals_fit = [x for x in hvals if x in dict_fit]
 
     # Add traces for the fit and confidence intervals
     if "lin_fit" in traces:
         alpha = plot_settings['alphas']['lin_fit']
 
-        for i, hname in enumerate(hvals):
+        for hname in hvals_fit:
             c_ind = hvals.index(hname)  # Select index of colour for the category
             c = colors[f'd{c_ind+1}']
             c_txt = f'rgba({c[0]},{c[1]},{c[2]},{alpha})'
@@ -98,7 +173,7 @@ def add_trace_linreg(df: pd.DataFrame, plot_params: dict, plot_settings: dict, f
 
     if "conf_95%" in traces:
         alpha = plot_settings['alphas']['conf_95%']
-        for hname in hvals:
+        for hname in hvals_fit:
             c_ind = hvals.index(hname)  # Select index of colour for the category
             c = colors[f'd{c_ind+1}']
             c_txt = f'rgba({c[0]},{c[1]},{c[2]},{alpha})'
@@ -120,7 +195,7 @@ def add_trace_linreg(df: pd.DataFrame, plot_params: dict, plot_settings: dict, f
 
     return fig
 
-def add_trace_lowess(df: pd.DataFrame, plot_params: dict, plot_settings: dict, fig: Any) -> None:
+def add_trace_lowess(plot_data: dict, plot_params: dict, plot_settings: dict, fig: Any) -> None:
     '''
     Add trace for non-linear fit
     '''
@@ -134,21 +209,16 @@ def add_trace_lowess(df: pd.DataFrame, plot_params: dict, plot_settings: dict, f
     alpha = plot_settings['alphas']['lowess']
 
     # Get hue params
-    hvar = plot_params['hvar']
     hvals = plot_params['hvals']
-    if hvar is None or hvar == 'None':
-        hvar = 'grouping_var'
     if hvals is None:
-        hvals = df[hvar].dropna().sort_values().unique().tolist()
+        hvals = plot_data['hnames']
 
     lowess_s = plot_params['lowess_s']
         
-    dict_fit = utilstat.lowess_model(
-        df, plot_params['xvar'], plot_params['yvar'], hvar, lowess_s
-    )
+    dict_fit = utilstat.lowess_model(plot_data, lowess_s)
 
     # Add traces for the fit and confidence intervals
-    for hname in hvals:
+    for hname in [x for x in hvals if x in dict_fit]:
         c_ind = hvals.index(hname)  # Select index of colour for the category
         c = colors[f'd{c_ind+1}']
         c_txt = f'rgba({c[0]},{c[1]},{c[2]},{alpha})'
@@ -168,21 +238,21 @@ def add_trace_lowess(df: pd.DataFrame, plot_params: dict, plot_settings: dict, f
         fig.add_trace(trace)
 
 def add_trace_dot(
-    df: pd.DataFrame, sel_mrid: str, plot_params: dict, plot_settings: dict, fig: Any
+    plot_data: dict, sel_mrid: str, plot_params: dict, plot_settings: dict, fig: Any
 ) -> None:
     '''
     Add trace for a single dot
     '''
-    df_tmp = df[df.MRID == sel_mrid]
-    if df_tmp.shape[0] == 0:
+    ind_sel = np.flatnonzero(plot_data['mrid'] == sel_mrid)
+    if ind_sel.shape[0] == 0:
         return fig
 
     print('aab')
     print(plot_settings['flag_hide_legend'])
 
     trace = go.Scatter(
-        x=df_tmp[plot_params['xvar']],
-        y=df_tmp[plot_params['yvar']],
+        x=plot_data['x'][ind_sel],
+        y=plot_data['y'][ind_sel],
         mode="markers",
         name="Selected",
         marker=dict(
@@ -192,9 +262,10 @@ def add_trace_dot(
     )
     fig.add_trace(trace)
 
-def add_trace_centile(df: pd.DataFrame, plot_params: dict, plot_settings: dict, fig: Any) -> None:
+def add_trace_centile(cent_table: dict, plot_params: dict, plot_settings: dict, fig: Any) -> None:
     '''
     Add trace for centile curves
+    Curves of the selected roi are read from the centile table (see utils_stats)
     '''
     cvals = st.session_state.plot_settings['centile_trace_types']
 
@@ -214,22 +285,33 @@ def add_trace_centile(df: pd.DataFrame, plot_params: dict, plot_settings: dict,
     # c = colors[f'd{c_ind+1}']
     # c_txt = f'rgba({c[0]},{c[1]},{c[2]},{c[3]})'
 
+    # Centile curves are plotted against age
+    if plot_params['xvar'] != 'Age':
+        return fig
+
     # Get centile values for the selected roi
-    df_tmp = df[df.VarName == plot_params['yvar']]
+    vals_cent = utilstat.get_centile_curves(cent_table, plot_params['yvar'])
+    if vals_cent is None:
+        return fig
+    list_cent = cent_table['names']
 
     # Max centile value for normalization
     flag_norm = plot_params['flag_norm_centiles']
     
-    if flag_norm:
+    if flag_norm and 'centile_50' in list_cent:
         #norm_val = df_tmp[df_tmp.columns[df_tmp.columns.str.contains('centile')]].max().max()
-        norm_val = df_tmp['centile_50'].max()
+        norm_val = np.nanmax(vals_cent[:, list_cent.index('centile_50')])
+    else:
+        flag_norm = False
 
     # Create line traces
     list_tr = [s for s in plot_params['traces'] if "centile" in s]
     for i, cvar in enumerate(cvals):
         if cvar in plot_params['traces']:
-            if cvar in df_tmp.columns[2:]:
-                yvals = df_tmp[cvar]
+            if cvar in list_cent:
+                yvals = vals_cent[:, list_cent.index(cvar)]
+                is_valid = ~np.isnan(yvals)
+                yvals = yvals[is_valid]
                 if flag_norm:
                     yvals = yvals * 100 / norm_val
         
@@ -238,7 +320,7 @@ def add_trace_centile(df: pd.DataFrame, plot_params: dict, plot_settings: dict,
                 c_txt = f'rgba({c[0]},{c[1]},{c[2]},{alpha})'
 
                 ctrace = go.Scatter(
-                    x=df_tmp[plot_params['xvar']],
+                    x=cent_table['ages'][is_valid],
                     y=yvals,
                     mode="lines",
                     name=cvar,
@@ -0,0 +1,215 @@
+import csv
+import os
+from functools import lru_cache
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Readers of ROI tables shared by the workflows and the viewer (the derived
+# roi map of DLMUSE and centile tables, read once per file version)
+
+
+@lru_cache(maxsize=8)
+def read_derived_map(csv_roi_dict: str, mtime: int) -> dict:
+    """
+    Reads the derived roi map to roi codes, names, label lists and a sparse
+    (label x roi) matrix (mtime is used only to invalidate the cache)
+    """
+    list_codes, list_names, list_labels = [], [], []
+    with open(csv_roi_dict) as roi_map:
+        reader = csv.reader(roi_map, delimiter=",")
+        for row in reader:
+            list_codes.append(str(row[0]))
+            list_names.append(row[1])
+            list_labels.append([int(x) for x in row[2:] if x.strip() != ""])
+
+    # Sparse matrix with a column for each derived roi
+    ind_lbl = np.concatenate(list_labels).astype(int)
+    ind_roi = np.repeat(np.arange(len(list_codes)), [len(x) for x in list_labels])
+    mat_map = sparse.csc_matrix(
+        (np.ones(len(ind_lbl)), (ind_lbl, ind_roi)),
+        shape=(ind_lbl.max() + 1, len(list_codes)),
+    )
+
+    return {
+        "codes": list_codes,
+        "names": list_names,
+        "labels": list_labels,
+        "matrix": mat_map,
+    }
+
+
+def get_derived_map(csv_roi_dict: str) -> dict:
+    """
+    Returns the derived roi map (read once per file version)
+    """
+    return read_derived_map(csv_roi_dict, os.stat(csv_roi_dict).st_mtime_ns)
+
+
+def calc_derived_rois(
+    df_in: pd.DataFrame, derived_map: dict, roi_prefix: str = "MUSE_"
+) -> list:
+    """
+    Calculates derived roi volumes as a single product of the single roi
+    volumes with the derived roi matrix
+    Derived rois that are already in df_in are copied; rois with components
+    missing in df_in are skipped and returned with the list of missing labels
+    """
+    mat_map = derived_map["matrix"]
+    list_codes = [roi_prefix + x for x in derived_map["codes"]]
+
+    # Single rois in the data
+    list_lbl = [
+        int(x[len(roi_prefix) :])
+        for x in df_in.columns
+        if x.startswith(roi_prefix) and x[len(roi_prefix) :].isdigit()
+    ]
+    list_lbl = [x for x in list_lbl if x < mat_map.shape[0]]
+    is_avail = np.zeros(mat_map.shape[0], dtype=bool)
+    is_avail[list_lbl] = True
+
+    # Derived rois with missing components
+    is_in_data = np.isin(list_codes, df_in.columns)
+    num_missing = mat_map[~is_avail, :].getnnz(axis=0)
+    dict_missing = {
+        list_codes[i]: [x for x in derived_map["labels"][i] if not is_avail[x]]
+        for i in np.flatnonzero((num_missing > 0) & ~is_in_data)
+    }
+
+    # Calculate volumes (missing values are counted as 0, as in pandas sum)
+    vals = df_in[[roi_prefix + str(x) for x in list_lbl]].to_numpy(dtype=float)
+    vals = np.nan_to_num(vals)
+    vals_out = mat_map[list_lbl, :].T.dot(vals.T).T
+
+    df_out = pd.DataFrame(data=vals_out, columns=list_codes, index=df_in.index)
+    if is_in_data.any():
+        sel_codes = np.array(list_codes)[is_in_data].tolist()
+        df_out[sel_codes] = df_in[sel_codes]
+    df_out = df_out.drop(columns=list(dict_missing))
+
+    return [df_out, dict_missing]
+
+
+def prep_centile_array(df_cent: pd.DataFrame, sel_vars: list) -> Any:
+    """
+    Pivots the centile table into an (ROI x age x centile) array
+    Returns the sorted age bins, centile values and the array
+    """
+    cent = df_cent.columns[2:].str.replace("centile_", "").astype(int).values
+    ages = np.sort(df_cent.Age.unique())
+
+    # Keep the first row for each (ROI, age) pair, as in a row-by-row lookup
+    df_sel = df_cent[df_cent.VarName.isin(sel_vars)]
+    df_sel = df_sel.drop_duplicates(subset=["VarName", "Age"], keep="first")
+
+    arr_cent = np.full([len(sel_vars), len(ages), len(cent)], np.nan)
+    ind_var = pd.Index(sel_vars).get_indexer(df_sel.VarName)
+    ind_age = np.searchsorted(ages, df_sel.Age.values)
+    arr_cent[ind_var, ind_age, :] = df_sel.iloc[:, 2:].values.astype(float)
+
+    return ages, cent, arr_cent
+
+
+def make_centile_table(df_cent: pd.DataFrame) -> dict:
+    """
+    Creates a centile table with arrays indexed by ROI and age
+    The first column of the input is the ROI name (VarName or ROI)
+    """
+    df_cent = df_cent.rename(columns={df_cent.columns[0]: "VarName"})
+    list_rois = df_cent.VarName.unique().tolist()
+    ages, cent, arr_cent = prep_centile_array(df_cent, list_rois)
+
+    # Tables are shared (cached), so arrays are read only
+    for arr in [ages, cent, arr_cent]:
+        arr.flags.writeable = False
+
+    return {
+        "rois": list_rois,
+        "roi_index": {x: i for i, x in enumerate(list_rois)},
+        "ages": ages,
+        "centiles": cent,
+        "names": df_cent.columns[2:].tolist(),
+        "values": arr_cent,
+    }
+
+
+@lru_cache(maxsize=16)
+def read_centile_table(cent_csv: str, mtime: float) -> dict:
+    """
+    Reads a centile table
+    Tables are kept in memory, keyed by path and modification time
+    """
+    print(f"Loading centile table: {cent_csv}")
+    return make_centile_table(pd.read_csv(cent_csv))
+
+
+def get_centile_table(cent_csv: str) -> Any:
+    """
+    Returns the centile table (read once per file version), or None if the
+    file does not exist
+    """
+    try:
+        mtime = os.stat(cent_csv).st_mtime_ns
+    except OSError:
+        return None
+    return read_centile_table(cent_csv, mtime)
+
+
+def get_centile_curves(cent_table: dict, roi: str) -> Any:
+    """
+    Returns the centile curves of an ROI, an (age x centile) array, or None
+    if the ROI is not in the table
+    """
+    ind = cent_table["roi_index"].get(roi)
+    if ind is None:
+        return None
+    return cent_table["values"][ind]
+
+
+def interp_centiles(
+    vals_subj: np.ndarray, ind_age: np.ndarray, cent: np.ndarray, arr_cent: np.ndarray
+) -> np.ndarray:
+    """
+    Interpolates centile values for all subjects (rows) and ROIs (columns) at once
+    """
+    num_var, num_age, num_cent = arr_cent.shape
+
+    # Centile curve (row of the flattened table) used for each subject/ROI
+    ind_row = np.arange(num_var)[np.newaxis, :] * num_age + ind_age[:, np.newaxis]
+    vals_cent = arr_cent.reshape(-1, num_cent)
+    vmin = vals_cent[ind_row, 0]
+    vmax = vals_cent[ind_row, -1]
+
+    # Clip subject values to the centile range
+    sval = np.minimum(vmax, np.maximum(vmin, vals_subj))
+
+    # Map each curve to its own interval [2*row, 2*row+1] so that a single
+    # searchsorted over the flattened table finds the bin in every curve
+    vrange = (vals_cent[:, -1] - vals_cent[:, 0])[:, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grid = (vals_cent - vals_cent[:, [0]]) / vrange
+        grid = np.clip(np.nan_to_num(grid), 0, 1)
+        keys = (sval - vmin) / (vmax - vmin)
+        keys = np.clip(np.nan_to_num(keys), 0, 1)
+    offset = 2 * np.arange(vals_cent.shape[0])[:, np.newaxis]
+    grid = (grid + offset).ravel()
+    keys = keys + 2 * ind_row
+
+    # Find nearest x values
+    ind1 = np.searchsorted(grid, keys, side="left") - ind_row * num_cent - 1
+    ind1 = np.clip(ind1, 0, num_cent - 2)
+    ind2 = ind1 + 1
+    v1 = vals_cent[ind_row, ind1]
+    v2 = vals_cent[ind_row, ind2]
+
+    # Calculate slope and estimate subj centile
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (cent[ind2] - cent[ind1]) / (v2 - v1)
+        cent_subj = cent[ind1] + slope * (sval - v1)
+
+    # Keep missing values as missing
+    cent_subj[np.isnan(vals_subj) | np.isnan(vmin)] = np.nan
+
+    return cent_subj
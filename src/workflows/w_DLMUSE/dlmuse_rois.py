@@ -0,0 +1,108 @@
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+)
+import roi_tables as roitab
+
+csv_derived_default = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "w_sMRI",
+    "lists",
+    "list_MUSE_mapping_derived.csv",
+)
+
+
+def calc_roi_volumes(f_seg: str, mat_map: Any) -> np.ndarray:
+    """
+    Calculate the volumes of all rois in the map (a sparse label x roi matrix)
+    for a segmentation image
+    Voxels of each label are counted in a single pass
+    """
+    nii = nib.load(f_seg)
+    labels = np.asanyarray(nii.dataobj).astype(np.int64)
+    vox_vol = float(np.prod(nii.header.get_zooms()[:3]))
+
+    # Labels that are not in the map are ignored
+    counts = np.bincount(labels.ravel(), minlength=mat_map.shape[0])
+    counts = counts[: mat_map.shape[0]]
+
+    return mat_map.T.dot(counts) * vox_vol
+
+
+def dlmuse_rois(
+    in_dir: str,
+    in_suff: str,
+    out_csv: str,
+    csv_derived: Any = None,
+    num_workers: Any = None,
+) -> None:
+    if csv_derived is None:
+        csv_derived = csv_derived_default
+    pattern = os.path.join(in_dir, f"*{in_suff}")
+    sel_files = sorted(glob.glob(pattern, recursive=False))
+    if len(sel_files) == 0:
+        return
+
+    derived_map = roitab.get_derived_map(csv_derived)
+    list_codes, mat_map = derived_map["codes"], derived_map["matrix"].tocsr()
+    list_mrid = [os.path.basename(x).replace(in_suff, "") for x in sel_files]
+
+    # Calculate volumes in parallel
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = min(num_workers, len(sel_files))
+    list_maps = [mat_map] * len(sel_files)
+    if num_workers <= 1:
+        list_out = list(map(calc_roi_volumes, sel_files, list_maps))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list_out = list(
+                executor.map(
+                    calc_roi_volumes,
+                    sel_files,
+                    list_maps,
+                    chunksize=max(1, len(sel_files) // (4 * num_workers)),
+                )
+            )
+
+    df = pd.DataFrame(data=np.array(list_out), columns=list_codes)
+    df.insert(0, "MRID", list_mrid)
+    df.to_csv(out_csv, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in_dir", help="Provide the path to data", required=True)
+    parser.add_argument(
+        "--in_suff",
+        help="Provide the image suffix",
+        default="_T1_DLMUSE.nii.gz",
+    )
+    parser.add_argument("--out_csv", help="Provide the out csv name", required=True)
+    parser.add_argument(
+        "--csv_derived",
+        help="Provide the derived roi map (list_MUSE_mapping_derived.csv)",
+        default=None,
+    )
+    parser.add_argument(
+        "--num_workers", help="Provide the number of workers", type=int, default=None
+    )
+    options = parser.parse_args()
+
+    dlmuse_rois(
+        options.in_dir,
+        options.in_suff,
+        options.out_csv,
+        options.csv_derived,
+        options.num_workers,
+    )
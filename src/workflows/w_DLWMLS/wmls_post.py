@@ -1,24 +1,96 @@
 import argparse
 import glob
 import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
 
 import nibabel as nib
 import numpy as np
 import pandas as pd
 
 
-def wmls_post(in_dir, img_suff, out_csv):
+def calc_wml_vol(f_wmls: str, f_seg: Any = None) -> list:
+    """
+    Calculate the lesion volume in a DLWMLS mask and (optionally) the lesion
+    volume in each region of the matching DLMUSE segmentation
+    Returns [total volume, {region label: volume}]; regional volumes are None
+    if the segmentation is missing or not in the lesion mask space
+    """
+    # Read mask without converting to float (no scaling for label images)
+    nii = nib.load(f_wmls)
+    is_wml = np.asanyarray(nii.dataobj) > 0
+    vox_vol = float(np.prod(nii.header.get_zooms()[:3]))
+    wmlvol = vox_vol * np.count_nonzero(is_wml)
+
+    dict_roi = None
+    if f_seg is not None:
+        if not os.path.exists(f_seg):
+            print(f"Segmentation not found: {f_seg}")
+        else:
+            nii_seg = nib.load(f_seg)
+            if nii_seg.shape[:3] != is_wml.shape[:3] or not np.allclose(
+                nii_seg.affine, nii.affine, atol=1e-3
+            ):
+                print(f"Segmentation is not in lesion mask space: {f_seg}")
+            else:
+                # Count lesion voxels in each region in a single pass
+                labels = np.asanyarray(nii_seg.dataobj)[is_wml].astype(np.int64)
+                counts = np.bincount(labels)
+                dict_roi = {
+                    lbl: vox_vol * counts[lbl] for lbl in np.flatnonzero(counts)
+                }
+
+    return [wmlvol, dict_roi]
+
+
+def wmls_post(
+    in_dir: str,
+    img_suff: str,
+    out_csv: str,
+    seg_dir: Any = None,
+    seg_suff: str = "_T1_DLMUSE.nii.gz",
+    num_workers: Any = None,
+) -> None:
     pattern = os.path.join(in_dir, f"*{img_suff}")
-    sel_files = glob.glob(pattern, recursive=False)
-    df = pd.DataFrame(columns=["MRID", "WMLVol"])
-    for tmp_sel in sel_files:
-        nii = nib.load(tmp_sel)
-        data = nii.get_fdata().flatten()
-        wmlvol = np.prod(nii.header.get_zooms()) * sum(data > 0)
-        mrid = os.path.basename(tmp_sel).replace(img_suff, "")
-        df.loc[len(df)] = {"MRID": mrid, "WMLVol": wmlvol}
-    if df.shape[0] > 0:
-        df.to_csv(out_csv, index=False)
+    sel_files = sorted(glob.glob(pattern, recursive=False))
+    if len(sel_files) == 0:
+        return
+
+    list_mrid = [os.path.basename(x).replace(img_suff, "") for x in sel_files]
+    list_seg = [None] * len(sel_files)
+    if seg_dir is not None:
+        list_seg = [os.path.join(seg_dir, f"{x}{seg_suff}") for x in list_mrid]
+
+    # Calculate volumes in parallel
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = min(num_workers, len(sel_files))
+    if num_workers <= 1:
+        list_out = list(map(calc_wml_vol, sel_files, list_seg))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list_out = list(
+                executor.map(
+                    calc_wml_vol,
+                    sel_files,
+                    list_seg,
+                    chunksize=max(1, len(sel_files) // (4 * num_workers)),
+                )
+            )
+
+    df = pd.DataFrame({"MRID": list_mrid, "WMLVol": [x[0] for x in list_out]})
+
+    # Add regional volumes (0 for regions without lesions, NaN for subjects
+    # without a valid segmentation)
+    if seg_dir is not None:
+        flag_seg = np.array([x[1] is not None for x in list_out])
+        df_roi = pd.DataFrame([x[1] if x[1] is not None else {} for x in list_out])
+        df_roi.loc[flag_seg] = df_roi.loc[flag_seg].fillna(0)
+        df_roi = df_roi[sorted(df_roi.columns)]
+        df_roi.columns = [f"WMLVol_MUSE_{x}" for x in df_roi.columns]
+        df = pd.concat([df, df_roi], axis=1)
+
+    df.to_csv(out_csv, index=False)
 
 
 if __name__ == "__main__":
@@ -26,6 +98,26 @@ if __name__ == "__main__":
     parser.add_argument("--in_dir", help="Provide the path to data", required=True)
     parser.add_argument("--in_suff", help="Provide the image suffix", required=True)
     parser.add_argument("--out_csv", help="Provide the out csv name", required=True)
+    parser.add_argument(
+        "--seg_dir",
+        help="Provide the path to DLMUSE segmentations (for regional volumes)",
+        default=None,
+    )
+    parser.add_argument(
+        "--seg_suff",
+        help="Provide the DLMUSE segmentation suffix",
+        default="_T1_DLMUSE.nii.gz",
+    )
+    parser.add_argument(
+        "--num_workers", help="Provide the number of workers", type=int, default=None
+    )
     options = parser.parse_args()
 
-    wmls_post(options.in_dir, options.in_suff, options.out_csv)
+    wmls_post(
+        options.in_dir,
+        options.in_suff,
+        options.out_csv,
+        options.seg_dir,
+        options.seg_suff,
+        options.num_workers,
+    )
@@ -1,12 +1,64 @@
 # Import packages
-import csv as csv
+import glob
+import gzip
+import hashlib
 import os
+import pickle
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
+from importlib import metadata, util
 
 import numpy as np
 import pandas as pd
 import re
+from typing import Any
+
 from stqdm import stqdm
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+)
+import roi_tables as roitab
+
+# Formats for intermediate files and the columnar copy of the output
+table_formats = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+# Open writers (and table schemas) of columnar files appended in chunks
+table_writers: dict = {}
+
+# Params that do not change step results (not used in step cache keys)
+cache_skip_params = [
+    "dset_name",
+    "out_dir",
+    "out_wdir",
+    "tmp_dir",
+    "out_format",
+    "checkpoints",
+    "flag_checkpoint",
+    "flag_append",
+    "flag_cache",
+    "block_ind",
+    "model_combat",
+    "df_roidict",
+]
+
+# Packages used by the steps (versions are part of step cache keys)
+cache_packages = [
+    "spare_scores",
+    "NiChartHarmonize",
+    "scikit-learn",
+    "PredCRD",
+    "CCL_NMF_Prediction",
+]
+
+# Packages with models used by a step (model files are part of step cache keys)
+step_packages = {"sgan": "PredCRD", "cclnmf": "CCL_NMF_Prediction"}
+
+# Extensions of model files bundled in packages
+model_exts = (".pkl", ".gz", ".pt", ".pth", ".joblib", ".npz", ".npy", ".h5", ".json")
+
 
 def check_input(
     in_csv: str,
@@ -54,176 +106,348 @@ def combine_rois(
     """
     key_var = "MRID"
     roi_prefix = "MUSE_"
-    # Read derived roi map file to a dictionary
-    dict_roi = {}
-    with open(csv_roi_dict) as roi_map:
-        reader = csv.reader(roi_map, delimiter=",")
-        for row in reader:
-            key = roi_prefix + str(row[0])
-            val = [roi_prefix + str(x) for x in row[2:]]
-            dict_roi[key] = val
-
-    # Create derived roi df
-    label_names = list(dict_roi.keys())
-    df_out = df_in[[key_var]]
-    df_out = df_out.reindex(columns=[key_var] + label_names)
-
-    # Calculate volumes for derived rois
-    for i, key in enumerate(dict_roi):
-        key_vals = dict_roi[key]
-        try:
-            if key in df_in.columns:
-                df_out[key] = df_in[
-                    key
-                ]  # If ROI is already in df, do not calculate it from parts
-                print("WARNING:  Skip derived ROI, already in data: " + key)
-            else:
-                df_out[key] = df_in[key_vals].sum(
-                    axis=1
-                )  # If not, calculate it (sum of single ROIs in the dict)
-        except:
-            df_out = df_out.drop(columns=key)
-            print("WARNING:  Skip derived ROI with missing components: " + key)
+
+    # Calculate derived rois using the derived roi map
+    derived_map = roitab.get_derived_map(csv_roi_dict)
+    df_out, dict_missing = roitab.calc_derived_rois(df_in, derived_map, roi_prefix)
+    df_out = pd.concat([df_in[[key_var]], df_out], axis=1)
+
+    if len(dict_missing) > 0:
+        print(
+            "WARNING:  Skip derived ROIs with missing components: "
+            + ", ".join(f"{k} {v}" for k, v in dict_missing.items())
+        )
 
     return df_out
 
 
 def calc_subject_centiles(
-    df_in: pd.DataFrame, df_cent: pd.DataFrame, df_dict: pd.DataFrame
+    df_in: pd.DataFrame, cent_table: dict, df_dict: pd.DataFrame
 ) -> pd.DataFrame:
     """
     Calculates subject specific centile values
     """
     # Rename centiles roi names
     rdict = dict(zip(df_dict["Name"], df_dict["Code"]))
-    df_cent["VarName"] = df_cent["VarName"].replace(rdict)
-
-    cent = df_cent.columns[2:].str.replace("centile_", "").astype(int).values
+    list_rois = [rdict.get(x, x) for x in cent_table["rois"]]
 
     # Get age bin
+    ages = cent_table["ages"]
     df_in["Age"] = df_in.Age.round(0)
-    df_in.loc[df_in["Age"] > df_cent.Age.max(), "Age"] = df_cent.Age.max()
-    df_in.loc[df_in["Age"] < df_cent.Age.min(), "Age"] = df_cent.Age.min()
+    df_in.loc[df_in["Age"] > ages.max(), "Age"] = ages.max()
+    df_in.loc[df_in["Age"] < ages.min(), "Age"] = ages.min()
+
+    # Find ROIs (the first table entry of each renamed roi is used)
+    ind_roi = {}
+    for i, x in enumerate(list_rois):
+        ind_roi.setdefault(x, i)
+    sel_vars = df_in.columns[df_in.columns.isin(list(ind_roi))].tolist()
+
+    # Select centiles and find the age bin of each subject
+    arr_cent = cent_table["values"][[ind_roi[x] for x in sel_vars]]
+    ind_age = np.searchsorted(ages, df_in.Age.values)
+    ind_age = np.clip(ind_age, 0, len(ages) - 1)
+
+    # Find the centile value of each roi for all subjects
+    vals_subj = df_in[sel_vars].values.astype(float)
+    cent_subj_all = roitab.interp_centiles(
+        vals_subj, ind_age, cent_table["centiles"], arr_cent
+    )
 
-    # Find ROIs
-    sel_vars = df_in.columns[df_in.columns.isin(df_cent.VarName.unique())].tolist()
+    # Create and save output data
+    df_out = pd.DataFrame(columns=sel_vars, data=cent_subj_all)
+    df_out = pd.concat([df_in[["MRID"]], df_out], axis=1)
 
-    # For each subject find the centile value of each roi
-    cent_subj_all = np.zeros([df_in.shape[0], len(sel_vars)])
-    for i, tmp_ind in enumerate(df_in.index):
-        df_subj = df_in.loc[[tmp_ind]]
-        df_cent_sel = df_cent[df_cent.Age == df_subj.Age.values[0]]
+    return df_out
 
-        for j, tmp_var in enumerate(sel_vars):
-            # Get centile values
-            vals_cent = df_cent_sel[df_cent_sel.VarName == tmp_var].values[0][2:]
 
-            # Get subject value
-            sval = df_subj[tmp_var].values[0]
+def run_cmd(cmd: str, f_out: Any = None) -> None:
+    """
+    Runs an external command, raises an error if it fails
+    If f_out is set, a previous version of the output file is removed (some
+    tools do not overwrite it) and the command is checked to have created it.
+    """
+    if f_out is not None and os.path.exists(f_out):
+        os.remove(f_out)
+    print(f"About to run {cmd}")
+    ret = os.system(cmd)
+    if ret != 0:
+        raise RuntimeError(f"Command failed with exit status {ret}: {cmd}")
+    if f_out is not None and not os.path.exists(f_out):
+        raise RuntimeError(f"Command did not create output {f_out}: {cmd}")
+
+
+@lru_cache(maxsize=16)
+def load_spare_model(mdl_path: str, mtime: float) -> Any:
+    """
+    Loads a SPARE model
+    Models are kept in memory, keyed by path and modification time
+    """
+    # spare_scores is needed only for in-process scoring
+    from spare_scores.util import load_model
 
-            # Find nearest x values
-            sval = np.min([vals_cent[-1], np.max([vals_cent[0], sval])])
-            ind1 = np.where(sval <= vals_cent)[0][0] - 1
-            if ind1 == -1:
-                ind1 = 0
-            ind2 = ind1 + 1
+    print(f"Loading SPARE model: {mdl_path}")
+    return load_model(mdl_path)
 
-            # Calculate slope
-            slope = (cent[ind2] - cent[ind1]) / (vals_cent[ind2] - vals_cent[ind1])
 
-            # Estimate subj centile
-            cent_subj_all[i, j] = cent[ind1] + slope * (sval - vals_cent[ind1])
+def calc_spare_score(df: pd.DataFrame, mdl_path: str, spare_var: str) -> pd.DataFrame:
+    """
+    Applies a SPARE model to the data in-process
+    """
+    from spare_scores.spare import spare_test
 
-    # Create and save output data
-    df_out = pd.DataFrame(columns=sel_vars, data=cent_subj_all)
-    df_out = pd.concat([df_in[["MRID"]], df_out], axis=1)
+    mdl = load_spare_model(mdl_path, os.path.getmtime(mdl_path))
+    res = spare_test(df.copy(), mdl, key_var="MRID", spare_var=spare_var)
+    if res["status_code"] != 0:
+        raise RuntimeError(f"SPARE calculation failed ({mdl_path}): {res['status']}")
+    return res["data"]
 
-    return df_out
 
+@lru_cache(maxsize=4)
+def load_combat_model(mdl_path: str, mtime: float) -> Any:
+    """
+    Loads a COMBAT model (gzipped or plain pickle)
+    Models are kept in memory, keyed by path and modification time
+    """
+    print(f"Loading COMBAT model: {mdl_path}")
+    with open(mdl_path, "rb") as f:
+        flag_gzip = f.read(2) == b"\x1f\x8b"
+    f_open = gzip.open if flag_gzip else open
+    with f_open(mdl_path, "rb") as f:
+        return pickle.load(f)
+
+
+def harmonize_rois(
+    mat_rois: np.ndarray,
+    df_cov: pd.DataFrame,
+    list_vars: list,
+    mdl_path: str,
+) -> Any:
+    """
+    Applies a COMBAT model to a ROI matrix (subjects x ROIs) in-process
+    df_cov has the key, site and covariate columns for the rows of the matrix.
+    Returns the harmonized matrix (rows excluded by the model are set to NaN)
+    and the names of the harmonized variables.
+    """
+    # NiChartHarmonize is needed only for in-process harmonization
+    from NiChartHarmonize.nh_apply_model import nh_harmonize_to_ref
 
-def run_workflow(
+    mdl = load_combat_model(mdl_path, os.path.getmtime(mdl_path))
+
+    df_in = pd.concat(
+        [
+            df_cov.reset_index(drop=True),
+            pd.DataFrame(mat_rois, columns=list_vars),
+        ],
+        axis=1,
+    )
+
+    # Check that model variables are in the data
+    dict_vars = mdl["mdl_ref"]["dict_vars"]
+    list_harm = dict_vars["data_vars"]
+    missing_vars = [
+        x for x in dict_vars["cov_columns"] + list_harm if x not in df_in.columns
+    ]
+    if len(missing_vars) > 0:
+        raise ValueError(f"Data does not match COMBAT model, missing: {missing_vars}")
+
+    # Apply model (the cached model is copied, not updated, by the call)
+    _, df_out = nh_harmonize_to_ref(df_in, mdl)
+
+    # Rows are indexed by their position in the input
+    mat_out = np.full([df_in.shape[0], len(list_harm)], np.nan)
+    mat_out[df_out.index.values, :] = df_out[
+        [f"{x}_HARM" for x in list_harm]
+    ].values.astype(float)
+    return mat_out, list_harm
+
+
+def init_params(
     dset_name: str,
     bdir: str,
-    in_csv: str,
-    in_demog: str,
     out_dir: str,
-) -> None:
-    # Fixed params
-    key_var = "MRID"
-    min_age = 50
-    max_age = 95
-    suff_combat = "_HARM"
-    spare_types = [
-        "AD",
-        "Age",
-        "Hypertension",
-        "Diabetes",
-        "Hyperlipidemia",
-        "Obesity",
-        "Smoking",
-    ]
-    icv_ref_val = 1430000
-    cent_csv = os.path.join(
-        bdir, "resources", "centiles", "istag_centiles_CN_ICV_Corrected.csv"
-    )
-    csv_muse_all = os.path.join(
-        bdir, "src", "workflows", "w_sMRI", "lists", "list_MUSE_all.csv"
-    )
-    csv_muse_single = os.path.join(
-        bdir, "src", "workflows", "w_sMRI", "lists", "list_MUSE_single.csv"
-    )
-    csv_muse_derived = os.path.join(
-        bdir, "src", "workflows", "w_sMRI", "lists", "list_MUSE_mapping_derived.csv"
-    )
-    model_combat = os.path.join(
-        bdir,
-        "src",
-        "workflows",
-        "w_sMRI",
-        "models",
-        "vISTAG1",
-        "COMBAT",
-        "combined_DLMUSE_raw_COMBATModel.pkl.gz",
-    )
-    spare_dir = os.path.join(
-        bdir, "src", "workflows", "w_sMRI", "models", "vISTAG1", "SPARE"
-    )
-    spare_pref = "combined_DLMUSE_raw_COMBAT_SPARE-"
-    spare_suff = "_Model.pkl.gz"
+    flag_harmonize: bool,
+    out_format: str = "csv",
+) -> dict:
+    """
+    Sets fixed workflow parameters and paths
+    """
+    if out_format not in table_formats:
+        raise ValueError(f"Unknown file format: {out_format}")
+    ext = table_formats[out_format]
+    w_dir = os.path.join(bdir, "src", "workflows", "w_sMRI")
+    params = {
+        "dset_name": dset_name,
+        "flag_harmonize": flag_harmonize,
+        "key_var": "MRID",
+        "min_age": 50,
+        "max_age": 95,
+        "suff_combat": "_HARM",
+        "spare_types": ["AD", "Age"],
+        "icv_ref_val": 1430000,
+        "cent_csv": os.path.join(
+            bdir, "resources", "centiles", "istag_centiles_CN_ICV_Corrected.csv"
+        ),
+        "csv_muse_all": os.path.join(w_dir, "lists", "list_MUSE_all.csv"),
+        "csv_muse_single": os.path.join(w_dir, "lists", "list_MUSE_single.csv"),
+        "csv_muse_derived": os.path.join(
+            w_dir, "lists", "list_MUSE_mapping_derived.csv"
+        ),
+        "model_combat": os.path.join(
+            w_dir,
+            "models",
+            "vISTAG1",
+            "COMBAT",
+            "combined_DLMUSE_raw_COMBATModel.pkl.gz",
+        ),
+        "spare_dir": os.path.join(w_dir, "models", "vISTAG1", "SPARE"),
+        "spare_pref": "combined_DLMUSE_raw_COMBAT_SPARE-",
+        "spare_suff": "_Model.pkl.gz",
+        "out_format": out_format,
+        "out_dir": out_dir,
+        "out_wdir": os.path.join(out_dir, "working_dir"),
+    }
+    if flag_harmonize:
+        params["spare_types"] = [
+            "AD",
+            "Age",
+            "Hypertension",
+            "Diabetes",
+            "Hyperlipidemia",
+            "Obesity",
+            "Smoking",
+        ]
+
+    # Names of checkpoint files for each intermediate result
+    pref = "_combat" if flag_harmonize else ""
+    params["checkpoints"] = {
+        "rois": f"_rois_init{ext}",
+        "combat": f"_combat{ext}",
+        "icvcorr": f"{pref}_icvcorr{ext}",
+        "centiles": f"{pref}_icvcorr_centiles{ext}",
+        "spare": f"{pref}_spare-all{ext}",
+        "sgan": f"_sgan{ext}",
+        "cclnmf": f"_cclnmf{ext}",
+    }
+    return params
+
+
+def prep_input(params: dict, df: pd.DataFrame, df_demog: pd.DataFrame) -> dict:
+    """
+    Merges a block of input data with demographics into initial workflow data
+    """
+    df.columns = df.columns.astype(str)
 
-    # Print args
-    print(
-        f"About to run: run_workflow {dset_name} {bdir} {in_csv} {in_demog} {out_dir}"
+    # Rename ROIs
+    vdict = params["df_roidict"].set_index("Index")["Code"].to_dict()
+    df = df.rename(columns=vdict)
+
+    # Keep DLICV in a separate df
+    df_icv = df[["MRID", "MUSE_702"]]
+    df_icv.columns = ["MRID", "DLICV"]
+    df = df.drop(columns=["MUSE_702"])
+
+    # Add DLICV to demog
+    df_demog = df_demog.merge(df_icv, on="MRID")
+
+    # Add covars
+    df_raw = df_demog.merge(df, on=params["key_var"])
+
+    return {"demog": df_demog, "rois": df_raw}
+
+
+def read_input(params: dict, in_csv: str, in_demog: str, chunk_size: int = 0) -> Any:
+    """
+    Reads roi lists and input data, and yields initial workflow data
+    With chunk_size > 0, the data file is read in blocks of chunk_size rows
+    (demographics, with a few columns per subject, are read at once).
+    """
+    # Read roi lists
+    df_tmp = pd.read_csv(params["csv_muse_single"])
+    params["list_muse_single"] = df_tmp.Code.tolist()
+    df_roidict = pd.read_csv(params["csv_muse_all"])
+    df_roidict.Index = df_roidict.Index.astype(str)
+    params["df_roidict"] = df_roidict
+
+    # Read data
+    df_demog = pd.read_csv(in_demog, dtype={"MRID": str})
+    if chunk_size <= 0:
+        df = pd.read_csv(in_csv, dtype={"MRID": str})
+        yield prep_input(params, df, df_demog)
+        return
+
+    with pd.read_csv(in_csv, dtype={"MRID": str}, chunksize=chunk_size) as reader:
+        for df in reader:
+            yield prep_input(params, df, df_demog)
+
+
+def get_new_sites(params: dict, in_demog: str) -> list:
+    """
+    Returns sites in the demographics file that are not in the COMBAT model
+    """
+    mdl_combat = params["model_combat"]
+    mdl = load_combat_model(mdl_combat, os.path.getmtime(mdl_combat))
+    site_var = mdl["mdl_ref"]["dict_vars"]["batch_var"]
+    df_demog = pd.read_csv(in_demog)
+    if site_var not in df_demog.columns:
+        df_demog[site_var] = "SITE1"
+    mdl_sites = set(mdl["mdl_batches"]["batch_values"])
+    return sorted(
+        str(x) for x in df_demog[site_var].dropna().unique() if x not in mdl_sites
     )
 
-    def step_combat() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
 
-        # Check SITE column
-        if "SITE" not in df_in.columns:
-            df_in["SITE"] = "SITE1"
+def select_age_range(params: dict, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Selects subjects with age in the range of the COMBAT model
+    """
+    return df[(df["Age"] > params["min_age"]) & (df["Age"] < params["max_age"])]
 
-        # Select variables for harmonization
-        muse_vars = df_in.columns[df_in.columns.str.contains("MUSE")].tolist()
-        other_vars = ["MRID", "Age", "Sex", "SITE", "DLICV"]
-        df_out = df_in[other_vars + muse_vars]
 
-        # Check that sample has age range consistent with the model
-        df_out = df_out[df_out["Age"] > min_age]
-        df_out = df_out[df_out["Age"] < max_age]
+def step_combat(params: dict, data: dict) -> dict:
+    """
+    Applies COMBAT harmonization to the input ROIs
+    """
+    key_var = params["key_var"]
+    suff_combat = params["suff_combat"]
+    dset_name = params["dset_name"]
+    tmp_dir = params["tmp_dir"]
+    df_in = data["rois"].copy()
+
+    # Check SITE column
+    if "SITE" not in df_in.columns:
+        df_in["SITE"] = "SITE1"
+
+    # Select variables for harmonization
+    muse_vars = df_in.columns[df_in.columns.str.contains("MUSE")].tolist()
+    other_vars = ["MRID", "Age", "Sex", "SITE", "DLICV"]
+    df_out = df_in[other_vars + muse_vars]
+
+    # Check that sample has age range consistent with the model
+    df_out = select_age_range(params, df_out)
+
+    mdl_combat = params["model_combat"]
+    if params["flag_inproc"]:
+        # Apply combat in-process
+        mat_harm, list_harm = harmonize_rois(
+            df_out[muse_vars].values,
+            df_out[other_vars],
+            muse_vars,
+            mdl_combat,
+        )
+        df_combat = pd.DataFrame(data=mat_harm, columns=list_harm)
+        df_combat.insert(0, key_var, df_out[key_var].values)
+        df_combat = df_combat.dropna(subset=list_harm, how="all")
 
+    else:
         # Save combat input
-        f_combat_in = os.path.join(out_wdir, f"{dset_name}_combat_in.csv")
+        f_combat_in = os.path.join(tmp_dir, f"{dset_name}_combat_in.csv")
         df_out.to_csv(f_combat_in, index=False)
 
         # Apply combat
-        mdl_combat = os.path.join("src", "workflow", model_combat)
-        f_combat_out = os.path.join(out_wdir, f"{dset_name}_combat_init.csv")
-        os.system(
-            f"neuroharm -a apply -i {f_combat_in} -m {mdl_combat} -u {f_combat_out}"
-        )
+        f_combat_out = os.path.join(tmp_dir, f"{dset_name}_combat_init.csv")
+        cmd = f"neuroharm -a apply -i {f_combat_in} -m {mdl_combat} -u {f_combat_out}"
+        run_cmd(cmd, f_combat_out)
 
         # Edit combat output (remove non mri columns and suffix combat)
         df_combat = pd.read_csv(f_combat_out, dtype={"MRID": str})
@@ -234,452 +458,784 @@ def run_workflow(
         df_combat = df_combat[sel_vars]
         df_combat.columns = df_combat.columns.str.replace(suff_combat, "")
 
-        # Add derived rois
-        df_combat = combine_rois(df_combat, csv_muse_derived)
-
-        # Merge covars to harmonized ROIs
-        df_combat = df_demog.merge(df_combat, on=key_var)
-
-        # Change DLICV to ICV
-        df_combat = df_combat.rename(columns={"DLICV": "ICV"})
-
-        # Write out file
-        f_combat_out = os.path.join(out_wdir, f"{dset_name}_combat.csv")
-        df_combat.to_csv(f_combat_out, index=False)
-
-    def step_centiles() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_combat.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
-
-        # Normalize ROIs
-        df_icvcorr = df_in.copy()
-        var_muse = df_icvcorr.columns[df_icvcorr.columns.str.contains("MUSE")]
-        df_tmp = df_icvcorr[var_muse]
-        df_tmp = df_tmp.div(df_in["ICV"], axis=0) * icv_ref_val
-        # df_tmp=df_tmp.div(df_icvcorr['ICV'], axis=0) * 100
-        df_icvcorr[var_muse] = df_tmp.values
-
-        # Calculate centiles
-        df_cent = pd.read_csv(cent_csv)
-        df_centiles = calc_subject_centiles(df_icvcorr, df_cent, df_roidict)
-
-        # Write out files
-        f_icvcorr = os.path.join(out_wdir, f"{dset_name}_combat_icvcorr.csv")
-        df_icvcorr.to_csv(f_icvcorr, index=False)
-        f_centiles = os.path.join(out_wdir, f"{dset_name}_combat_icvcorr_centiles.csv")
-        df_centiles.to_csv(f_centiles, index=False)
-
-    def step_spare() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_combat.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
-
-        df_modified = df_in.rename(columns=lambda x: x[5:] if x.startswith('MUSE_') else x)
-        df_modified = df_modified.rename(columns={"ICV": "702"})
-        alt_f_in = os.path.join(out_wdir, f"{dset_name}_combat_alt.csv")
-        df_modified.to_csv(alt_f_in, index=False)
-
-        # Apply spare
-        df_spare = df_in[["MRID"]]
-        for spare_type in spare_types:
-            spare_mdl = os.path.join(spare_dir, f"{spare_pref}{spare_type}{spare_suff}")
-            f_spare_out = os.path.join(
-                out_wdir, f"{dset_name}_combat_spare_{spare_type}.csv"
-            )
+    # Add derived rois
+    df_combat = combine_rois(df_combat, params["csv_muse_derived"])
+
+    # Merge covars to harmonized ROIs
+    df_combat = data["demog"].merge(df_combat, on=key_var)
+
+    # Change DLICV to ICV
+    df_combat = df_combat.rename(columns={"DLICV": "ICV"})
+
+    return {"combat": df_combat}
+
+
+def step_centiles(params: dict, data: dict) -> dict:
+    """
+    Calculates ICV corrected ROIs and their centile values
+    """
+    if params["flag_harmonize"]:
+        df_in = data["combat"]
+        icv_var = "ICV"
+    else:
+        df_in = data["rois"]
+        icv_var = "DLICV"
+
+    # Normalize ROIs
+    df_icvcorr = df_in.copy()
+    var_muse = df_icvcorr.columns[df_icvcorr.columns.str.contains("MUSE")]
+    df_tmp = df_icvcorr[var_muse]
+    df_tmp = df_tmp.div(df_in[icv_var], axis=0) * params["icv_ref_val"]
+    df_icvcorr[var_muse] = df_tmp.values
+
+    # Calculate centiles
+    cent_table = roitab.get_centile_table(params["cent_csv"])
+    if cent_table is None:
+        raise FileNotFoundError(f"Centile table not found: {params['cent_csv']}")
+    df_centiles = calc_subject_centiles(df_icvcorr, cent_table, params["df_roidict"])
+
+    return {"icvcorr": df_icvcorr, "centiles": df_centiles}
+
+
+def get_spare_model_path(params: dict, spare_type: str) -> str:
+    """
+    Returns the path to the SPARE model of the given type
+    """
+    return os.path.join(
+        params["spare_dir"],
+        f"{params['spare_pref']}{spare_type}{params['spare_suff']}",
+    )
+
+
+def step_spare(params: dict, data: dict) -> dict:
+    """
+    Calculates SPARE scores
+    """
+    dset_name = params["dset_name"]
+    tmp_dir = params["tmp_dir"]
+    if params["flag_harmonize"]:
+        df_in = data["combat"]
+        pref = "_combat"
+    else:
+        df_in = data["rois"]
+        pref = ""
+
+    df_modified = df_in.rename(columns=lambda x: x[5:] if x.startswith("MUSE_") else x)
+    df_modified = df_modified.rename(columns={"ICV": "702"})
+
+    # Apply spare in-process
+    df_spare = df_in[["MRID"]]
+    if params["flag_inproc"]:
+        for spare_type in params["spare_types"]:
+            spare_mdl = get_spare_model_path(params, spare_type)
+            spare_var = f"SPARE{spare_type}"
             if spare_type in ["AD", "Age"]:
-                os.system(f"spare_score -a test -i {alt_f_in} -m {spare_mdl} -o {f_spare_out}")
+                df = calc_spare_score(df_modified, spare_mdl, spare_var)
             else:
-                os.system(f"spare_score -a test -i {f_in} -m {spare_mdl} -o {f_spare_out}")
-
-            # Change column name for the spare output
-            df = pd.read_csv(f_spare_out)
-            df = df[df.columns[0:2]]
-            df.columns = ["MRID", f"SPARE{spare_type}"]
+                df = calc_spare_score(df_in, spare_mdl, spare_var)
             df_spare = df_spare.merge(df)
+        return {"spare": df_spare}
+
+    # Save input files
+    f_in = os.path.join(tmp_dir, f"{dset_name}{pref}_spare_in.csv")
+    df_in.to_csv(f_in, index=False)
+    alt_f_in = os.path.join(tmp_dir, f"{dset_name}_combat_alt.csv")
+    df_modified.to_csv(alt_f_in, index=False)
+
+    # Apply spare
+    for spare_type in params["spare_types"]:
+        spare_mdl = get_spare_model_path(params, spare_type)
+        f_spare_out = os.path.join(tmp_dir, f"{dset_name}{pref}_spare_{spare_type}.csv")
+        if spare_type in ["AD", "Age"]:
+            run_cmd(
+                f"spare_score -a test -i {alt_f_in} -m {spare_mdl} -kv MRID -o {f_spare_out}",
+                f_spare_out,
+            )
+        else:
+            run_cmd(
+                f"spare_score -a test -i {f_in} -m {spare_mdl} -kv MRID -o {f_spare_out}",
+                f_spare_out,
+            )
 
-        # Write out file with all spare scores
-        f_spare_out = os.path.join(out_wdir, f"{dset_name}_combat_spare-all.csv")
-        df_spare.to_csv(f_spare_out, index=False)
-
-    def step_sgan() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
-
-        # Select input
-        sel_covars = ["MRID", "Age", "Sex", "DLICV"]
-        sel_vars = sel_covars + list_muse_single
-        df_sel = df_in[sel_vars]
-        f_sgan_in = os.path.join(out_wdir, f"{dset_name}_sgan_in.csv")
-        df_sel.to_csv(f_sgan_in, index=False)
-
-        # Run prediction
-        f_sgan_out = os.path.join(out_wdir, f"{dset_name}_sgan_init.csv")
-        cmd = f"PredCRD -i {f_sgan_in} -o {f_sgan_out}"
-        print(f"About to run {cmd}")
-        os.system(cmd)
-
-        # Edit columns
-        df_sgan = pd.read_csv(f_sgan_out)
-        df_sgan.columns = ["MRID"] + df_sgan.add_prefix("SurrealGAN_").columns[
-            1:
-        ].tolist()
-        f_sgan = os.path.join(out_wdir, f"{dset_name}_sgan.csv")
-        df_sgan.to_csv(f_sgan, index=False)
-
-    def step_cclnmf() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
-
-        # Select input
-        sel_demog_vars = ["MRID", "Age", "Sex"]
-        sel_vars = ["MRID"] + list_muse_single + ["DLICV"]
-        df_sel = df_in[sel_vars].rename(columns={"DLICV": "702"}) # Needed for CCL_NMF_Prediction
-        df_sel = df_sel.rename(columns=lambda x: x[5:] if x.startswith('MUSE_') else x)
-        df_demog_sel = df_in[sel_demog_vars]
-        f_cclnmf_in = os.path.join(out_wdir, f"{dset_name}_cclnmf_in.csv")
-        df_sel.to_csv(f_cclnmf_in, index=False)
-        f_cclnmf_demog_in = os.path.join(out_wdir, f"{dset_name}_cclnmf_demographics.csv")
-        df_demog_sel.to_csv(f_cclnmf_demog_in, index=False)
-
-        # Run prediction
-        f_cclnmf_out = os.path.join(out_wdir, f"{dset_name}_cclnmf_init.csv")
-        cmd = f"ccl_nmf_prediction -i {f_cclnmf_in} -d {f_cclnmf_demog_in} -o {f_cclnmf_out}"
-        print(f"About to run {cmd}")
-        os.system(cmd)
-
-        # Edit columns
-        df_cclnmf = pd.read_csv(f_cclnmf_out)
-        df_cclnmf.rename(columns={
+        # Change column name for the spare output
+        df = pd.read_csv(f_spare_out, dtype={"MRID": str})
+        df = df[df.columns[0:2]]
+        df.columns = ["MRID", f"SPARE{spare_type}"]
+        df_spare = df_spare.merge(df)
+
+    return {"spare": df_spare}
+
+
+def get_single_roi_vars(params: dict) -> list:
+    """
+    Returns input variables for SurrealGAN and CCL-NMF (covars + single ROIs)
+    """
+    return ["MRID", "Age", "Sex", "DLICV"] + params["list_muse_single"]
+
+
+def step_sgan(params: dict, data: dict) -> dict:
+    """
+    Calculates SurrealGAN indices
+    """
+    dset_name = params["dset_name"]
+    tmp_dir = params["tmp_dir"]
+    df_in = data["rois"]
+
+    # Select input
+    df_sel = df_in[get_single_roi_vars(params)]
+    f_sgan_in = os.path.join(tmp_dir, f"{dset_name}_sgan_in.csv")
+    df_sel.to_csv(f_sgan_in, index=False)
+
+    # Run prediction
+    f_sgan_out = os.path.join(tmp_dir, f"{dset_name}_sgan_init.csv")
+    cmd = f"PredCRD -i {f_sgan_in} -o {f_sgan_out}"
+    run_cmd(cmd, f_sgan_out)
+
+    # Edit columns
+    df_sgan = pd.read_csv(f_sgan_out, dtype={"MRID": str})
+    df_sgan.columns = ["MRID"] + df_sgan.add_prefix("SurrealGAN_").columns[1:].tolist()
+
+    return {"sgan": df_sgan}
+
+
+def step_cclnmf(params: dict, data: dict) -> dict:
+    """
+    Calculates CCL-NMF components
+    """
+    dset_name = params["dset_name"]
+    tmp_dir = params["tmp_dir"]
+    df_in = data["rois"]
+
+    # Select input
+    sel_demog_vars = ["MRID", "Age", "Sex"]
+    sel_vars = ["MRID"] + params["list_muse_single"] + ["DLICV"]
+    df_sel = df_in[sel_vars].rename(
+        columns={"DLICV": "702"}
+    )  # Needed for CCL_NMF_Prediction
+    df_sel = df_sel.rename(columns=lambda x: x[5:] if x.startswith("MUSE_") else x)
+    df_demog_sel = df_in[sel_demog_vars]
+    f_cclnmf_in = os.path.join(tmp_dir, f"{dset_name}_cclnmf_in.csv")
+    df_sel.to_csv(f_cclnmf_in, index=False)
+    f_cclnmf_demog_in = os.path.join(tmp_dir, f"{dset_name}_cclnmf_demographics.csv")
+    df_demog_sel.to_csv(f_cclnmf_demog_in, index=False)
+
+    # Run prediction
+    f_cclnmf_out = os.path.join(tmp_dir, f"{dset_name}_cclnmf_init.csv")
+    cmd = (
+        f"ccl_nmf_prediction -i {f_cclnmf_in} -d {f_cclnmf_demog_in} -o {f_cclnmf_out}"
+    )
+    run_cmd(cmd, f_cclnmf_out)
+
+    # Edit columns
+    df_cclnmf = pd.read_csv(f_cclnmf_out, dtype={"MRID": str})
+    df_cclnmf = df_cclnmf.rename(
+        columns={
             col: re.sub(r"CCL_NMF_(\d+)", r"CCL-NMF\1", col)
-            for col in df.columns
-        }, inplace=True)
+            for col in df_cclnmf.columns
+        }
+    )
 
-        # Export to csv
-        f_cclnmf = os.path.join(out_wdir, f"{dset_name}_cclnmf.csv")
-        df_cclnmf.to_csv(f_cclnmf, index=False)
+    return {"cclnmf": df_cclnmf}
 
-    # Make out dir
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    out_wdir = os.path.join(out_dir, "working_dir")
-    if not os.path.exists(out_wdir):
-        os.makedirs(out_wdir)
 
-    # Read roi lists
-    df_tmp = pd.read_csv(csv_muse_single)
-    list_muse_single = df_tmp.Code.tolist()
+def get_steps(flag_harmonize: bool) -> dict:
+    """
+    Returns workflow steps with the data each step depends on
+    For steps that read only some columns of their input, "cols" returns
+    these columns (only they are used in the cache key of the step)
+    """
+    base = "combat" if flag_harmonize else "rois"
+    steps = {
+        "combat": {"func": step_combat, "deps": ["rois", "demog"]},
+        "centiles": {"func": step_centiles, "deps": [base]},
+        "spare": {"func": step_spare, "deps": [base]},
+        "sgan": {"func": step_sgan, "deps": ["rois"], "cols": get_single_roi_vars},
+        "cclnmf": {
+            "func": step_cclnmf,
+            "deps": ["rois"],
+            "cols": get_single_roi_vars,
+        },
+    }
+    if not flag_harmonize:
+        del steps["combat"]
+    return steps
+
+
+def write_table(df: pd.DataFrame, f_out: str, flag_append: bool = False) -> None:
+    """
+    Writes a dataframe to a csv, parquet or feather file (by file extension),
+    or appends its rows to the file. Appended columns are aligned to the
+    columns of the existing file. Columnar files stay open for appending
+    until close_tables() is called.
+    """
+    ext = os.path.splitext(f_out)[1]
+    if ext == ".csv":
+        if not flag_append:
+            df.to_csv(f_out, index=False)
+            return
+        out_cols = pd.read_csv(f_out, nrows=0).columns
+        df = df.reindex(columns=out_cols)
+        df.to_csv(f_out, mode="a", header=False, index=False)
+        return
+
+    # pyarrow is needed only for columnar formats
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if flag_append:
+        writer, schema = table_writers[f_out]
+        writer.write_table(get_arrow_table(df, schema))
+        return
+
+    close_tables([f_out])
+    schema = get_table_schema(df)
+    if ext == ".parquet":
+        writer = pq.ParquetWriter(f_out, schema)
+    else:
+        writer = pa.ipc.new_file(f_out, schema)
+    writer.write_table(get_arrow_table(df, schema))
+    table_writers[f_out] = (writer, schema)
+
+
+def get_table_schema(df: pd.DataFrame) -> Any:
+    """
+    Returns the schema of a columnar file that a dataframe and later blocks of
+    the same table are written to. Text (object) columns are stored as strings,
+    as their type can not be inferred from a block with all values missing.
+    """
+    import pyarrow as pa
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    list_fields = [
+        (
+            pa.field(x.name, pa.string())
+            if df[x.name].dtype == object or pa.types.is_null(x.type)
+            else x
+        )
+        for x in schema
+    ]
+    return pa.schema(list_fields)
 
-    # Read data
-    df = pd.read_csv(in_csv, dtype={"MRID": str})
-    df.columns = df.columns.astype(str)
 
-    # Rename ROIs
-    df_roidict = pd.read_csv(csv_muse_all)
-    df_roidict.Index = df_roidict.Index.astype(str)
-    vdict = df_roidict.set_index("Index")["Code"].to_dict()
-    df = df.rename(columns=vdict)
+def get_arrow_table(df: pd.DataFrame, schema: Any) -> Any:
+    """
+    Converts a dataframe to an arrow table with the given schema (columns are
+    aligned to the schema, and string columns are cast to text)
+    """
+    import pyarrow as pa
 
-    # Keep DLICV in a separate df
-    df_icv = df[["MRID", "MUSE_702"]]
-    df_icv.columns = ["MRID", "DLICV"]
-    df = df.drop(columns=["MUSE_702"])
+    df = df.reindex(columns=schema.names)
+    str_cols = [x.name for x in schema if pa.types.is_string(x.type)]
+    df = df.astype({x: "string" for x in str_cols})
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
 
-    # Add DLICV to demog
-    df_demog = pd.read_csv(in_demog, dtype={"MRID": str})
-    df_demog = df_demog.merge(df_icv, on="MRID")
 
-    # Add covars
-    df_raw = df_demog.merge(df, on=key_var)
-    f_raw = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-    df_raw.to_csv(f_raw, index=False)
-
-    list_func = [step_combat, step_centiles, step_spare, step_sgan, step_cclnmf]
-    # list_fnames = [
-    # "COMBAT harmonization",
-    # "Centile calculation",
-    # "SPARE index calculation",
-    # "SurrealGAN index calculation",
-    # "CCL_NMF calculation",
-    # ]
-
-    for i, sel_func in stqdm(
-        enumerate(list_func),
-        desc="Running step ...",
-        total=len(list_func),
-    ):
-        sel_func()
-
-    # Combine results
+def get_tmp_table_file(f_out: str) -> str:
+    """
+    Returns the name of the temp file that a table is written to before it
+    replaces f_out (in the same folder and with the same extension)
+    """
+    return os.path.join(
+        os.path.dirname(f_out), f".{os.getpid()}.{os.path.basename(f_out)}"
+    )
+
+
+def close_tables(list_files: Any = None) -> None:
+    """
+    Closes open columnar files (all files if list_files is not set)
+    """
+    if list_files is None:
+        list_files = list(table_writers)
+    for f_out in list_files:
+        if f_out in table_writers:
+            table_writers.pop(f_out)[0].close()
+
+
+def save_checkpoint(params: dict, data: dict, list_names: list) -> None:
+    """
+    Writes intermediate results to the working dir
+    In chunked runs, results of later chunks are appended.
+    """
+    if not params["flag_checkpoint"]:
+        return
+    for sel_name in list_names:
+        if sel_name not in params["checkpoints"]:
+            continue
+        f_out = os.path.join(
+            params["out_wdir"],
+            f"{params['dset_name']}{params['checkpoints'][sel_name]}",
+        )
+        write_table(data[sel_name], f_out, params.get("flag_append", False))
+
+
+def get_step_files(params: dict, sel_step: str) -> list:
+    """
+    Returns model and list files used by a step
+    """
+    if sel_step == "combat":
+        return [params["model_combat"], params["csv_muse_derived"]]
+    if sel_step == "centiles":
+        return [params["cent_csv"]]
+    if sel_step == "spare":
+        return [get_spare_model_path(params, x) for x in params["spare_types"]]
+    if sel_step in step_packages:
+        return get_package_files(step_packages[sel_step])
+    return []
+
+
+@lru_cache(maxsize=None)
+def get_package_files(pkg: str) -> list:
+    """
+    Returns model files bundled in an installed package (files with model
+    extensions in the folders of its modules)
+    """
+    list_mods = [pkg]
+    try:
+        dict_dists = metadata.packages_distributions()
+        list_mods += [k for k, v in dict_dists.items() if pkg in v]
+    except Exception:
+        pass
+
+    list_files = []
+    for mod in sorted(set(list_mods)):
+        try:
+            spec = util.find_spec(mod)
+        except Exception:
+            continue
+        if spec is None or spec.submodule_search_locations is None:
+            continue
+        for mod_dir in spec.submodule_search_locations:
+            for root, _, files in os.walk(mod_dir):
+                list_files += [
+                    os.path.join(root, x) for x in files if x.endswith(model_exts)
+                ]
+    return sorted(set(list_files))
+
+
+@lru_cache(maxsize=1)
+def get_code_hash() -> str:
+    """
+    Returns a hash of this module and of the shared roi tables module, so that
+    code changes invalidate the cache
+    """
+    hsh = hashlib.sha256()
+    for f_code in [__file__, roitab.__file__]:
+        with open(f_code, "rb") as f:
+            hsh.update(f.read())
+    return hsh.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def get_package_versions() -> str:
+    """
+    Returns versions of the packages used to apply the models (and of the
+    external tools they install), so that upgrades invalidate the cache
+    """
+    list_vers = []
+    for pkg in cache_packages:
+        try:
+            list_vers.append(f"{pkg}=={metadata.version(pkg)}")
+        except metadata.PackageNotFoundError:
+            list_vers.append(f"{pkg} missing")
+    return " ".join(list_vers)
+
+
+def hash_df(hsh: Any, df: pd.DataFrame) -> None:
+    """
+    Adds the columns, types and values of a dataframe to a hash
+    """
+    hsh.update(repr(list(zip(df.columns, df.dtypes.astype(str)))).encode())
+    hsh.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+
+def get_step_key(params: dict, sel_step: str, step: dict, data: dict) -> Any:
+    """
+    Returns the cache key of a step: a hash of its input data, model files,
+    params and package versions. Returns None if the step should not be cached.
+    """
+    if not params.get("flag_cache", False):
+        return None
+
+    hsh = hashlib.sha256()
+    hsh.update(f"{sel_step} {get_code_hash()} {get_package_versions()}".encode())
+
+    # Input data
+    for sel_name in step["deps"]:
+        df = data[sel_name]
+        if "cols" in step:
+            df = df[step["cols"](params)]
+        hash_df(hsh, df)
+
+    # Model files
+    for f_mdl in get_step_files(params, sel_step):
+        if os.path.exists(f_mdl):
+            f_stat = os.stat(f_mdl)
+            hsh.update(f"{f_mdl} {f_stat.st_size} {f_stat.st_mtime_ns}".encode())
+        else:
+            hsh.update(f"{f_mdl} missing".encode())
+
+    # Params
+    sel_params = {k: v for k, v in params.items() if k not in cache_skip_params}
+    hsh.update(repr(sorted(sel_params.items())).encode())
+    hash_df(hsh, params["df_roidict"])
+
+    return hsh.hexdigest()
+
+
+def get_cache_file(params: dict, sel_step: str, sel_key: str) -> str:
+    """
+    Returns the name of the cache file of a step (for the current data block)
+    """
+    f_name = f"{sel_step}_{params.get('block_ind', 0)}_{sel_key}.pkl"
+    return os.path.join(params["out_wdir"], "step_cache", f_name)
+
+
+def read_step_cache(params: dict, sel_step: str, sel_key: Any) -> Any:
+    """
+    Returns cached results of a step, or None if they are not in the cache
+    """
+    if sel_key is None:
+        return None
+    f_cache = get_cache_file(params, sel_step, sel_key)
+    if not os.path.exists(f_cache):
+        return None
+    try:
+        with open(f_cache, "rb") as f:
+            out = pickle.load(f)
+    except Exception:
+        print(f"WARNING:  Could not read step cache: {f_cache}")
+        return None
+    print(f"Reusing cached results of step: {sel_step}")
+    return out
+
+
+def write_step_cache(params: dict, sel_step: str, sel_key: Any, out: dict) -> None:
+    """
+    Saves results of a step to the cache
+    Only the latest entry of each step and data block is kept, so that the
+    cache size is bounded by the size of a single run
+    """
+    if sel_key is None:
+        return
+    f_cache = get_cache_file(params, sel_step, sel_key)
+    os.makedirs(os.path.dirname(f_cache), exist_ok=True)
+    f_tmp = f"{f_cache}.{os.getpid()}.tmp"
+    with open(f_tmp, "wb") as f:
+        pickle.dump(out, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f_tmp, f_cache)
+
+    # Remove older entries of the step
+    for f_old in glob.glob(get_cache_file(params, sel_step, "*")):
+        if f_old != f_cache:
+            try:
+                os.remove(f_old)
+            except OSError:
+                print(f"WARNING:  Could not remove step cache: {f_old}")
+
+
+def update_data(params: dict, data: dict, out: dict, pbar: Any) -> None:
+    """
+    Adds results of a step to workflow data
+    """
+    data.update(out)
+    save_checkpoint(params, data, list(out))
+    pbar.update(1)
+
+
+def run_step(sel_func: Any, params: dict, data: dict) -> dict:
+    """
+    Runs a single workflow step (called in worker processes)
+    """
+    return sel_func(params, data)
+
+
+def run_steps(steps: dict, params: dict, data: dict, num_workers: int = 1) -> dict:
+    """
+    Runs workflow steps in dependency order, passing results in memory
+    With num_workers > 1, steps with all inputs ready run in parallel
+    With params["flag_cache"], results of steps with unchanged inputs are
+    read from the step cache in the working dir
+    """
+    pending = dict(steps)
+    running = {}
+    with stqdm(total=len(steps), desc="Running step ...") as pbar:
+        if num_workers <= 1:
+            while len(pending) > 0:
+                # Select the first step with all inputs ready
+                ready = [
+                    k for k, v in pending.items() if all(d in data for d in v["deps"])
+                ]
+                if len(ready) == 0:
+                    raise ValueError(f"Unresolved step dependencies: {list(pending)}")
+                sel_step = ready[0]
+                step = pending.pop(sel_step)
+                sel_key = get_step_key(params, sel_step, step, data)
+                out = read_step_cache(params, sel_step, sel_key)
+                if out is None:
+                    print(f"Running step: {sel_step}")
+                    out = step["func"](params, data)
+                    write_step_cache(params, sel_step, sel_key, out)
+                update_data(params, data, out, pbar)
+            return data
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                # Submit all steps with inputs ready
+                ready = [
+                    k for k, v in pending.items() if all(d in data for d in v["deps"])
+                ]
+                num_cached = 0
+                for sel_step in ready:
+                    step = pending.pop(sel_step)
+                    sel_key = get_step_key(params, sel_step, step, data)
+                    out = read_step_cache(params, sel_step, sel_key)
+                    if out is not None:
+                        update_data(params, data, out, pbar)
+                        num_cached += 1
+                        continue
+                    print(f"Running step: {sel_step}")
+                    fut = executor.submit(
+                        run_step,
+                        step["func"],
+                        params,
+                        {d: data[d] for d in step["deps"]},
+                    )
+                    running[fut] = (sel_step, sel_key)
+
+                # Cached results may make other steps ready
+                if num_cached > 0:
+                    continue
+                if len(running) == 0:
+                    raise ValueError(f"Unresolved step dependencies: {list(pending)}")
+
+                # Collect finished steps
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    sel_step, sel_key = running.pop(fut)
+                    try:
+                        out = fut.result()
+                    except Exception:
+                        print(f"Step failed: {sel_step}")
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        raise
+                    print(f"Finished step: {sel_step}")
+                    write_step_cache(params, sel_step, sel_key, out)
+                    update_data(params, data, out, pbar)
+
+    return data
+
+
+def merge_results(params: dict, data: dict) -> pd.DataFrame:
+    """
+    Merges ROIs and ML scores into the final output
+    """
+    df_roidict = params["df_roidict"]
+    rdict = dict(zip(df_roidict.Code, df_roidict.Name))
 
     # Rename roi names and merge dfs
-    f_combat = os.path.join(out_wdir, f"{dset_name}_combat.csv")
-    df_out = pd.read_csv(f_combat, dtype={"MRID": str})
-    df_out = df_out.rename(columns=dict(zip(df_roidict.Code, df_roidict.Name)))
+    base = "combat" if params["flag_harmonize"] else "rois"
+    df_out = data[base].rename(columns=rdict)
     df_out = df_out.loc[:, ~df_out.columns.duplicated()]
     df_out = df_out.rename(columns={"DLICV": "ICV"})
 
-    f_centiles = os.path.join(out_wdir, f"{dset_name}_combat_icvcorr_centiles.csv")
-    df_centiles = pd.read_csv(f_centiles, dtype={"MRID": str})
+    df_centiles = data["centiles"]
     df_tmp = df_centiles[
         ["MRID"]
         + df_centiles.columns[df_centiles.columns.str.contains("MUSE")].tolist()
     ]
     df_tmp = df_tmp.rename(columns={"DLICV": "ICV"})
-    df_tmp = df_tmp.rename(columns=dict(zip(df_roidict.Code, df_roidict.Name)))
+    df_tmp = df_tmp.rename(columns=rdict)
     df_tmp = df_tmp.loc[:, ~df_tmp.columns.duplicated()]
     df_out = df_out.merge(df_tmp, on="MRID", suffixes=["", "_centiles"])
 
-    f_spare = os.path.join(out_wdir, f"{dset_name}_combat_spare-all.csv")
-    df_spare = pd.read_csv(f_spare, dtype={"MRID": str})
-    df_out = df_out.merge(df_spare, on="MRID")
-
-    f_sgan = os.path.join(out_wdir, f"{dset_name}_sgan.csv")
-    df_sgan = pd.read_csv(f_sgan, dtype={"MRID": str})
-    df_out = df_out.merge(df_sgan, on="MRID")
+    for sel_name in ["spare", "sgan", "cclnmf"]:
+        df_out = df_out.merge(data[sel_name], on="MRID")
 
-    f_cclnmf = os.path.join(out_wdir, f"{dset_name}_cclnmf.csv")
-    df_cclnmf = pd.read_csv(f_cclnmf, dtype={"MRID": str})
-    df_out = df_out.merge(df_cclnmf, on="MRID")
-
-    # Write out file
-    f_results = os.path.join(out_dir, f"{dset_name}_DLMUSE+MLScores.csv")
-    df_out.to_csv(f_results, index=False)
+    return df_out
 
 
-def run_workflow_noharmonization(
+def run_mlscores(
     dset_name: str,
     bdir: str,
     in_csv: str,
     in_demog: str,
     out_dir: str,
+    flag_harmonize: bool = True,
+    flag_checkpoint: bool = True,
+    num_workers: int = 1,
+    flag_inproc: bool = False,
+    chunk_size: int = 0,
+    out_format: str = "csv",
+    flag_cache: bool = False,
 ) -> None:
-    # Fixed params
-    key_var = "MRID"
-    spare_types = ["AD", "Age"]
-    icv_ref_val = 1430000
-    cent_csv = os.path.join(
-        bdir, "resources", "centiles", "istag_centiles_CN_ICV_Corrected.csv"
-    )
-    csv_muse_all = os.path.join(
-        bdir, "src", "workflows", "w_sMRI", "lists", "list_MUSE_all.csv"
-    )
-    csv_muse_single = os.path.join(
-        bdir, "src", "workflows", "w_sMRI", "lists", "list_MUSE_single.csv"
-    )
-    # csv_muse_derived = os.path.join(
-    # bdir, "src", "workflows", "w_sMRI", "lists", "list_MUSE_mapping_derived.csv"
-    # )
-    spare_dir = os.path.join(
-        bdir, "src", "workflows", "w_sMRI", "models", "vISTAG1", "SPARE"
-    )
-    spare_pref = "combined_DLMUSE_raw_COMBAT_SPARE-"
-    spare_suff = "_Model.pkl.gz"
-
+    """
+    Runs the ML scores workflow
+    Data is passed between steps in memory. Intermediate results are written
+    to the working dir only if flag_checkpoint is set. Independent steps run
+    in parallel if num_workers > 1. With flag_inproc, models are applied
+    in-process (instead of calling external tools) and kept in memory.
+    With chunk_size > 0, subjects are processed in batches of chunk_size and
+    results are appended to the output, so that memory use is bounded by the
+    batch size. The output files are replaced only after all batches are
+    processed; if a batch fails, partial output and output of earlier runs
+    are removed. With harmonization, batches are allowed only if all sites are
+    in the COMBAT model (parameters of new sites are estimated on the data,
+    and would differ between batches).
+    With out_format "parquet" or "feather", intermediate files are written in
+    the columnar format, and a columnar copy of the output csv is added.
+    With flag_cache, results of each step are saved in the working dir, and
+    reused in later runs if the inputs, models and params of the step are
+    unchanged (one entry is kept for each step and batch).
+    """
     # Print args
     print(
         f"About to run: run_workflow {dset_name} {bdir} {in_csv} {in_demog} {out_dir}"
     )
-
-    def step_centiles() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
-
-        # Normalize ROIs
-        df_icvcorr = df_in.copy()
-        var_muse = df_icvcorr.columns[df_icvcorr.columns.str.contains("MUSE")]
-        df_tmp = df_icvcorr[var_muse]
-        df_tmp = df_tmp.div(df_in["DLICV"], axis=0) * icv_ref_val
-        # df_tmp=df_tmp.div(df_icvcorr['DLICV'], axis=0) * 100
-        df_icvcorr[var_muse] = df_tmp.values
-
-        # Calculate centiles
-        df_cent = pd.read_csv(cent_csv)
-        df_centiles = calc_subject_centiles(df_icvcorr, df_cent, df_roidict)
-
-        # Write out files
-        f_icvcorr = os.path.join(out_wdir, f"{dset_name}_icvcorr.csv")
-        df_icvcorr.to_csv(f_icvcorr, index=False)
-        f_centiles = os.path.join(out_wdir, f"{dset_name}_icvcorr_centiles.csv")
-        df_centiles.to_csv(f_centiles, index=False)
-
-    def step_spare() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
-
-        df_modified = df_in.rename(columns=lambda x: x[5:] if x.startswith('MUSE_') else x)
-        df_modified = df_modified.rename(columns={"ICV": "702"})
-        alt_f_in = os.path.join(out_wdir, f"{dset_name}_combat_alt.csv")
-        df_modified.to_csv(alt_f_in, index=False)
-
-        # Apply spare
-        df_spare = df_in[["MRID"]]
-        for spare_type in spare_types:
-            spare_mdl = os.path.join(spare_dir, f"{spare_pref}{spare_type}{spare_suff}")
-            f_spare_out = os.path.join(out_wdir, f"{dset_name}_spare_{spare_type}.csv")
-            
-            if spare_type in ["AD", "Age"]:
-                os.system(f"spare_score -a test -i {alt_f_in} -m {spare_mdl} -o {f_spare_out}")
-            else:
-                os.system(f"spare_score -a test -i {f_in} -m {spare_mdl} -o {f_spare_out}")
-            # Change column name for the spare output
-            df = pd.read_csv(f_spare_out)
-            df = df[df.columns[0:2]]
-            df.columns = ["MRID", f"SPARE{spare_type}"]
-            df_spare = df_spare.merge(df)
-
-        # Write out file with all spare scores
-        f_spare_out = os.path.join(out_wdir, f"{dset_name}_spare-all.csv")
-        df_spare.to_csv(f_spare_out, index=False)
-
-    def step_sgan() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
-
-        # Select input
-        sel_covars = ["MRID", "Age", "Sex", "DLICV"]
-        sel_vars = sel_covars + list_muse_single
-        df_sel = df_in[sel_vars]
-        f_sgan_in = os.path.join(out_wdir, f"{dset_name}_sgan_in.csv")
-        df_sel.to_csv(f_sgan_in, index=False)
-
-        # Run prediction
-        f_sgan_out = os.path.join(out_wdir, f"{dset_name}_sgan_init.csv")
-        cmd = f"PredCRD -i {f_sgan_in} -o {f_sgan_out}"
-        print(f"About to run {cmd}")
-        os.system(cmd)
-
-        # Edit columns
-        df_sgan = pd.read_csv(f_sgan_out)
-        df_sgan.columns = ["MRID"] + df_sgan.add_prefix("SurrealGAN_").columns[
-            1:
-        ].tolist()
-        f_sgan = os.path.join(out_wdir, f"{dset_name}_sgan.csv")
-        df_sgan.to_csv(f_sgan, index=False)
-    
-    def step_cclnmf() -> None:
-        # Read input
-        f_in = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-        df_in = pd.read_csv(f_in, dtype={"MRID": str})
-
-        # Select input
-        sel_demog_vars = ["MRID", "Age", "Sex"]
-        sel_vars = ["MRID"] + list_muse_single + ["DLICV"]
-        df_sel = df_in[sel_vars]
-        df_demog_sel = df_in[sel_demog_vars]
-        df_sel = df_in[sel_vars].rename(columns={"DLICV": "702"}) # Needed for CCL_NMF_Prediction
-        df_sel = df_sel.rename(columns=lambda x: x[5:] if x.startswith('MUSE_') else x)
-
-        f_cclnmf_in = os.path.join(out_wdir, f"{dset_name}_cclnmf_in.csv")
-        df_sel.to_csv(f_cclnmf_in, index=False)
-        f_cclnmf_demog_in = os.path.join(out_wdir, f"{dset_name}_cclnmf_demographics.csv")
-        df_demog_sel.to_csv(f_cclnmf_demog_in, index=False)
-
-        # Run prediction
-        f_cclnmf_out = os.path.join(out_wdir, f"{dset_name}_cclnmf_init.csv")
-        cmd = f"ccl_nmf_prediction -i {f_cclnmf_in} -d {f_cclnmf_demog_in} -o {f_cclnmf_out}"
-        print(f"About to run {cmd}")
-        os.system(cmd)
-
-        # Edit columns
-        df_cclnmf = pd.read_csv(f_cclnmf_out)
-        df_cclnmf.rename(columns={
-            col: re.sub(r"CCL_NMF_(\d+)", r"CCL-NMF\1", col)
-            for col in df.columns
-        }, inplace=True)
-
-        # Export to csv
-        f_cclnmf = os.path.join(out_wdir, f"{dset_name}_cclnmf.csv")
-        df_cclnmf.to_csv(f_cclnmf, index=False)
-    
+    params = init_params(dset_name, bdir, out_dir, flag_harmonize, out_format)
+    params["flag_checkpoint"] = flag_checkpoint
+    params["flag_inproc"] = flag_inproc
+    params["flag_cache"] = flag_cache
 
     # Make out dir
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-    out_wdir = os.path.join(out_dir, "working_dir")
-    if not os.path.exists(out_wdir):
-        os.makedirs(out_wdir)
-
-    # Read roi lists
-    df_tmp = pd.read_csv(csv_muse_single)
-    list_muse_single = df_tmp.Code.tolist()
-
-    # Read data
-    df = pd.read_csv(in_csv, dtype={"MRID": str})
-    df.columns = df.columns.astype(str)
-
-    # Rename ROIs
-    df_roidict = pd.read_csv(csv_muse_all)
-    df_roidict.Index = df_roidict.Index.astype(str)
-    vdict = df_roidict.set_index("Index")["Code"].to_dict()
-    df = df.rename(columns=vdict)
-
-    # Keep DLICV in a separate df
-    df_icv = df[["MRID", "MUSE_702"]]
-    df_icv.columns = ["MRID", "DLICV"]
-    df = df.drop(columns=["MUSE_702"])
-
-    # Add DLICV to demog
-    df_demog = pd.read_csv(in_demog, dtype={"MRID": str})
-    df_demog = df_demog.merge(df_icv, on="MRID")
+    if (flag_checkpoint or flag_cache) and not os.path.exists(params["out_wdir"]):
+        os.makedirs(params["out_wdir"])
+
+    # Parameters of new sites must be estimated on the whole sample
+    if chunk_size > 0 and flag_harmonize:
+        new_sites = get_new_sites(params, in_demog)
+        if len(new_sites) > 0:
+            raise ValueError(
+                f"Sites not in the COMBAT model: {new_sites}."
+                " Harmonization of new sites needs all subjects at once,"
+                " run without batches (chunk_size=0)."
+            )
 
-    # Add covars
-    df_raw = df_demog.merge(df, on=key_var)
-    f_raw = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-    df_raw.to_csv(f_raw, index=False)
-
-    list_func = [step_centiles, step_spare, step_sgan, step_cclnmf]
-    # list_fnames = [
-    # "Centile calculation",
-    # "SPARE index calculation",
-    # "SurrealGAN index calculation",
-    # "CCL_NMF calculation",
-    # ]
-
-    for i, sel_func in stqdm(
-        enumerate(list_func),
-        desc="Running step ...",
-        total=len(list_func),
-    ):
-        sel_func()
-
-    # Combine results
+    # Read input data
+    list_data = read_input(params, in_csv, in_demog, chunk_size)
 
-    # Rename roi names and merge dfs
-    f_raw = os.path.join(out_wdir, f"{dset_name}_rois_init.csv")
-    df_out = pd.read_csv(f_raw, dtype={"MRID": str})
-    df_out = df_out.rename(columns=dict(zip(df_roidict.Code, df_roidict.Name)))
-    df_out = df_out.loc[:, ~df_out.columns.duplicated()]
-    df_out = df_out.rename(columns={"DLICV": "ICV"})
+    # Load models before starting workers, so that they share the cache
+    if flag_inproc:
+        if flag_harmonize:
+            mdl_combat = params["model_combat"]
+            load_combat_model(mdl_combat, os.path.getmtime(mdl_combat))
+        for spare_type in params["spare_types"]:
+            spare_mdl = get_spare_model_path(params, spare_type)
+            load_spare_model(spare_mdl, os.path.getmtime(spare_mdl))
 
-    f_centiles = os.path.join(out_wdir, f"{dset_name}_icvcorr_centiles.csv")
-    df_centiles = pd.read_csv(f_centiles, dtype={"MRID": str})
-    df_tmp = df_centiles[
-        ["MRID"]
-        + df_centiles.columns[df_centiles.columns.str.contains("MUSE")].tolist()
-    ]
-    df_tmp = df_tmp.rename(columns=dict(zip(df_roidict.Code, df_roidict.Name)))
-    df_tmp = df_tmp.loc[:, ~df_tmp.columns.duplicated()]
-    df_tmp = df_tmp.rename(columns={"DLICV": "ICV"})
-    df_out = df_out.merge(df_tmp, on="MRID", suffixes=["", "_centiles"])
+    # Run steps (files for external tools are kept only with checkpoints)
+    steps = get_steps(flag_harmonize)
+    f_results = os.path.join(out_dir, f"{dset_name}_DLMUSE+MLScores.csv")
+    list_results = [f_results]
+    if out_format != "csv":
+        list_results.append(
+            os.path.join(
+                out_dir, f"{dset_name}_DLMUSE+MLScores{table_formats[out_format]}"
+            )
+        )
+    # Output is written to temp files, which replace the output files only
+    # after all batches are processed
+    list_tmp = [get_tmp_table_file(x) for x in list_results]
+    num_out = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            params["tmp_dir"] = params["out_wdir"] if flag_checkpoint else tmp_dir
+            for i, data in enumerate(list_data):
+                # Skip batches with no subjects to process
+                df_sel = data["rois"]
+                if flag_harmonize:
+                    df_sel = select_age_range(params, df_sel)
+                if df_sel.shape[0] == 0:
+                    print(f"WARNING:  Skip data block with no subjects to process: {i}")
+                    continue
+                if chunk_size > 0:
+                    print(
+                        f"Processing data block {i} ({data['rois'].shape[0]} subjects)"
+                    )
+
+                params["flag_append"] = num_out > 0
+                params["block_ind"] = i
+                save_checkpoint(params, data, ["rois"])
+                data = run_steps(steps, params, data, num_workers)
+
+                # Combine results and write out file
+                df_out = merge_results(params, data)
+                for f_out in list_tmp:
+                    write_table(df_out, f_out, num_out > 0)
+                num_out += df_out.shape[0]
+
+            close_tables(list_tmp)
+            if num_out == 0:
+                raise ValueError("No subjects were processed, output was not created")
+            for f_tmp, f_out in zip(list_tmp, list_results):
+                os.replace(f_tmp, f_out)
+
+        except BaseException:
+            # Remove partial output and output of earlier runs
+            close_tables(list_tmp)
+            for f_out in list_tmp + list_results:
+                if os.path.exists(f_out):
+                    os.remove(f_out)
+            raise
+
+        finally:
+            close_tables()
 
-    f_spare = os.path.join(out_wdir, f"{dset_name}_spare-all.csv")
-    df_spare = pd.read_csv(f_spare, dtype={"MRID": str})
-    df_out = df_out.merge(df_spare, on="MRID")
 
-    f_sgan = os.path.join(out_wdir, f"{dset_name}_sgan.csv")
-    df_sgan = pd.read_csv(f_sgan, dtype={"MRID": str})
-    df_out = df_out.merge(df_sgan, on="MRID")
+def run_workflow(
+    dset_name: str,
+    bdir: str,
+    in_csv: str,
+    in_demog: str,
+    out_dir: str,
+    flag_checkpoint: bool = True,
+    num_workers: int = 1,
+    flag_inproc: bool = False,
+    chunk_size: int = 0,
+    out_format: str = "csv",
+    flag_cache: bool = False,
+) -> None:
+    run_mlscores(
+        dset_name,
+        bdir,
+        in_csv,
+        in_demog,
+        out_dir,
+        flag_harmonize=True,
+        flag_checkpoint=flag_checkpoint,
+        num_workers=num_workers,
+        flag_inproc=flag_inproc,
+        chunk_size=chunk_size,
+        out_format=out_format,
+        flag_cache=flag_cache,
+    )
 
-    f_cclnmf = os.path.join(out_wdir, f"{dset_name}_cclnmf.csv")
-    df_cclnmf = pd.read_csv(f_cclnmf, dtype={"MRID": str})
-    df_out = df_out.merge(df_cclnmf, on="MRID")
 
-    # Write out file
-    f_results = os.path.join(out_dir, f"{dset_name}_DLMUSE+MLScores.csv")
-    df_out.to_csv(f_results, index=False)
+def run_workflow_noharmonization(
+    dset_name: str,
+    bdir: str,
+    in_csv: str,
+    in_demog: str,
+    out_dir: str,
+    flag_checkpoint: bool = True,
+    num_workers: int = 1,
+    flag_inproc: bool = False,
+    chunk_size: int = 0,
+    out_format: str = "csv",
+    flag_cache: bool = False,
+) -> None:
+    run_mlscores(
+        dset_name,
+        bdir,
+        in_csv,
+        in_demog,
+        out_dir,
+        flag_harmonize=False,
+        flag_checkpoint=flag_checkpoint,
+        num_workers=num_workers,
+        flag_inproc=flag_inproc,
+        chunk_size=chunk_size,
+        out_format=out_format,
+        flag_cache=flag_cache,
+    )
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "workflows",
+        "w_DLMUSE",
+    )
+)
+import dlmuse_rois as dlmuse_rois
+
+
+def make_label_image(f_out: str, seed: int = 0) -> np.ndarray:
+    """
+    Writes a synthetic DLMUSE label map (with a label that is not in the map)
+    """
+    rng = np.random.default_rng(seed)
+    list_lbl = [0, 1, 4, 11, 23, 30, 40, 41, 61, 62, 81, 207, 250]
+    labels = rng.choice(list_lbl, size=(20, 24, 16)).astype(np.int16)
+    nib.save(nib.Nifti1Image(labels, np.diag([1.2, 1.0, 1.5, 1.0])), f_out)
+    return labels
+
+
+def test_roi_volumes_match_label_sums(tmp_path: str) -> None:
+    for i in range(2):
+        make_label_image(os.path.join(tmp_path, f"S{i}_T1_DLMUSE.nii.gz"), seed=i)
+    out_csv = os.path.join(tmp_path, "rois.csv")
+    dlmuse_rois.dlmuse_rois(str(tmp_path), "_T1_DLMUSE.nii.gz", out_csv, num_workers=1)
+    df_out = pd.read_csv(out_csv, dtype={"MRID": str}).set_index("MRID")
+
+    # Reference: voxels of the labels of each roi, summed over the float image
+    derived_map = dlmuse_rois.roitab.get_derived_map(dlmuse_rois.csv_derived_default)
+    for mrid in ["S0", "S1"]:
+        nii = nib.load(os.path.join(tmp_path, f"{mrid}_T1_DLMUSE.nii.gz"))
+        data = nii.get_fdata()
+        vox_vol = np.prod(nii.header.get_zooms()[:3])
+        for code, labels in zip(derived_map["codes"], derived_map["labels"]):
+            vol = np.isin(data, labels).sum() * vox_vol
+            assert np.isclose(df_out.loc[mrid, code], vol)
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "viewer"
+    )
+)
+import utils.utils_stats as utilstat
+
+
+def make_data(num_points: int, noise: float, seed: int = 0) -> pd.DataFrame:
+    """
+    Creates a synthetic cohort (age, roi volume and sex of each subject)
+    """
+    rng = np.random.default_rng(seed)
+    age = rng.uniform(20, 95, num_points)
+    sex = rng.choice(["F", "M"], num_points)
+    vol = 7e5 - 20 * (age - 20) ** 2 + 4e4 * (sex == "M")
+    vol += rng.normal(0, noise, num_points)
+    return pd.DataFrame({"Age": age, "GM": vol, "Sex": sex})
+
+
+def test_linreg_matches_statsmodels() -> None:
+    df = make_data(2000, 3e4)
+    plot_data = utilstat.calc_plot_data(df, "Age", "GM", "Sex")
+    dict_fit = utilstat.calc_linreg(plot_data)
+
+    for hname, dfh in df.groupby("Sex"):
+        model = sm.OLS(dfh["GM"], sm.add_constant(dfh["Age"])).fit()
+        x_hat = dict_fit[hname]["x_hat"]
+        pred = model.get_prediction(sm.add_constant(x_hat))
+        assert np.allclose(dict_fit[hname]["y_hat"], pred.predicted_mean)
+        assert np.allclose(dict_fit[hname]["conf_int"], pred.conf_int())
+
+
+def test_lowess_matches_statsmodels() -> None:
+    # Groups are larger than LOWESS_MAX_POINTS, so that points are binned
+    noise = 3e3
+    df = make_data(2 * utilstat.LOWESS_MAX_POINTS + 2000, noise)
+    plot_data = utilstat.calc_plot_data(df, "Age", "GM", "Sex")
+    frac = 0.7
+    dict_fit = utilstat.calc_lowess(plot_data, frac)
+
+    for hname, dfh in df.groupby("Sex"):
+        assert dfh.shape[0] > utilstat.LOWESS_MAX_POINTS
+        pred = sm.nonparametric.lowess(dfh["GM"], dfh["Age"], frac=frac)
+        x_hat = dict_fit[hname]["x_hat"]
+        y_ref = np.interp(x_hat, pred[:, 0], pred[:, 1])
+        # Binning and the delta interpolation change the fit by a small
+        # fraction of the noise (the curve spans ~1e5)
+        assert np.abs(dict_fit[hname]["y_hat"] - y_ref).max() < 0.1 * noise
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "viewer"
+    )
+)
+import utils.utils_nifti as utilni
+
+
+def test_label_index_matches_label_masks() -> None:
+    rng = np.random.default_rng(0)
+    labels = np.zeros((30, 36, 24), dtype=np.uint16)
+    labels[5:20, 8:30, 2:15] = rng.choice([0, 4, 11, 300], size=(15, 22, 13))
+    labels[22:25, 1:3, 20:23] = 52
+    dict_lbl = utilni.calc_label_index(labels)
+
+    assert dict_lbl["labels"].tolist() == [4, 11, 52, 300]
+    for i, lbl in enumerate(dict_lbl["labels"]):
+        # Reference: coordinates of the voxels of the label
+        ind = np.array(np.nonzero(labels == lbl))
+        assert dict_lbl["counts"][i] == ind.shape[1]
+        assert np.array_equal(dict_lbl["bbox"][i, :, 0], ind.min(axis=1))
+        assert np.array_equal(dict_lbl["bbox"][i, :, 1], ind.max(axis=1))
+        assert np.allclose(dict_lbl["centroid"][i], ind.mean(axis=1))
+        for ax in utilni.VIEW_AXES:
+            prof = np.bincount(ind[ax], minlength=labels.shape[ax])
+            assert np.array_equal(dict_lbl[f"prof{ax}"][:, i], prof)
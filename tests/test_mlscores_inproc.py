@@ -0,0 +1,75 @@
+import os
+import shutil
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+bdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(bdir, "src", "workflows", "w_sMRI"))
+import w_mlscores as w_mlscores
+
+in_dir = os.path.join(bdir, "src", "examples", "test_input", "vTest1", "Study1")
+
+
+def read_test_input(tmp_path: str) -> tuple:
+    """
+    Reads the example study (the demog copy has no DLICV, so that the merged
+    table has a single DLICV column, as in the workflow input)
+    """
+    f_demog = os.path.join(tmp_path, "Study1_Demog.csv")
+    df_demog = pd.read_csv(os.path.join(in_dir, "Study1_Demog.csv"))
+    df_demog.drop(columns=["DLICV"], errors="ignore").to_csv(f_demog, index=False)
+
+    params = w_mlscores.init_params("Study1", bdir, str(tmp_path), True)
+    params["tmp_dir"] = str(tmp_path)
+    data = next(
+        w_mlscores.read_input(
+            params, os.path.join(in_dir, "Study1_DLMUSE.csv"), f_demog
+        )
+    )
+    return params, data
+
+
+def run_both(sel_func: str, params: dict, data: dict, out_name: str) -> tuple:
+    """
+    Runs a step in-process and with the external tool
+    """
+    list_out = []
+    for flag_inproc in [True, False]:
+        params["flag_inproc"] = flag_inproc
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            out = getattr(w_mlscores, sel_func)(params, data)[out_name]
+        list_out.append(out.set_index("MRID").sort_index())
+    return list_out[0], list_out[1]
+
+
+def test_spare_inproc_matches_cli(tmp_path: str) -> None:
+    if shutil.which("spare_score") is None:
+        pytest.skip("spare_score is not installed")
+    params, data = read_test_input(tmp_path)
+    data["combat"] = data["rois"].rename(columns={"DLICV": "ICV"})
+
+    df_inproc, df_cli = run_both("step_spare", params, data, "spare")
+    assert list(df_inproc.columns) == list(df_cli.columns)
+    assert df_inproc.index.equals(df_cli.index)
+    assert np.allclose(df_inproc.values, df_cli.values, equal_nan=True)
+
+
+def test_combat_inproc_matches_cli(tmp_path: str) -> None:
+    if shutil.which("neuroharm") is None:
+        pytest.skip("neuroharm is not installed")
+    params, data = read_test_input(tmp_path)
+    if not os.path.exists(params["model_combat"]):
+        pytest.skip("COMBAT model is not available")
+
+    df_inproc, df_cli = run_both("step_combat", params, data, "combat")
+    assert list(df_inproc.columns) == list(df_cli.columns)
+    assert df_inproc.index.equals(df_cli.index)
+    num_cols = df_inproc.select_dtypes("number").columns
+    assert np.allclose(
+        df_inproc[num_cols].values, df_cli[num_cols].values, equal_nan=True
+    )
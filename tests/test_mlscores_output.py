@@ -0,0 +1,111 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+bdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(bdir, "src", "workflows", "w_sMRI"))
+import w_mlscores as w_mlscores
+
+in_dir = os.path.join(bdir, "src", "examples", "test_input", "vTest1", "Study1")
+
+
+def run_chunks(out_dir: str, num_fail: int, monkeypatch: pytest.MonkeyPatch) -> str:
+    """
+    Runs the workflow in batches, with steps replaced by a stub that fails on
+    batch num_fail
+    """
+    list_calls = []
+
+    def run_steps(steps: dict, params: dict, data: dict, num_workers: int) -> dict:
+        list_calls.append(data["rois"].shape[0])
+        if len(list_calls) == num_fail:
+            raise RuntimeError("Step failed")
+        return data
+
+    def merge_results(params: dict, data: dict) -> pd.DataFrame:
+        return data["rois"][["MRID", "Age", "MUSE_4"]]
+
+    monkeypatch.setattr(w_mlscores, "run_steps", run_steps)
+    monkeypatch.setattr(w_mlscores, "merge_results", merge_results)
+    w_mlscores.run_mlscores(
+        "Study1",
+        bdir,
+        os.path.join(in_dir, "Study1_DLMUSE.csv"),
+        os.path.join(in_dir, "Study1_Demog.csv"),
+        out_dir,
+        flag_harmonize=False,
+        flag_checkpoint=False,
+        chunk_size=100,
+    )
+    return os.path.join(out_dir, "Study1_DLMUSE+MLScores.csv")
+
+
+def test_failed_batch_removes_output(
+    tmp_path: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    f_out = run_chunks(str(tmp_path), 0, monkeypatch)
+    assert pd.read_csv(f_out).shape[0] == 288
+
+    # A failed run leaves no partial or stale output
+    with pytest.raises(RuntimeError):
+        run_chunks(str(tmp_path), 2, monkeypatch)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("ext", [".parquet", ".feather"])
+def test_append_text_column_missing_in_first_block(tmp_path: str, ext: str) -> None:
+    df = pd.DataFrame(
+        {
+            "MRID": ["S1", "S2", "S3", "S4"],
+            "DX": pd.Series([None, None, "AD", "CN"], dtype=object),
+            "Age": [61.5, 70.0, 82.5, 75.0],
+        }
+    )
+    f_out = os.path.join(tmp_path, f"out{ext}")
+    try:
+        w_mlscores.write_table(df.iloc[:2], f_out)
+        w_mlscores.write_table(df.iloc[2:], f_out, True)
+    finally:
+        w_mlscores.close_tables()
+
+    df_out = pd.read_parquet(f_out) if ext == ".parquet" else pd.read_feather(f_out)
+    pd.testing.assert_frame_equal(df_out, df)
+
+
+def test_chunked_rerun_reads_step_cache(
+    tmp_path: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    list_calls = []
+
+    def step_test(params: dict, data: dict) -> dict:
+        list_calls.append(data["rois"].shape[0])
+        return {"test": data["rois"][["MRID", "Age"]]}
+
+    def merge_results(params: dict, data: dict) -> pd.DataFrame:
+        return data["test"]
+
+    monkeypatch.setattr(
+        w_mlscores,
+        "get_steps",
+        lambda x: {"test": {"func": step_test, "deps": ["rois"]}},
+    )
+    monkeypatch.setattr(w_mlscores, "merge_results", merge_results)
+    for _ in range(2):
+        w_mlscores.run_mlscores(
+            "Study1",
+            bdir,
+            os.path.join(in_dir, "Study1_DLMUSE.csv"),
+            os.path.join(in_dir, "Study1_Demog.csv"),
+            str(tmp_path),
+            flag_harmonize=False,
+            flag_checkpoint=False,
+            chunk_size=100,
+            flag_cache=True,
+        )
+
+    # Each batch is computed once, and read from the cache in the second run
+    assert list_calls == [100, 100, 88]
+    df_out = pd.read_csv(os.path.join(tmp_path, "Study1_DLMUSE+MLScores.csv"))
+    assert df_out.shape[0] == 288
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "viewer"
+    )
+)
+import utils.utils_nifti as utilni
+
+
+def resample_zoom(nii: nib.Nifti1Image) -> np.ndarray:
+    """
+    Reference: reorient the image and rescale it with ndimage.zoom
+    """
+    nii = utilni.reorient_nifti(nii, ref_orient="IPL")
+    return ndimage.zoom(
+        nii.get_fdata(), nii.header.get_zooms(), order=0, mode="nearest"
+    )
+
+
+def test_resample_maps_match_zoom() -> None:
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 200, size=(30, 36, 24)).astype(np.int16)
+    list_affines = [
+        np.diag([1.0, 1.0, 1.0, 1.0]),
+        np.diag([-1.2, 1.0, 1.5, 1.0]),
+        np.array([[0, 0, 2.0, 0], [-0.9, 0, 0, 0], [0, 1.3, 0, 0], [0, 0, 0, 1.0]]),
+    ]
+    for affine in list_affines:
+        nii = nib.Nifti1Image(data, affine)
+        out = utilni.resample_volume(
+            np.asanyarray(nii.dataobj), utilni.get_resample_maps(nii)
+        )
+        out_ref = resample_zoom(nii)
+        assert out.dtype == data.dtype
+        assert out.shape == out_ref.shape
+        assert np.array_equal(out, out_ref)
@@ -0,0 +1,120 @@
+import csv
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+src_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"
+)
+sys.path.append(os.path.join(src_dir, "workflows", "common"))
+import roi_tables as roitab
+
+csv_derived = os.path.join(
+    src_dir, "workflows", "w_sMRI", "lists", "list_MUSE_mapping_derived.csv"
+)
+
+
+def combine_rois_loop(df_in: pd.DataFrame, csv_roi_dict: str) -> pd.DataFrame:
+    """
+    Reference implementation (pandas sum of single rois for each derived roi)
+    """
+    roi_prefix = "MUSE_"
+    dict_roi = {}
+    with open(csv_roi_dict) as roi_map:
+        reader = csv.reader(roi_map, delimiter=",")
+        for row in reader:
+            dict_roi[roi_prefix + str(row[0])] = [roi_prefix + str(x) for x in row[2:]]
+
+    dict_out = {}
+    for key, key_vals in dict_roi.items():
+        if key in df_in.columns:
+            dict_out[key] = df_in[key]
+        elif all(x in df_in.columns for x in key_vals):
+            dict_out[key] = df_in[key_vals].sum(axis=1)
+    return pd.DataFrame(dict_out)
+
+
+def make_rois(num_subj: int = 50, seed: int = 0) -> pd.DataFrame:
+    """
+    Creates single roi volumes for all labels in the derived roi map, with
+    missing values, a missing label and a derived roi already in the data
+    """
+    rng = np.random.default_rng(seed)
+    derived_map = roitab.get_derived_map(csv_derived)
+    list_lbl = sorted(set(np.concatenate(derived_map["labels"]).tolist()))
+    df = pd.DataFrame(
+        rng.uniform(100, 5000, [num_subj, len(list_lbl)]),
+        columns=[f"MUSE_{x}" for x in list_lbl],
+    )
+    df.iloc[::7, 3] = np.nan
+    df = df.drop(columns=["MUSE_4"])
+    df["MUSE_702"] = rng.uniform(1e6, 2e6, num_subj)
+    return df
+
+
+def test_derived_rois_match_loop() -> None:
+    df_in = make_rois()
+    derived_map = roitab.get_derived_map(csv_derived)
+    df_out, dict_missing = roitab.calc_derived_rois(df_in, derived_map)
+    df_ref = combine_rois_loop(df_in, csv_derived)
+
+    assert list(df_out.columns) == list(df_ref.columns)
+    assert "MUSE_702" in df_out.columns
+    assert all(4 in x for x in dict_missing.values())
+    assert np.allclose(df_out.values, df_ref.values, equal_nan=True)
+
+
+def interp_centiles_loop(
+    vals_subj: np.ndarray, ind_age: np.ndarray, cent: np.ndarray, arr_cent: np.ndarray
+) -> np.ndarray:
+    """
+    Reference (per subject, per ROI) linear interpolation of centile values
+    """
+    cent_subj = np.full(vals_subj.shape, np.nan)
+    for i in range(vals_subj.shape[0]):
+        for j in range(vals_subj.shape[1]):
+            vals_cent = arr_cent[j, ind_age[i]]
+            sval = vals_subj[i, j]
+            if np.isnan(sval) or np.isnan(vals_cent[0]):
+                continue
+            sval = np.min([vals_cent[-1], np.max([vals_cent[0], sval])])
+            ind1 = max(np.where(sval <= vals_cent)[0][0] - 1, 0)
+            ind2 = ind1 + 1
+            slope = (cent[ind2] - cent[ind1]) / (vals_cent[ind2] - vals_cent[ind1])
+            cent_subj[i, j] = cent[ind1] + slope * (sval - vals_cent[ind1])
+    return cent_subj
+
+
+def make_centiles(num_roi: int = 6, seed: int = 0) -> pd.DataFrame:
+    """
+    Creates a synthetic centile table (one row per ROI and age)
+    """
+    rng = np.random.default_rng(seed)
+    ages = np.arange(40, 60)
+    list_df = []
+    for i in range(num_roi):
+        base = rng.uniform(1e3, 1e4) - 10 * (ages - 40)
+        vals = base[:, np.newaxis] * np.array([0.8, 0.9, 1.0, 1.1, 1.2])
+        df = pd.DataFrame(vals, columns=[f"centile_{x}" for x in [5, 25, 50, 75, 95]])
+        df.insert(0, "Age", ages)
+        df.insert(0, "VarName", f"ROI{i}")
+        list_df.append(df)
+    return pd.concat(list_df, ignore_index=True)
+
+
+def test_interp_centiles_match_loop() -> None:
+    cent_table = roitab.make_centile_table(make_centiles())
+    num_subj, num_roi = 200, len(cent_table["rois"])
+    rng = np.random.default_rng(1)
+    ind_age = rng.integers(0, len(cent_table["ages"]), num_subj)
+    vals_subj = cent_table["values"][np.arange(num_roi), ind_age[:, np.newaxis], 2]
+    vals_subj = vals_subj * rng.uniform(0.6, 1.4, [num_subj, num_roi])
+    vals_subj[::11, 2] = np.nan
+
+    args = [vals_subj, ind_age, cent_table["centiles"], cent_table["values"]]
+    cent_subj = roitab.interp_centiles(*args)
+    assert np.allclose(cent_subj, interp_centiles_loop(*args), equal_nan=True)
+    assert np.isnan(cent_subj[::11, 2]).all()
+    assert np.nanmin(cent_subj) == 5 and np.nanmax(cent_subj) == 95
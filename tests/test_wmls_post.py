@@ -0,0 +1,66 @@
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "workflows",
+        "w_DLWMLS",
+    )
+)
+import wmls_post as wmls_post
+
+affine = np.diag([1.2, 1.0, 1.5, 1.0])
+
+
+def make_images(in_dir: str, seg_dir: str, mrid: str, seed: int) -> tuple:
+    """
+    Writes a synthetic lesion mask and DLMUSE segmentation
+    """
+    rng = np.random.default_rng(seed)
+    wmls = (rng.uniform(size=(20, 24, 16)) > 0.8).astype(np.uint8)
+    seg = rng.choice([0, 4, 11, 23, 81], size=wmls.shape).astype(np.int16)
+    nib.save(nib.Nifti1Image(wmls, affine), os.path.join(in_dir, f"{mrid}_WMLS.nii.gz"))
+    nib.save(
+        nib.Nifti1Image(seg, affine), os.path.join(seg_dir, f"{mrid}_T1_DLMUSE.nii.gz")
+    )
+    return wmls, seg
+
+
+def test_wml_volumes_match_masked_sums(tmp_path: str) -> None:
+    in_dir = os.path.join(tmp_path, "wmls")
+    seg_dir = os.path.join(tmp_path, "seg")
+    os.makedirs(in_dir)
+    os.makedirs(seg_dir)
+    dict_img = {
+        x: make_images(in_dir, seg_dir, x, i) for i, x in enumerate(["S0", "S1"])
+    }
+
+    # Segmentation of S2 is not in the lesion mask space
+    make_images(in_dir, seg_dir, "S2", 2)
+    nii = nib.load(os.path.join(seg_dir, "S2_T1_DLMUSE.nii.gz"))
+    nib.save(
+        nib.Nifti1Image(np.asanyarray(nii.dataobj), np.eye(4)),
+        os.path.join(seg_dir, "S2_T1_DLMUSE.nii.gz"),
+    )
+
+    out_csv = os.path.join(tmp_path, "wmls.csv")
+    wmls_post.wmls_post(in_dir, "_WMLS.nii.gz", out_csv, seg_dir, num_workers=1)
+    df_out = pd.read_csv(out_csv, dtype={"MRID": str}).set_index("MRID")
+
+    # Reference: lesion voxels of each region
+    vox_vol = np.prod(np.diag(affine)[:3])
+    for mrid, (wmls, seg) in dict_img.items():
+        assert np.isclose(df_out.loc[mrid, "WMLVol"], wmls.sum() * vox_vol)
+        for lbl in [0, 4, 11, 23, 81]:
+            vol = np.sum((wmls > 0) & (seg == lbl)) * vox_vol
+            assert np.isclose(df_out.loc[mrid, f"WMLVol_MUSE_{lbl}"], vol)
+
+    roi_cols = df_out.columns[df_out.columns.str.startswith("WMLVol_MUSE_")]
+    assert df_out.loc["S2", roi_cols].isna().all()
+    assert df_out.loc["S2", "WMLVol"] > 0